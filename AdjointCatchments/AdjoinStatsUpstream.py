@@ -1,33 +1,236 @@
-import pandas as pd
 import os
 from glob import glob
 import json
 
-import pandas as pd
+import numpy as np
 
-import AdjoinUpdown as adj
+from AdjointIndex import INDEX_EXTENSION, GlobalAdjointIndex, merge_regions
+from RiverNetwork import RiverNetwork
 
+AGG_FUNCS = ("sum", "mean", "min", "max", "count")
 
-def join_stats_upstream(upstream_ids: list, stats_df: pd.DataFrame, cols: list, agg_func: str = "sum"):
 
-    return
+def accumulate_upstream(network: RiverNetwork, stats_df: "pd.DataFrame", cols: list, agg_func: str = "sum",
+                        id_col: str = "COMID", weight_col: str = None) -> "pd.DataFrame":
+    """
+    Aggregates attributes over everything upstream of every segment of a network at once, e.g. upstream drainage area,
+    precipitation or land cover fractions. Works as a flow accumulation over the network's depth first order (see
+    RiverNetwork.UpstreamClosure), where every upstream set is a contiguous slice: sums, counts and means come from
+    differences of prefix sums, and mins and maxes from a sparse table built one level at a time, so the whole region
+    is done in a few passes over NumPy arrays for all columns together.
+    Args:
+        network: RiverNetwork (or UpstreamClosure) of the region.
+        stats_df: dataframe with a row of attributes per segment. Segments without a row, or with NaN values, are
+                  skipped, the same as in pandas aggregations.
+        cols: names of the columns to aggregate.
+        agg_func: one of "sum", "mean", "min", "max" or "count".
+        id_col: name of the column in stats_df with the segment ids.
+        weight_col: optional column of weights, e.g. catchment area. With "sum" gives the sum of weight * value and
+                    with "mean" the weighted mean.
+
+    Returns: dataframe indexed by segment id, in network order, with the aggregated value of each column.
+    """
+    # pandas is imported by the functions that take or return dataframes, aggregate_lists and read_stats_table need
+    # only NumPy
+    import pandas as pd
+
+    closure = network if not isinstance(network, RiverNetwork) else network.upstream_closure()
+    network = closure.network
+    values = _align_to_network(network, stats_df, cols, id_col)[closure.order]
+    weights = None
+    if weight_col is not None:
+        if agg_func not in ("sum", "mean"):
+            raise ValueError("Weights can only be used with sum or mean")
+        weights = _align_to_network(network, stats_df, [weight_col], id_col)[closure.order]
+    start, end = closure.start, closure.end
+
+    if agg_func in ("sum", "mean", "count"):
+        valid = ~np.isnan(values)
+        counts = _range_sums(valid.astype(np.int64), start, end)
+        if agg_func == "count":
+            result = counts
+        else:
+            if weights is not None:
+                valid &= ~np.isnan(weights)
+                values = values * weights
+            sums = _range_sums(np.where(valid, values, 0.0), start, end)
+            if agg_func == "sum":
+                result = np.where(counts > 0, sums, np.nan)
+            else:
+                denominators = counts if weights is None else _range_sums(np.where(valid, weights, 0.0), start, end)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    result = np.where(denominators > 0, sums / denominators, np.nan)
+    elif agg_func in ("min", "max"):
+        result = _range_reduce(values, start, end, np.fmin if agg_func == "min" else np.fmax)
+    else:
+        raise ValueError(f"agg_func must be one of {AGG_FUNCS}")
+    return pd.DataFrame(result, index=pd.Index(network.ids, name=id_col), columns=cols)
+
+
+def join_stats_upstream(upstream_ids, stats_df: "pd.DataFrame", cols: list, agg_func: str = "sum",
+                        id_col: str = "COMID", weight_col: str = None):
+    """
+    Aggregates attributes over existing upstream lists, such as a list from an *-upstream-dict.json file. All the
+    lists are flattened into one long table and aggregated with a single groupby, rather than filtering stats_df once
+    per id. For a whole region, accumulate_upstream does the same from the network without needing the lists.
+    Args:
+        upstream_ids: a list of ids, or a dictionary (or AdjointIndex) of ids paired with lists of ids.
+        stats_df: dataframe with a row of attributes per segment.
+        cols: names of the columns to aggregate.
+        agg_func: one of "sum", "mean", "min", "max" or "count".
+        id_col: name of the column in stats_df with the segment ids.
+        weight_col: optional column of weights, used with "sum" or "mean" as in accumulate_upstream.
+
+    Returns: series of aggregated values for a single list, or a dataframe indexed by key for a dictionary of lists.
+    """
+    import pandas as pd
+
+    if agg_func not in AGG_FUNCS:
+        raise ValueError(f"agg_func must be one of {AGG_FUNCS}")
+    if weight_col is not None and agg_func not in ("sum", "mean"):
+        raise ValueError("Weights can only be used with sum or mean")
+    single = not hasattr(upstream_ids, "items")
+    lists = {0: upstream_ids} if single else upstream_ids
+    keys, lengths, members = [], [], []
+    for key, ids in lists.items():
+        keys.append(key)
+        lengths.append(len(ids))
+        members.append(np.asarray(ids, dtype=np.int64))
+    owners = np.repeat(np.arange(len(keys)), lengths)
+    members = np.concatenate(members) if members else np.zeros(0, dtype=np.int64)
+
+    stats = stats_df.drop_duplicates(id_col).set_index(id_col)
+    rows = stats.index.get_indexer(members)
+    found = rows != -1
+    long = stats[cols].iloc[rows[found]].reset_index(drop=True)
+    groups = owners[found]
+    if weight_col is not None:
+        weights = stats[weight_col].to_numpy(dtype=float)[rows[found]]
+        valid = long.notna() & ~np.isnan(weights)[:, None]
+        weighted = long.mul(weights, axis=0).where(valid)
+        result = weighted.groupby(groups).sum(min_count=1)
+        if agg_func == "mean":
+            weight_sums = pd.DataFrame(np.where(valid, weights[:, None], np.nan), columns=cols).groupby(groups).sum()
+            result = result / weight_sums.where(weight_sums > 0)
+    elif agg_func == "sum":
+        result = long.groupby(groups).sum(min_count=1)
+    else:
+        result = long.groupby(groups).agg(agg_func)
+    result = result.reindex(range(len(keys)))
+    if agg_func == "count":
+        result = result.fillna(0).astype(np.int64)
+    if single:
+        return result.iloc[0].rename(None)
+    result.index = pd.Index(keys, name=id_col)
+    return result
+
+
+def aggregate_lists(upstream_ids, keys, stat_ids: np.ndarray, values: np.ndarray, agg_func: str = "sum",
+                    columns: list = None, sorted_ids: bool = False) -> np.ndarray:
+    """
+    Aggregates attributes over stored upstream lists with NumPy only, the counterpart of join_stats_upstream for
+    callers that should not pay for importing pandas, such as short lookups against an index. The lists of all keys
+    are gathered into one array and reduced by range, as in accumulate_upstream.
+    Args:
+        upstream_ids: a dictionary or AdjointIndex (or GlobalAdjointIndex) of ids paired with lists of ids.
+        keys: ids whose lists to aggregate.
+        stat_ids: array of the segment id of each row of values.
+        values: 2d float array with a row of attributes per segment. Segments without a row, or with NaN values, are
+                skipped.
+        agg_func: one of "sum", "mean", "min", "max" or "count".
+        columns: optional positions of the columns of values to aggregate, all of them by default. Only the rows of
+                 the listed ids are read, so a long lived caller can keep one table of every column.
+        sorted_ids: if true, stat_ids are sorted and unique, so they are searched without being sorted again and each
+                    call costs only the length of the lists.
+
+    Returns: 2d array with a row of aggregated values per key. A key whose list is empty, or has no values, gets 0
+             for count and NaN for the other functions, as with join_stats_upstream.
+    """
+    if agg_func not in AGG_FUNCS:
+        raise ValueError(f"agg_func must be one of {AGG_FUNCS}")
+    lists = [np.asarray(upstream_ids[key], dtype=np.int64) for key in keys]
+    lengths = np.array([len(ids) for ids in lists], dtype=np.int64)
+    members = np.concatenate(lists) if lists else np.zeros(0, dtype=np.int64)
+    end = np.cumsum(lengths)
+    start = end - lengths
+
+    stat_ids = np.asarray(stat_ids, dtype=np.int64)
+    values = np.asarray(values, dtype=float).reshape(len(stat_ids), -1)
+    columns = np.arange(values.shape[1]) if columns is None else np.asarray(columns, dtype=np.int64)
+    gathered = np.full((len(members), len(columns)), np.nan)
+    if len(stat_ids):
+        sorter = None if sorted_ids else np.argsort(stat_ids, kind="stable")
+        rows = np.minimum(np.searchsorted(stat_ids, members, sorter=sorter), len(stat_ids) - 1)
+        rows = rows if sorter is None else sorter[rows]
+        found = stat_ids[rows] == members
+        gathered[found] = values[np.ix_(rows[found], columns)]
+
+    if agg_func in ("min", "max"):
+        return _range_reduce(gathered, start, end, np.fmin if agg_func == "min" else np.fmax)
+    valid = ~np.isnan(gathered)
+    counts = _range_sums(valid.astype(np.int64), start, end)
+    if agg_func == "count":
+        return counts
+    sums = _range_sums(np.where(valid, gathered, 0.0), start, end)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts if agg_func == "mean" else sums, np.nan)
+
+
+def read_stats_table(path: str, id_col: str, cols: list):
+    """
+    Reads an id column and attribute columns with NumPy only, from a .npz file of named arrays or a .csv file with a
+    header row.
+
+    Returns: tuple of the int64 id array and a 2d float array with a column per name in cols.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as table:
+            return table[id_col].astype(np.int64), np.column_stack([table[col].astype(float) for col in cols])
+    table = np.genfromtxt(path, delimiter=",", names=True, dtype=None, encoding="utf-8", usecols=[id_col, *cols])
+    table = np.atleast_1d(table)
+    return table[id_col].astype(np.int64), np.column_stack([table[col].astype(float) for col in cols])
+
+
+def _align_to_network(network: RiverNetwork, stats_df: "pd.DataFrame", cols: list, id_col: str) -> np.ndarray:
+    values = np.full((len(network), len(cols)), np.nan)
+    rows = network.index_of(stats_df[id_col].to_numpy())
+    found = rows != -1
+    values[rows[found]] = stats_df[cols].to_numpy(dtype=float)[found]
+    return values
+
+
+def _range_sums(values: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    prefix = np.zeros((len(values) + 1,) + values.shape[1:], dtype=values.dtype)
+    np.cumsum(values, axis=0, out=prefix[1:])
+    return prefix[end] - prefix[start]
+
+
+def _range_reduce(values: np.ndarray, start: np.ndarray, end: np.ndarray, ufunc) -> np.ndarray:
+    """
+    Reduces values[start[i]:end[i]] for every i with an idempotent ufunc (fmin or fmax), using a sparse table where
+    level j holds the reduction of each window of 2**j values. Only one level is kept in memory at a time, and the
+    ranges whose length needs that level are answered as it is built. Empty ranges are left NaN.
+    """
+    result = np.full((len(start),) + values.shape[1:], np.nan)
+    lengths = end - start
+    level = np.full(len(start), -1, dtype=np.int64)
+    level[lengths > 0] = np.floor(np.log2(lengths[lengths > 0])).astype(np.int64)
+    table = values
+    width = 1
+    for j in range(int(level.max()) + 1 if len(level) else 0):
+        sel = level == j
+        result[sel] = ufunc(table[start[sel]], table[end[sel] - width])
+        table = ufunc(table[:-width], table[width:])
+        width *= 2
+    return result
+
 
 jsons_dir = "../RegionalAdjointCatchmentCOMID_JSONs"
 stats_shp = ""
 if __name__ == "__main__":
-    jsons = glob(os.path.join(jsons_dir, "*.json"))
-    all_regions_out = os.path.join(jsons_dir, 'all-regions-upstream_dict.json')
-    all_regions = {}
+    jsons = sorted(glob(os.path.join(jsons_dir, "*-upstream-dict.json")))
+    all_regions_out = os.path.join(jsons_dir, 'all-regions-upstream-dict' + INDEX_EXTENSION)
     if not os.path.exists(all_regions_out):
-        for js in jsons:
-            print(js)
-            f = open(js)
-            cur = json.load(f)
-            all_regions.update(cur)
-        with open(all_regions_out, 'w') as f:
-            json.dump(all_regions, f)
-    else:
-        f = open(all_regions_out)
-        all_regions = json.load(f)
+        merge_regions(jsons, all_regions_out)
+    all_regions = GlobalAdjointIndex(all_regions_out)
     print(all_regions['13082861'])
-
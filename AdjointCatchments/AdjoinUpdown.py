@@ -2,11 +2,19 @@ import argparse
 import json
 import os
 import queue
+import sys
 from collections.abc import Iterable
 from glob import glob
-import geopandas as gpd
 import numpy as np
-import pandas as pd
+
+import Instrumentation
+from AdjointIndex import INDEX_EXTENSION, closure_to_index, dict_to_index
+from Instrumentation import span
+from NetworkSchemas import SCHEMAS, get_schema
+from ResultWriter import format_for_path, write_lists
+from RiverNetwork import RiverNetwork, UpstreamTreeView, DownstreamTreeView
+
+COMMANDS = ("build", "query", "stats", "verify")
 
 
 class NpEncoder(json.JSONEncoder):
@@ -20,7 +28,7 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
-def make_tree(df: pd.DataFrame, order: int = 0) -> dict:
+def make_tree(df: "pd.DataFrame", order: int = 0) -> dict:
     """
     Makes a dictionary depicting a tree where each segment id as a key has a tuple containing the ids of its parent segments, or the ones that
     have it as the next down id. Either does this for every id in the tree, or only includes ids of a given stream order
@@ -49,14 +57,14 @@ def make_tree(df: pd.DataFrame, order: int = 0) -> dict:
     return tree
 
 
-def make_tree_up(df: pd.DataFrame, order: int = 0, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID", order_col: str = "order_") -> dict:
+def make_tree_up(df, order: int = 0, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID", order_col: str = "order_") -> UpstreamTreeView:
     """
     Makes a dictionary depicting a tree where each segment id as a key has a tuple containing the ids of its parent segments, or the ones that
     have it as the next down id. Either does this for every id in the tree, or only includes ids of a given stream order
-    and their parent of the same stream order, if they have one. This function attempts to use pandas vectorization and
-    indexing to improve efficiency on make_tree, but may miss some edge cases, further testing is underway.
+    and their parents of the same stream order, if they have any. The tree is a read-only view over a RiverNetwork,
+    which is built from the id columns in one vectorized pass, rather than a dict filled by one lookup per segment.
     Args:
-        df: dataframe to parse the tree from. Must contain:
+        df: dataframe or RiverNetwork to parse the tree from. A dataframe must contain:
             - a column with the segment/catchment ID ("HydroID")
             - a column with the IDs for the next down segment ("NextDownID")
             - an order column
@@ -67,35 +75,21 @@ def make_tree_up(df: pd.DataFrame, order: int = 0, stream_id_col: str = "COMID",
                           one that the stream for that row feeds into.
         order_col: name of the column that contains the stream order
 
-    Returns: dictionary where for each key, a tuple of all values that have that key as their next down id is assigned.
-             if order==0, values will be either length 0 or 2, otherwise will be 0 or one as only a maximum of
-             one parent will be of the given order.
+    Returns: dict-like view where for each key, a tuple of all values that have that key as their next down id is
+             assigned. if order==0, values will usually be either length 0 or 2, otherwise will usually be 0 or one as
+             normally a maximum of one parent will be of the given order. Use dict() on it if a real dict is needed.
     """
-    if order == 0:
-        out = df[[stream_id_col, next_down_id_col]].set_index(next_down_id_col)
-        out.drop(-1, inplace=True)
-        tree = {}
-        for hydroid in df[stream_id_col]:
-            if hydroid in out.index:
-                rows = out.loc[hydroid][stream_id_col]
-                if not (isinstance(rows, np.floating) or isinstance(rows, np.generic)):
-                    tree[hydroid] = tuple(rows.tolist())
-                else:
-                    tree[hydroid] = (rows,)
-            else:
-                tree[hydroid] = ()
-        return tree
-    out = df[df[order_col] == order][[stream_id_col, next_down_id_col, order_col]].set_index(next_down_id_col)
-    tree = {hydroid: ((int(out.loc[hydroid][stream_id_col]),) if hydroid in out.index else ()) for hydroid in
-            df[df[order_col] == order][stream_id_col]}
-    return tree
+    network = _as_network(df, stream_id_col, next_down_id_col, order_col if order != 0 else None)
+    if order != 0:
+        network = network.filter_order(order)
+    return network.upstream_tree()
 
 
-def make_tree_down(df: pd.DataFrame, order: int = 0, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID", order_col: str = "order_") -> dict:
+def make_tree_down(df, order: int = 0, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID", order_col: str = "order_") -> DownstreamTreeView:
     """
     Performs the simpler task of pairing segment ids as keys with their next down ids as values.
     Args:
-        df: dataframe to parse the tree from. Must contain:
+        df: dataframe or RiverNetwork to parse the tree from. A dataframe must contain:
             - a column with the segment/catchment ID ("HydroID")
             - a column with the IDs for the next down segment ("NextDownID")
             - an order column
@@ -106,20 +100,16 @@ def make_tree_down(df: pd.DataFrame, order: int = 0, stream_id_col: str = "COMID
                           one that the stream for that row feeds into.
         order_col: name of the column that contains the stream order
 
-    Returns: dictionary where for each key its next down id from the dataframe is given as a value.
+    Returns: dict-like view where for each key its next down id from the dataframe is given as a value. If filtered by
+             order, ids whose next down segment is of a different order get -1.
     """
-    if order == 0:
-        tree = dict(zip(df[stream_id_col], df[next_down_id_col]))
-        return tree
-    out = df[[stream_id_col, next_down_id_col, order_col]][df[order_col] == order]
-    out_2 = out[out[next_down_id_col].isin(out[stream_id_col])]
-    out.loc[~out[stream_id_col].isin(out_2[stream_id_col]), next_down_id_col] = -1
-    # tree = dict(zip(out.loc[out['NextDownID'] != -1, 'HydroID'], out.loc[out['NextDownID'] != -1, 'NextDownID']))
-    tree = dict(zip(out[stream_id_col], out[next_down_id_col]))
-    return tree
+    network = _as_network(df, stream_id_col, next_down_id_col, order_col if order != 0 else None)
+    if order != 0:
+        network = network.filter_order(order)
+    return network.downstream_tree()
 
 
-def trace_tree(tree: dict, search_id: int, cuttoff_n: int = 200) -> list:
+def trace_tree(tree: dict, search_id: int, cuttoff_n: int = None) -> list:
     """
     Universal function that traces a tree produced by make_tree_up or make_tree_down from the search id all the way to
     the end of the segment. If the given tree was produced for a given order, it will produce a list with all down or
@@ -131,30 +121,41 @@ def trace_tree(tree: dict, search_id: int, cuttoff_n: int = 200) -> list:
               {2: (3, 5), 3: (), 4: (): 5: (6, 7), 6: (), 7: ()} for an upstream tree
                 or
               {2: -1, 3: 2, 5: 2, 4: -1, 6: 5, 7: 5} for a downstream tree
+              Views made by make_tree_up and make_tree_down are traced directly on their RiverNetwork arrays.
+              Either way each segment is visited only once, so cycles in a malformed tree cannot loop forever; use
+              NetworkValidation.validate_network to find and clean them.
         search_id: id to search from.
+        cuttoff_n: optional maximum number of queue items processed for plain dict trees. None, the default, traces
+                   the whole tree.
 
     Returns: list containing all ids that will be upstream of the search_id.
     """
+    if isinstance(tree, (UpstreamTreeView, DownstreamTreeView)):
+        network = tree.network
+        index = network.index_of(search_id)
+        if index == -1:
+            return [search_id] if search_id != -1 else []
+        if isinstance(tree, UpstreamTreeView):
+            return network.ids[network.upstream_indices(index)].tolist()
+        return network.ids[network.downstream_indices(index)].tolist()
     q = queue.Queue()
     q.put((search_id,))
     upstream = []
+    visited = set()
     i = 0
 
     while not q.empty():
         n = q.get()
-        if i > cuttoff_n:  # cuts off infinite loops. Number may need to be adjusted if adjoint catchments start to contain more than 200 individual regions
+        if cuttoff_n is not None and i > cuttoff_n:
             break
-        if isinstance(n, Iterable):
-            for s in n:
-                if s != -1:
-                    upstream.append(s)
-                if s in tree:
-                    q.put(tree[s])
-        else:
-            if n != -1:
-                upstream.append(n)
-            if n in tree:
-                q.put(tree[n])
+        for s in (n if isinstance(n, Iterable) else (n,)):
+            if s in visited:
+                continue
+            visited.add(s)
+            if s != -1:
+                upstream.append(s)
+            if s in tree:
+                q.put(tree[s])
         i += 1
     return upstream
 
@@ -196,32 +197,79 @@ def trace_downstream(tree: dict, search_id: int) -> list:
         down_id = tree[down_id]
     return downstream
 
-def join_order_geoglows(catch, drain):
-    drain_pts = gpd.GeoDataFrame(pd.DataFrame(drain).drop('geometry', axis=1),
-                                         geometry=drain.centroid)
-    comb = catch.sjoin(drain_pts[['COMID', 'order_', 'geometry']], how='left', predicate='contains')
-    comb.reset_index(inplace=True, drop=True)
-    comb.drop('index_right', axis=1, inplace=True)
-    comb_adjoin = comb.copy()
-    comb_adjoin = comb_adjoin.dissolve(by='HydroID', as_index=False, aggfunc='max')
-    comb_adjoin = comb_adjoin.sort_values(by='HydroID', ascending=True)
+def _as_network(df, stream_id_col: str, next_down_id_col: str, order_col: str = None) -> RiverNetwork:
+    if isinstance(df, RiverNetwork):
+        return df
+    return RiverNetwork.from_dataframe(df, stream_id_col, next_down_id_col, order_col)
+
+
+def join_order_geoglows(catch: "gpd.GeoDataFrame", drain: "gpd.GeoDataFrame", catch_id_col: str = "HydroID",
+                        drain_id_col: str = "COMID", order_col: str = "order_", match_on_id: bool = False):
+    """
+    Adds the id and stream order of the drainage line in each catchment to a GEOGloWS catchment GeoDataFrame. Only
+    attributes are joined and aggregated, the catchment geometries are left untouched.
+    Args:
+        catch: catchment GeoDataFrame.
+        drain: drainage line GeoDataFrame with id and order columns.
+        catch_id_col: the name of the column with the catchment ids.
+        drain_id_col: the name of the column with the drainage line ids.
+        order_col: the name of the column with the stream orders in drain.
+        match_on_id: if true, catchments are matched to the drainage line with the same id, with no spatial join,
+                     for tables whose catchment and drainage line ids are the same ids. By default each catchment gets
+                     the highest order of the drainage lines whose centroids it contains, found with a single STRtree
+                     bulk query.
+
+    Returns: the catchments, one row per catchment id (the first row if an id is repeated), sorted by id, with the
+             drain_id_col and order_col columns added.
+    """
+    with span("join_order", len(catch)):
+        return _join_order(catch, drain, catch_id_col, drain_id_col, order_col, match_on_id)
+
+
+def _join_order(catch, drain, catch_id_col: str, drain_id_col: str, order_col: str, match_on_id: bool):
+    # geopandas, pandas and shapely take most of a second to import, so they are only imported by the functions that
+    # read or join tables, and looking lists up in a stored index needs nothing but NumPy
+    import pandas as pd
+    import shapely
+
+    catch_ids = catch[catch_id_col].to_numpy()
+    drain_ids = drain[drain_id_col].to_numpy()
+    if match_on_id:
+        matches = pd.DataFrame({catch_id_col: catch_ids, drain_id_col: catch_ids})
+        matches = matches.merge(drain[[drain_id_col, order_col]], on=drain_id_col, how="inner")
+    else:
+        tree = shapely.STRtree(drain.geometry.centroid.values)
+        catch_rows, drain_rows = tree.query(catch.geometry.values, predicate="contains")
+        matches = pd.DataFrame({catch_id_col: catch_ids[catch_rows], drain_id_col: drain_ids[drain_rows],
+                                order_col: drain[order_col].to_numpy()[drain_rows]})
+    joined = matches.groupby(catch_id_col, sort=False).max()
+    comb_adjoin = catch.drop(columns=[col for col in (drain_id_col, order_col) if col in catch.columns and
+                                      col != catch_id_col])
+    comb_adjoin = comb_adjoin.drop_duplicates(catch_id_col).join(joined, on=catch_id_col)
+    comb_adjoin = comb_adjoin.sort_values(by=catch_id_col, ascending=True).reset_index(drop=True)
     return comb_adjoin
 
 
 def create_adjoint_dict(network_shp, out_file: str = None, stream_id_col: str = "COMID",
                         next_down_id_col: str = "NextDownID", order_col: str = "order_", trace_up: bool = True,
-                        order_filter: int = 0):
+                        order_filter: int = 0, return_dict: bool = True):
     """
     Creates a dictionary where each unique id in a stream network is assigned a list of all ids upstream or downstream
     of that stream, as specified. By default is designed to trace upstream on GEOGloWS Delineation Catchment shapefiles,
     but can be customized for other files with column name parameters, customized to trace down, or filtered by stream
     order. If filtered by stream order, the dictionary will only contain ids of the given stream order, with the
-    upstream or downstream ids for the other streams in the chain that share that stream order.
+    upstream or downstream ids for the other streams in the chain that share that stream order. Upstream lists are
+    computed for every id at once from one ordering of the network (see RiverNetwork.UpstreamClosure), so they are
+    never truncated, and are given in depth first order starting with the id itself. The read, validate,
+    build_network, trace and write stages are timed in spans of the current Instrumentation.
     Args:
-        network_shp: path to  .shp file that contains the stream network. This file
+        network_shp: path to  .shp file that contains the stream network, read through NetworkIngest, so only the
+                     needed columns are read and they are cached for later runs. This file
                      must contain attributes for a unique id and a next down id, and if filtering by order number is
                      specified, it must also contain a column with stream order values.
-        out_file: a path to an output file to write the dictionary as a .json, if desired.
+        out_file: a path to an output file to write the dictionary as a .json, if desired. Lists are written as they
+                  are traced, see ResultWriter.write_lists, which can also write .jsonl and .parquet files. If the path
+                  ends in .adj the result is written as a memory-mapped AdjointIndex instead.
         stream_id_col: the name of the column that contains the unique ids for the stream segments
         next_down_id_col: the name of the column that contains the unique id of the next down stream for each row, the
                           one that the stream for that row feeds into.
@@ -229,102 +277,235 @@ def create_adjoint_dict(network_shp, out_file: str = None, stream_id_col: str =
         trace_up: if true, trace up from each stream, otherwise trace down.
         order_filter: if set to number other than zero, limits values traced to only ids that match streams with that
                       stream order
+        return_dict: if false, the dictionary is never built, only written to out_file, which keeps memory bounded
+                     for large regions.
 
-    Returns:
-
+    Returns: the dictionary, or out_file if return_dict is false.
     """
-    network_df = gpd.read_file(network_shp)
+    # NetworkIngest and NetworkValidation import pandas, see _join_order
+    from NetworkIngest import read_network_table
+    from NetworkValidation import validate_network
+
+    if out_file is not None and os.path.exists(out_file):
+        print("File already created")
+        return {}
     columns_to_search = [stream_id_col, next_down_id_col]
     if order_filter != 0:
         columns_to_search.append(order_col)
+    with span("read") as stage:
+        network_df = read_network_table(network_shp, columns_to_search)
+        stage.rows = len(network_df)
     for col in columns_to_search:
         if col not in network_df.columns:
             print(f"Column {col} not present")
             return {}
+    with span("validate", len(network_df)):
+        report, network_df = validate_network(network_df, stream_id_col, next_down_id_col,
+                                              order_col if order_filter != 0 else None)
+    if not report.ok:
+        print(report.summary())
+    with span("build_network") as stage:
+        network = _as_network(network_df, stream_id_col, next_down_id_col, order_col if order_filter != 0 else None)
+        if order_filter != 0:
+            network = network.filter_order(order_filter)
+        stage.rows = len(network)
+    return trace_network(network, out_file, trace_up, {"trace_up": trace_up, "order_filter": order_filter},
+                         return_dict)
+
+
+def trace_network(network: RiverNetwork, out_file: str = None, trace_up: bool = True, meta: dict = None,
+                  return_dict: bool = True):
+    """
+    Traces every segment of a network up or down and writes the lists, the tracing and output half of
+    create_adjoint_dict, shared by every source of networks (see NetworkSchemas).
+    Args:
+        network: RiverNetwork to trace.
+        out_file: path to write the lists to, see create_adjoint_dict for the formats.
+        trace_up: if true, trace up from each stream, otherwise trace down.
+        meta: dictionary of extra information stored in the header of .adj files.
+        return_dict: if false, the dictionary is never built, only written to out_file.
+
+    Returns: the dictionary, or out_file if return_dict is false.
+    """
     if trace_up:
-        tree = make_tree_up(network_df, order_filter, stream_id_col, next_down_id_col, order_col)
+        with span("trace", len(network)):
+            closure = network.upstream_closure()
+        lists = closure.items
     else:
-        tree = make_tree_down(network_df, order_filter, stream_id_col, next_down_id_col, order_col)
-    if order_filter != 0:
-        upstream_lists_dict = {str(hydro_id): trace_tree(tree, hydro_id) for hydro_id in network_df[network_df[order_col] == order_filter][stream_id_col]}
-    else:
-        upstream_lists_dict = {str(hydro_id): trace_tree(tree, hydro_id) for hydro_id in network_df[stream_id_col]}
+        closure = None
+        lists = lambda: ((stream_id, network.ids[network.downstream_indices(index)])
+                         for index, stream_id in enumerate(network.ids.tolist()))
+    upstream_lists_dict = None
+    if return_dict or (closure is None and out_file is not None and out_file.endswith(INDEX_EXTENSION)):
+        with span("to_dict", len(network)):
+            upstream_lists_dict = closure.to_dict() if closure is not None else \
+                {str(stream_id): values.tolist() for stream_id, values in lists()}
     if out_file is not None:
-        if not os.path.exists(out_file):
-            with open(out_file, "w") as f:
-                json.dump(upstream_lists_dict, f, cls=NpEncoder)
-        else:
-            print("File already created")
-            return {}
-    return upstream_lists_dict
+        with span("write", len(network)):
+            if out_file.endswith(INDEX_EXTENSION):
+                meta = {"trace_up": trace_up, **(meta or {})}
+                if closure is not None:
+                    closure_to_index(closure, out_file, meta)
+                else:
+                    dict_to_index(upstream_lists_dict, out_file, meta)
+            else:
+                write_lists(lists(), out_file, format_for_path(out_file) or "json")
+    return upstream_lists_dict if return_dict else out_file
 
 
-if __name__ == "__main__":
-    # catch = gpd.read_file(glob(os.path.join(sys.argv[1], "*.shp")))
-    # Default values
-    network_dir = None
-    out_file = None
-    stream_id_col = "HydroID"
-    next_down_id_col = "NextDownID"
-    order_col = "order_"
-    trace_up = True
-    order_filter = 0
+def main(argv: list = None):
+    """
+    Command line entry point with the subcommands:
+        - build: traces a network file and writes the lists (what running this script did before subcommands, and
+          still does when the first argument is not a subcommand)
+        - query: prints the upstream or downstream lists of ids from a stored .adj index
+        - stats: aggregates attribute columns over the upstream lists of ids in a stored .adj index
+        - verify: checks stored lists against the lists traced from the network, see VerifyResults
+    query and stats only read the index and a NumPy-readable table, so they never import pandas or geopandas.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] not in COMMANDS and argv[0] not in ("-h", "--help"):
+        argv = ["build", *argv]
+    from AdjoinStatsUpstream import AGG_FUNCS
+
+    parser = argparse.ArgumentParser(description='Adjoint catchment tools: build upstream or downstream lists from a '
+                                                 'stream network, and query, aggregate or verify stored results.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
     description = 'This script will run Adjoin Catchments code on a shapefile. The function produces a dictionary,' \
                   ' which can be written to a specified destination as a .json file if the "outfile" parameter is ' \
                   'defined. The function opens the shapefile provided, and for each stream id finds a list of all ' \
                   'stream ids that are upstream, or downstream, as specified, either filtering by stream order or ' \
                   'getting all stream segments. A dictionary is created with each id as the key, and the list of their'\
                   ' up or downstream parents/children as their value.'
-
-    parser = argparse.ArgumentParser(description=description)
-
-    parser.add_argument('networkshp', type=str,
-                        help='Required. Path to directory containing .shp file. This directory must only contain the '
-                             'target shapefile')
-    parser.add_argument('--outfile', metavar='-O', type=str,
-                        help='Path to output file if writing to .json is desired. Default: None')
-    parser.add_argument('--streamidcol', metavar='-SIDCol', type=str, default="COMID",
+    build = commands.add_parser('build', description=description, help='Trace a network and write the lists.')
+    build.add_argument('networkshp', type=str,
+                       help='Required. Path to directory containing .shp file. This directory must only contain the '
+                            'target shapefile')
+    build.add_argument('--outfile', metavar='-O', type=str,
+                       help='Path to output file if writing to .json is desired, or to .adj for a binary index. '
+                            'Default: None')
+    build.add_argument('--streamidcol', metavar='-SIDCol', type=str, default="COMID",
+                       help='Name of Stream ID Column. Default: "COMID"')
+    build.add_argument('--nextdownidcol', metavar='-NDIDCol', type=str, default="NextDownID",
+                       help='Name of Next Down ID Column. Default: "NextDownID"')
+    build.add_argument('--ordercol', metavar='-OrdCol', type=str, default="order_",
+                       help='Name of Column containing stream orders. Need not be provided if orderfilter is 0,'
+                            'otherwise required if the tool is to be able to filter by order. Default: "order_"')
+    build.add_argument('--traceup', metavar='-U', type=bool, default=True,
+                       help='If true, traces up, else down. Accepts: True or False. Default: True')
+    build.add_argument('--orderfilter', metavar='-Ord', type=int, default=0,
+                       help='Number of stream order to limit to. If 0 runs on all streams, else only includes '
+                            'specified stream order. Default: 0.')
+    build.add_argument('--schema', type=str, default=None, choices=sorted(SCHEMAS),
+                       help='Source of the network, sets the id, next down id and order column names for that source, '
+                            'e.g. "nga" for TauDEM LINKNO/DSLINKNO/strmOrder. Overrides the column options.')
+    Instrumentation.add_arguments(build)
+
+    query = commands.add_parser('query', help='Print the lists of ids from a stored .adj index.',
+                                description='Prints {id: [ids]} as json for each id, from a regional or all-regions '
+                                            '.adj index. Ids without an entry are printed as null.')
+    query.add_argument('index', type=str, help='Required. Path to the .adj index.')
+    query.add_argument('ids', type=int, nargs='+', help='Required. Stream ids to look up.')
+    query.add_argument('--down', action='store_true',
+                       help='Follow the stored next down ids instead, for indexes written from a network.')
+    query.add_argument('--count', action='store_true', help='Print the number of ids in each list instead.')
+
+    stats = commands.add_parser('stats', help='Aggregate attributes over the lists of a stored .adj index.',
+                                description='Aggregates attribute columns over the upstream list of each id and '
+                                            'prints a csv with a row per id.')
+    stats.add_argument('index', type=str, help='Required. Path to the .adj index.')
+    stats.add_argument('statsfile', type=str,
+                       help='Required. Table of attributes per segment, a .csv with a header row or a .npz of columns.')
+    stats.add_argument('ids', type=int, nargs='*',
+                       help='Stream ids to aggregate for. Default: every id of a regional index')
+    stats.add_argument('--cols', type=str, required=True, help='Required. Comma separated columns to aggregate.')
+    stats.add_argument('--idcol', type=str, default="COMID",
+                       help='Name of the stream id column of the stats file. Default: "COMID"')
+    stats.add_argument('--agg', choices=AGG_FUNCS, default="sum", help='Aggregation. Default: sum')
+
+    verify = commands.add_parser('verify', help='Check stored lists against the network.',
+                                 description='Recomputes the lists from the network and reports missing keys and '
+                                             'truncated, mismatched or duplicated lists. Exits with 1 if any differ.')
+    verify.add_argument('networkshp', type=str, help='Required. Path to the stream network file.')
+    verify.add_argument('results', type=str, help='Required. Path to the *-upstream-dict.json or .adj to check.')
+    verify.add_argument('--streamidcol', metavar='-SIDCol', type=str, default="COMID",
                         help='Name of Stream ID Column. Default: "COMID"')
-    parser.add_argument('--nextdownidcol', metavar='-NDIDCol', type=str, default="NextDownID",
+    verify.add_argument('--nextdownidcol', metavar='-NDIDCol', type=str, default="NextDownID",
                         help='Name of Next Down ID Column. Default: "NextDownID"')
-    parser.add_argument('--ordercol', metavar='-OrdCol', type=str, default="order_",
-                        help='Name of Column containing stream orders. Need not be provided if orderfilter is 0,'
-                             'otherwise required if the tool is to be able to filter by order. Default: "order_"')
-    parser.add_argument('--traceup', metavar='-U', type=bool, default=True,
-                        help='If true, traces up, else down. Accepts: True or False. Default: True')
-    parser.add_argument('--orderfilter', metavar='-Ord', type=int, default=0,
-                        help='Number of stream order to limit to. If 0 runs on all streams, else only includes '
-                             'specified stream order. Default: 0.')
-    args = parser.parse_args()
+    verify.add_argument('--schema', type=str, default=None, choices=sorted(SCHEMAS),
+                        help='Source of the network, overriding the column options.')
+    verify.add_argument('--sample', type=int, default=None,
+                        help='Number of randomly chosen lists to check. Default: all of them')
+    verify.add_argument('--workers', type=int, default=1, help='Number of processes. Default: 1')
+    verify.add_argument('--tracedown', action='store_true', help='The stored lists trace downstream.')
+
+    args = parser.parse_args(argv)
+    return {"build": _build, "query": _query, "stats": _stats, "verify": _verify}[args.command](args)
+
+
+def _build(args):
     print(vars(args))
-    network_shp = args.networkshp
-    if 'outfile' in args:
-        out_file = args.outfile
-    if 'streamidcol' in args:
-        stream_id_col = args.streamidcol
-    if 'nextdownidcol' in args:
-        next_down_id_col = args.nextdownidcol
-    if 'ordercol' in args:
-        order_col = args.ordercol
-    if 'traceup' in args:
-        trace_up = args.traceup
-    if 'orderfilter' in args:
-        order_filter = args.orderfilter
-
-    print(create_adjoint_dict(network_shp, out_file, stream_id_col, next_down_id_col, order_col, trace_up, order_filter))
-    # catch = gpd.read_file(glob(os.path.join("scratch_data/japan_comb_sorted", "*.shp"))[0])
-    # out_file = os.path.join(sys.argv[1], "tree_3.json") #path to directory in which jsons must be written should be given as argument when running script
-    # for i in range(5):
-    #     print(i)
-    #     tree = make_tree_up(catch, i)
-    #     out_file = os.path.join("scratch_data/trees_by_order", f"up_tree_order{i}.json")
-    #     with open(out_file, "w") as f:
-    #         json.dump(tree, f)
-    # for i in range(5):
-    #     print(i)
-    #     tree = make_tree_up(catch, i)
-    #     out_file = os.path.join("scratch_data/trees_by_order", f"down_tree_order{i}.json")
-    #     with open(out_file, "w") as f:
-    #         json.dump(tree, f)
+    stream_id_col, next_down_id_col, order_col = args.streamidcol, args.nextdownidcol, args.ordercol
+    if args.schema is not None:
+        schema = get_schema(args.schema)
+        stream_id_col, next_down_id_col = schema.stream_id_col, schema.next_down_id_col
+        order_col = schema.order_col or order_col
+    with Instrumentation.use_instrumentation(Instrumentation.from_args(args)):
+        print(create_adjoint_dict(args.networkshp, args.outfile, stream_id_col, next_down_id_col, order_col,
+                                  args.traceup, args.orderfilter))
+    return 0
+
+
+def _query(args):
+    from AdjointIndex import open_index
+
+    index = open_index(args.index)
+    found = {}
+    for key in args.ids:
+        if key not in index:
+            found[str(key)] = None
+            continue
+        values = index.downstream(key) if args.down else index[key]
+        found[str(key)] = len(values) if args.count else values.tolist()
+    print(json.dumps(found))
+    return 0 if all(value is not None for value in found.values()) else 1
+
+
+def _stats(args):
+    from AdjoinStatsUpstream import aggregate_lists, read_stats_table
+    from AdjointIndex import open_index
+
+    index = open_index(args.index)
+    cols = [col for col in args.cols.split(",") if col]
+    stat_ids, values = read_stats_table(args.statsfile, args.idcol, cols)
+    if args.ids:
+        keys = [key for key in args.ids if key in index]
+        for key in sorted(set(args.ids) - set(keys)):
+            print(f"WARNING: {key} is not in {args.index}", file=sys.stderr)
+    elif hasattr(index, "keys"):
+        keys = index.keys().tolist()
+    else:
+        raise ValueError(f"{args.index} holds several regions, give the ids to aggregate for")
+    result = aggregate_lists(index, keys, stat_ids, values, args.agg)
+    print(",".join([args.idcol, *cols]))
+    for key, row in zip(keys, result.tolist()):
+        print(",".join([str(key), *map(str, row)]))
+    return 0
 
 
+def _verify(args):
+    from VerifyResults import verify_file
+
+    report = verify_file(args.networkshp, args.results, args.streamidcol, args.nextdownidcol, args.schema,
+                         not args.tracedown, args.sample, args.workers)
+    print(report.summary())
+    return 0 if report.ok else 1
+
+
+if __name__ == "__main__":
+    # catch = gpd.read_file(glob(os.path.join("scratch_data/japan_comb_sorted", "*.shp"))[0])
+    # out_file = os.path.join(sys.argv[1], "tree_3.json") #path to directory in which jsons must be written should be given as argument when running script
+    # the lists of every stream order at once: OrderChains(RiverNetwork.from_dataframe(catch, order_col="order_"))
+    # .order_dicts()
+    sys.exit(main())
@@ -1,84 +1,218 @@
+import argparse
 import json
 import os
+import resource
 import sys
-import zipfile
-import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
-import geopandas as gpd
 import time
-import pandas as pd
+
+import numpy as np
+
 import AdjoinUpdown as adj
+import Instrumentation
+from Instrumentation import span
+from NetworkIngest import read_network_table
+from NetworkSchemas import read_network
+from NetworkValidation import validate_network
+
+MANIFEST_NAME = "regions-manifest.json"
+
+
+def find_regions(parse_dir: str) -> list:
+    """
+    Finds the GEOGloWS regions in a directory of delineation zips, largest first so the longest jobs start earliest.
+    Args:
+        parse_dir: directory containing the *drainageline.zip files, e.g. GEOGloWS-Delineation-Shapefiles
+
+    Returns: list of dictionaries with the region name, the path to its drainage line zip and the zip size in bytes.
+    """
+    regions = []
+    for drain_zip in glob(os.path.join(parse_dir, '*drainageline.zip')):
+        regions.append({"name": os.path.basename(drain_zip).split("-")[0], "drainage_zip": os.path.abspath(drain_zip),
+                        "size": os.path.getsize(drain_zip)})
+    return sorted(regions, key=lambda region: region["size"], reverse=True)
+
+
+def region_network(path: str, schema, basins: str = None, basin_id_col: str = "streamID", name: str = None):
+    """
+    Reads, validates and builds the network of a region described by a NetworkSchema, the same way for every source.
+    Args:
+        path: path to the stream network file.
+        schema: NetworkSchema, or the name of one, of the stream network.
+        basins: optional path to the region's catchments. If given, only streams with a catchment are kept.
+        basin_id_col: the name of the column of the basins holding the stream id of each catchment.
+        name: name of the region, for the validation summary.
+
+    Returns: tuple of (RiverNetwork, NetworkSchema).
+    """
+    with span("read") as stage:
+        schema, network_df = read_network(path, schema)
+        stage.rows = len(network_df)
+    order_col = schema.order_col if schema.order_col in network_df.columns else None
+    with span("validate", len(network_df)):
+        report, network_df = validate_network(network_df, schema.stream_id_col, schema.next_down_id_col, order_col,
+                                              outlet_id=schema.outlet_id)
+    if not report.ok:
+        print(f"{name or path}: {report.summary()}")
+    with span("build_network") as stage:
+        network = schema.network(network_df)
+        if basins is not None:
+            basin_ids = read_network_table(basins, [basin_id_col])[basin_id_col].to_numpy()
+            network = network.subset(np.isin(network.ids, basin_ids))
+        stage.rows = len(network)
+    return network, schema
+
 
-def create_adjoint_dict(catch_dir, drain_dir, out_file):
-    out_file = os.path.join(out_dir, f'{os.path.basename(catch_dir).split("-")[0]}-upstream-dict.json')
-    if not os.path.exists(out_file):
-        chmt = gpd.read_file(glob(os.path.join(catch_dir, "*.shp"))[0])
-        print(os.path.basename(catch_dir).split("-")[0])
-        print(chmt.columns)
-        if "NextDownID" in chmt.columns:
-            start_time = time.time()
-            drain = gpd.read_file(glob(os.path.join(drain_dir, "*.shp"))[0])
-            if "order_" not in chmt.columns:
-                chmt = join_order_geoglows(chmt, drain)
-            # tree = {hydro_id: tuple(chmt[chmt["NextDownID"] == hydro_id]["HydroID"].tolist()) for
-            #         hydro_id in chmt['HydroID']}
-            tree = adj.make_tree_up(chmt, 0)
-            print(tree)
-            upstream_lists_dict = {hydro_id: adj.trace_tree(tree, hydro_id) for hydro_id in chmt["HydroID"]}
-            with open(out_file, "w") as f:
-                json.dump(upstream_lists_dict, f)
-            print("time elapsed: {:.2f}s".format(time.time() - start_time))
-        else:
-            print("NextDownID not present")
-    else:
-        print("File already created")
-    return out_file
-
-
-def join_order_geoglows(catch, drain):
-    drain_pts = gpd.GeoDataFrame(pd.DataFrame(drain).drop('geometry', axis=1),
-                                         geometry=drain.centroid)
-    comb = catch.sjoin(drain_pts[['COMID', 'order_', 'geometry']], how='left', predicate='contains')
-    comb.reset_index(inplace=True, drop=True)
-    comb.drop('index_right', axis=1, inplace=True)
-    comb_adjoin = comb.copy()
-    comb_adjoin = comb_adjoin.dissolve(by='HydroID', as_index=False, aggfunc='max')
-    comb_adjoin = comb_adjoin.sort_values(by='HydroID', ascending=True)
-    return comb_adjoin
+def process_region(region: dict, out_file: str, stream_id_col: str = "COMID", instrument: dict = None,
+                   schema=None, trace_up: bool = True, basin_id_col: str = "streamID") -> dict:
+    """
+    Traces one region. Without a schema, runs create_adjoint_dict on the region's drainage lines, reading the shapefile
+    straight out of its zip. With a schema, the region's "source" file is read with region_network, keeping only the
+    streams with a catchment in its "basins" file if it has one, and traced with trace_network. The output is written
+    to a temporary file and moved into place once complete, so a crash never leaves a partial output behind. Meant to
+    run in its own worker process, so the reported peak RSS is that of this region alone.
+    Args:
+        region: dictionary from find_regions, or with a schema from AdjointCatchmentsNGA.find_nga_regions.
+        out_file: path to the output .json, .jsonl, .parquet or .adj file.
+        stream_id_col: the name of the column that contains the unique ids for the stream segments, without a schema.
+        instrument: if given, the stages of the region are timed, with the options "trace_memory" (bool) and
+                    "profile_path" (path for the region's cProfile stats) passed on to Instrumentation.
+        schema: optional NetworkSchema, or the name of one, of the region's source file.
+        trace_up: if true, trace up from each stream, otherwise trace down.
+        basin_id_col: the name of the column of the basins holding the stream id of each catchment.
+
+    Returns: dictionary with the region name, output path, wall time in seconds, peak RSS in MB, the number of segments
+             if a schema is given and, if instrumented, the span records of its stages.
+    """
+    start_time = time.time()
+    root, ext = os.path.splitext(out_file)
+    partial_file = f"{root}.partial{ext}"
+    if os.path.exists(partial_file):
+        os.remove(partial_file)
+    segments = None
+    instrumentation = Instrumentation.Instrumentation(enabled=instrument is not None, **(instrument or {}))
+    with Instrumentation.use_instrumentation(instrumentation):
+        with span("region"):
+            if schema is None:
+                adj.create_adjoint_dict(f"zip://{region['drainage_zip']}", partial_file, stream_id_col,
+                                        trace_up=trace_up, return_dict=False)
+            else:
+                network, schema = region_network(region["source"], schema, region.get("basins"), basin_id_col,
+                                                 region["name"])
+                segments = len(network)
+                adj.trace_network(network, partial_file, trace_up, {"region": region["name"], "schema": schema.name},
+                                  return_dict=False)
+    if not os.path.exists(partial_file):
+        raise RuntimeError(f"No output written for {region['name']}")
+    os.replace(partial_file, out_file)
+    report = {"name": region["name"], "out_file": out_file, "wall_time": time.time() - start_time,
+              "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if segments is not None:
+        report["segments"] = segments
+    if instrument is not None:
+        report["spans"] = [dict(record, region=region["name"]) for record in instrumentation.records]
+    return report
+
+
+def run_regions(parse_dir: str, out_dir: str, workers: int = None, stream_id_col: str = "COMID",
+                out_ext: str = ".json", force: bool = False,
+                instrumentation: Instrumentation.Instrumentation = None) -> dict:
+    """
+    Processes every region in a directory of delineation zips in parallel, one fresh worker process per region. The
+    state of each region is kept in a manifest in out_dir, so a rerun only processes regions that failed, were never
+    finished, or whose output has gone missing.
+    Args:
+        parse_dir: directory containing the *drainageline.zip files.
+        out_dir: directory to write the <region>-upstream-dict files and the manifest to.
+        workers: number of worker processes, defaults to the number of CPUs.
+        stream_id_col: the name of the column that contains the unique ids for the stream segments
+        out_ext: ".json" for the json dictionaries or ".adj" for binary AdjointIndex files.
+        force: if true, reprocesses regions that are already done.
+        instrumentation: if given and enabled, every region's stages are timed in its worker and the span records
+                         are passed to this instrumentation's sinks, tagged with the region name. The manifest then
+                         holds each region's stage totals. cProfile stats are written per region, named after
+                         instrumentation.profile_path with the region name added.
+
+    Returns: the manifest, a dictionary of region names paired with their status, timing and any error.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    pending = []
+    for region in find_regions(parse_dir):
+        out_file = os.path.join(out_dir, f'{region["name"]}-upstream-dict{out_ext}')
+        entry = manifest.get(region["name"], {})
+        if not force and entry.get("status") == "done" and os.path.exists(entry.get("out_file", out_file)):
+            print(f"{region['name']}: already done, skipping")
+            continue
+        pending.append((region, out_file))
+
+    instrument = None
+    if instrumentation is not None and instrumentation.enabled:
+        instrument = {"trace_memory": instrumentation.trace_memory}
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        futures = {}
+        for region, out_file in pending:
+            if instrument is not None and instrumentation.profile_path is not None:
+                root, ext = os.path.splitext(instrumentation.profile_path)
+                instrument = dict(instrument, profile_path=f"{root}-{region['name']}{ext or '.prof'}")
+            futures[pool.submit(process_region, region, out_file, stream_id_col, instrument)] = region
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                report = future.result()
+                spans = report.pop("spans", None)
+                if spans is not None:
+                    for record in spans:
+                        instrumentation.emit(record)
+                    report["stages"] = Instrumentation.aggregate(spans)
+                manifest[region["name"]] = {"status": "done", **report}
+                print(f"{region['name']}: {report['wall_time']:.2f}s, peak RSS {report['peak_rss_mb']:.0f} MB")
+            except Exception as e:
+                manifest[region["name"]] = {"status": "failed", "name": region["name"], "error": repr(e)}
+                print(f"WARNING: {region['name']} failed: {e!r}")
+            _write_manifest(manifest, manifest_path)
+    return manifest
+
+
+def _write_manifest(manifest: dict, manifest_path: str):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
 
 
 if __name__ == "__main__":
-    parse_dir = sys.argv[1]
-    out_dir = sys.argv[2]
     # parse_dir = 'GEOGloWS-Delineation-Shapefiles'
     # out_dir = 'RegionalAdjointCatchmentJSONs'
-    catchment_zips = glob(os.path.join(parse_dir, '*catchment.zip'))
-    drainageline_zips = glob(os.path.join(parse_dir, '*drainageline.zip'))
-    # catchment_zips = glob(os.path.join(parse_dir, '*/*basins*.gpkg'))
-    # drainageline_zips = glob(os.path.join(parse_dir, '*/*streamnet*.shp'))
-    print(catchment_zips)
-    catch_dirs = []
-    drain_dirs = []
-    for catch, drain in zip(catchment_zips, drainageline_zips):
-        catch_name, drain_name = os.path.basename(catch), os.path.basename(drain)
-        catch_dir = os.path.join(parse_dir, catch_name[:-4])
-        catch_dirs.append(catch_dir)
-        if not os.path.exists(catch_dir):
-            with zipfile.ZipFile(catch, 'r') as zip_ref:
-                os.mkdir(catch_dir)
-                zip_ref.extractall(catch_dir)
-        drain_dir = os.path.join(parse_dir, drain_name[:-4])
-        drain_dirs.append(drain_dir)
-        if not os.path.exists(drain_dir):
-            with zipfile.ZipFile(drain, 'r') as zip_ref:
-                os.mkdir(drain_dir)
-                zip_ref.extractall(drain_dir)
-
-    for catch_dir, drain_dir in zip(catch_dirs, drain_dirs):
-        out_file = os.path.join(out_dir, f'{os.path.basename(catch_dir).split("-")[0]}-upstream-dict.json')
-        # try:
-        if not os.path.exists(out_file):
-            adj.create_adjoint_dict(drain_dir, out_file, "COMID")
-        # except:
-        #     print(f"WARNING: {os.path.basename(out_file)} not written")
-        #     continue
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Runs AdjoinUpdown.create_adjoint_dict on every GEOGloWS region in a '
+                                                 'directory of *drainageline.zip files, in parallel, largest region '
+                                                 'first. Reruns pick up where a failed or interrupted run stopped.')
+    parser.add_argument('parse_dir', type=str, help='Required. Directory containing the delineation zip files.')
+    parser.add_argument('out_dir', type=str, help='Required. Directory to write the regional outputs to.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes. Default: number of CPUs')
+    parser.add_argument('--streamidcol', type=str, default="COMID",
+                        help='Name of Stream ID Column. Default: "COMID"')
+    parser.add_argument('--format', choices=['json', 'jsonl', 'parquet', 'adj'], default='json',
+                        help='Write json dictionaries, json lines, parquet tables or binary .adj indexes. Default: json')
+    parser.add_argument('--force', action='store_true', help='Reprocess regions that are already done.')
+    Instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with Instrumentation.use_instrumentation(Instrumentation.from_args(args)) as instrumentation:
+        manifest = run_regions(args.parse_dir, args.out_dir, args.workers, args.streamidcol, f".{args.format}",
+                               args.force, instrumentation)
+    if instrumentation.enabled:
+        for path, stage in Instrumentation.aggregate(instrumentation.records).items():
+            print(f"{path}: {stage['count']} regions, {stage['wall_s']:.2f}s wall in total, "
+                  f"{stage['max_wall_s']:.2f}s in the slowest region, {stage['rows']} rows")
+    failed = [name for name, entry in manifest.items() if entry["status"] == "failed"]
+    if failed:
+        print(f"Failed regions, rerun to retry: {failed}")
+        sys.exit(1)
@@ -1,61 +1,115 @@
-import json
+import argparse
 import os
-import queue
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
-import geopandas as gpd
-import time
-import contextily as cx
-import matplotlib.pyplot as plt
-start_time = time.time()
-
-parse_dir = '../NGADelineation'
-out_dir = '../NGADelineation/OutputJSONs'
-rivid_field = "streamID"
-next_down_field = 'DSLINKNO'
-catchments = glob(os.path.join(parse_dir, '*/*basins*.gpkg'))
-drainagelines = glob(os.path.join(parse_dir, '*/*streamnet*.shp'))
-
-catch = gpd.read_file(catchments[0])
-drain = gpd.read_file((drainagelines[0]))
-order_col = drain['strmOrder']
-print(drain.columns)
-catch_stream = catch.merge(drain.drop('geometry', axis=1), left_on='streamID', right_on='LINKNO').drop('LINKNO', axis=1)
-catch_stream.to_file(os.path.join(parse_dir, 'Japan_comb/Japan_comb.shp'))
-plot_group = catch_stream
-print(plot_group)
-ax = plot_group.plot(alpha=0.5)
-drain = drain[drain['LINKNO'].isin(plot_group['streamID'])]
-print(drain)
-drain.plot(ax=ax)
-try:
-    cx.add_basemap(ax, zoom=12)
-except:
-    print("Error in getting basemap, area likely too small to get tiles of sufficient resolution")
-
-def get_upstream(tree, search_id):
-    q = queue.Queue()
-    q.put((search_id,)) #how to make this a tuple?
-    upstream = []
-    i = 0
-
-    while not q.empty():
-        n = q.get()
-        if i > 200:
-            break
-        for s in n:
-            upstream.append(s)
-            if s in tree:
-                q.put(tree[s])
-        i += 1
-    return upstream
-
-
-tree = {rivid: tuple(catch_stream[catch_stream[next_down_field] == rivid][rivid_field].tolist()) for
-        rivid in catch_stream[rivid_field]}
-
-upstream_lists_dict = {rivid: get_upstream(tree, rivid) for rivid in catch_stream[rivid_field]}
-out_file = os.path.join(out_dir, f'Japan-nga-upstream-dict.json')
-with open(out_file, "w") as f:
-    json.dump(upstream_lists_dict, f)
-
-print ("time elapsed: {:.2f}s".format(time.time() - start_time))
\ No newline at end of file
+
+import Instrumentation
+from AdjointCatchmentsAllRegions import process_region
+
+
+def find_nga_regions(parse_dir: str) -> list:
+    """
+    Finds the NGA delineation regions in a directory, one sub directory per region holding a TauDEM stream network
+    (*streamnet*.shp) and optionally its catchments (*basins*.gpkg).
+    Args:
+        parse_dir: directory containing the region directories, e.g. NGADelineation
+
+    Returns: list of dictionaries with the region name and the paths to its stream network (as "streamnet" and as the
+             "source" read by process_region) and basins (or None), largest stream network first.
+    """
+    regions = []
+    for streamnet in glob(os.path.join(parse_dir, '*', '*streamnet*.shp')):
+        region_dir = os.path.dirname(streamnet)
+        basins = glob(os.path.join(region_dir, '*basins*.gpkg'))
+        regions.append({"name": os.path.basename(region_dir), "streamnet": streamnet, "source": streamnet,
+                        "basins": basins[0] if basins else None, "size": os.path.getsize(streamnet)})
+    return sorted(regions, key=lambda region: region["size"], reverse=True)
+
+
+def process_nga_region(region: dict, out_file: str, schema: str = "nga", basin_id_col: str = "streamID",
+                       trace_up: bool = True, instrument: dict = None) -> dict:
+    """
+    Traces one NGA region with AdjointCatchmentsAllRegions.process_region, with the same reader, validation, graph
+    builder, writers and atomic output as the GEOGloWS regions. The stream network gives the topology; if the region
+    has basins, only streams with a catchment are kept, as the catchments joined to the stream network were before.
+    Args:
+        region: dictionary from find_nga_regions.
+        out_file: path to the output file, .json, .jsonl, .parquet or .adj
+        schema: NetworkSchema, or the name of one, of the stream network.
+        basin_id_col: the name of the column of the basins holding the stream id of each catchment.
+        trace_up: if true, trace up from each stream, otherwise trace down.
+        instrument: if given, the stages are timed, with these options passed on to Instrumentation.
+
+    Returns: the report of process_region, with the region name, output path, number of segments, wall time in
+             seconds, peak RSS in MB and, if instrumented, the span records of its stages.
+    """
+    return process_region(region, out_file, instrument=instrument, schema=schema, trace_up=trace_up,
+                          basin_id_col=basin_id_col)
+
+
+def run_nga_regions(parse_dir: str, out_dir: str, workers: int = 1, out_ext: str = ".json", trace_up: bool = True,
+                    force: bool = False, instrumentation: Instrumentation.Instrumentation = None) -> list:
+    """
+    Processes every NGA region in a directory, in parallel if workers is more than one. Regions whose output already
+    exists are skipped unless force is true.
+    Args:
+        parse_dir: directory containing the region directories.
+        out_dir: directory to write the <region>-nga-upstream-dict files to.
+        workers: number of worker processes.
+        out_ext: extension, and so format, of the output files.
+        trace_up: if true, trace up from each stream, otherwise trace down.
+        force: if true, reprocesses regions whose output exists.
+        instrumentation: if given and enabled, the span records of every region are passed to its sinks.
+
+    Returns: list of the reports of the processed regions, with "error" set for regions that failed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    instrument = None
+    if instrumentation is not None and instrumentation.enabled:
+        instrument = {"trace_memory": instrumentation.trace_memory}
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        futures = {}
+        for region in find_nga_regions(parse_dir):
+            out_file = os.path.join(out_dir, f'{region["name"]}-nga-upstream-dict{out_ext}')
+            if not force and os.path.exists(out_file):
+                print(f"{region['name']}: File already created")
+                continue
+            futures[pool.submit(process_nga_region, region, out_file, "nga", "streamID", trace_up, instrument)] = \
+                region
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                report = future.result()
+                for record in report.pop("spans", []):
+                    instrumentation.emit(record)
+                print(f"{region['name']}: {report['segments']} segments, {report['wall_time']:.2f}s")
+            except Exception as e:
+                report = {"name": region["name"], "error": repr(e)}
+                print(f"WARNING: {region['name']} failed: {e!r}")
+            reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Traces every NGA delineation region in a directory: each sub '
+                                                 'directory holding a TauDEM *streamnet*.shp, and optionally its '
+                                                 '*basins*.gpkg catchments, gets a <region>-nga-upstream-dict file.')
+    parser.add_argument('parse_dir', type=str, nargs='?', default='../NGADelineation',
+                        help='Directory containing the region directories. Default: "../NGADelineation"')
+    parser.add_argument('out_dir', type=str, nargs='?', default='../NGADelineation/OutputJSONs',
+                        help='Directory to write the outputs to. Default: "../NGADelineation/OutputJSONs"')
+    parser.add_argument('--workers', type=int, default=1, help='Number of regions to process at once. Default: 1')
+    parser.add_argument('--format', choices=['json', 'jsonl', 'parquet', 'adj'], default='json',
+                        help='Write json dictionaries, json lines, parquet tables or binary .adj indexes. Default: json')
+    parser.add_argument('--tracedown', action='store_true', help='Trace downstream instead of upstream.')
+    parser.add_argument('--force', action='store_true', help='Reprocess regions whose output exists.')
+    Instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with Instrumentation.use_instrumentation(Instrumentation.from_args(args)) as instrumentation:
+        reports = run_nga_regions(args.parse_dir, args.out_dir, args.workers, f".{args.format}", not args.tracedown,
+                                  args.force, instrumentation)
+    if any("error" in report for report in reports):
+        sys.exit(1)
@@ -0,0 +1,584 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from RiverNetwork import RiverNetwork
+
+INDEX_EXTENSION = ".adj"
+MAGIC = b"ADJIDX01"
+GLOBAL_MAGIC = b"ADJGLB01"
+ALIGNMENT = 64
+
+
+class AdjointIndex:
+    """
+    Read-only, memory-mapped adjoint catchment index. Behaves like the dictionaries stored in the
+    *-upstream-dict.json files, but opening it only reads a small JSON header, and looking up an id only touches the
+    pages of the arrays that hold that id. The file holds:
+        - ids: sorted int64 table of every id in the index
+        - start, end: int64 offsets per id into order, -1 for ids that only appear as values
+        - order: int32 positions into ids, so the upstream (or downstream) list of ids[i] is
+          ids[order[start[i]:end[i]]]. For indexes written from an UpstreamClosure ("closure" layout) this is a single
+          permutation of the network and the ranges of different ids nest inside each other, for indexes converted
+          from json ("lists" layout) the lists are stored one after another.
+        - next_down (optional): int64 next down id of each id, present when written from a RiverNetwork
+    """
+
+    def __init__(self, path: str, offset: int = 0):
+        """
+        Args:
+            path: path to a .adj file, or to a file containing an index starting at the given byte offset.
+            offset: byte offset of the index inside the file.
+        """
+        self.path = path
+        self.offset = offset
+        self.header = read_header(path, offset)
+        self.layout = self.header["layout"]
+        self.meta = self.header.get("meta", {})
+        self._arrays = {name: _map_array(path, offset, spec) for name, spec in self.header["arrays"].items()}
+        self.ids = self._arrays["ids"]
+        self.start = self._arrays["start"]
+        self.end = self._arrays["end"]
+        self.order = self._arrays["order"]
+        self.next_down = self._arrays.get("next_down")
+
+    def __len__(self):
+        return self.header["count"]
+
+    def __contains__(self, key):
+        return self.position(key) != -1
+
+    def __getitem__(self, key) -> np.ndarray:
+        pos = self.position(key)
+        if pos == -1:
+            raise KeyError(key)
+        return self.ids[self.order[self.start[pos]:self.end[pos]]]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def position(self, key) -> int:
+        """
+        Returns: position of an id (given as an int or a string) in the sorted id table, or -1 if it has no entry.
+        """
+        key = int(key)
+        pos = int(np.searchsorted(self.ids, key))
+        if pos == len(self.ids) or self.ids[pos] != key or self.start[pos] == -1:
+            return -1
+        return pos
+
+    def upstream(self, key) -> np.ndarray:
+        """
+        Returns: array of the ids stored for the given id, the same values as the json lists.
+        """
+        return self[key]
+
+    def get(self, key, default=None):
+        pos = self.position(key)
+        if pos == -1:
+            return default
+        return self.ids[self.order[self.start[pos]:self.end[pos]]]
+
+    def downstream(self, key) -> np.ndarray:
+        """
+        Follows the stored next down ids from an id to its outlet. Needs an index written from a RiverNetwork.
+
+        Returns: array of the id and every id downstream of it.
+        """
+        if self.next_down is None:
+            raise ValueError(f"{self.path} has no next down ids, write it from a RiverNetwork to trace downstream")
+        if self.position(key) == -1:
+            raise KeyError(key)
+        path = [int(key)]
+        seen = set(path)
+        while True:
+            pos = int(np.searchsorted(self.ids, path[-1]))
+            nxt = int(self.next_down[pos])
+            if nxt in seen or self.position(nxt) == -1:
+                return np.array(path, dtype=self.ids.dtype)
+            path.append(nxt)
+            seen.add(nxt)
+
+    def keys(self) -> np.ndarray:
+        """
+        Returns: array of every id that has an entry in the index.
+        """
+        return self.ids[self.start != -1]
+
+    def items(self):
+        for pos in np.flatnonzero(self.start != -1):
+            yield int(self.ids[pos]), self.ids[self.order[self.start[pos]:self.end[pos]]]
+
+    def to_dict(self) -> dict:
+        """
+        Returns: dictionary in the *-upstream-dict.json format, string ids paired with lists of ids.
+        """
+        return {str(key): values.tolist() for key, values in self.items()}
+
+
+class GlobalAdjointIndex:
+    """
+    Read-only index of every region merged by merge_regions, used like the old all-regions-upstream_dict.json
+    dictionary. The file holds a sorted table of every id with the region it belongs to, a region-to-offset table, and
+    each region's index stored whole after that. Looking up an id searches the id table and then opens only that
+    region's index, so only that region's bytes are read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = read_header(path, 0, GLOBAL_MAGIC)
+        self.regions = self.header["regions"]
+        self.ids = _map_array(path, 0, self.header["arrays"]["ids"])
+        self.region_codes = _map_array(path, 0, self.header["arrays"]["region"])
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return self._code(key) != -1
+
+    def __getitem__(self, key) -> np.ndarray:
+        code = self._code(key)
+        if code == -1:
+            raise KeyError(key)
+        return self.region_index(code)[key]
+
+    def get(self, key, default=None):
+        code = self._code(key)
+        if code == -1:
+            return default
+        return self.region_index(code)[key]
+
+    def upstream(self, key) -> np.ndarray:
+        return self[key]
+
+    def downstream(self, key) -> np.ndarray:
+        code = self._code(key)
+        if code == -1:
+            raise KeyError(key)
+        return self.region_index(code).downstream(key)
+
+    def region_of(self, key) -> str:
+        """
+        Returns: name of the region an id belongs to, or None if it is in no region.
+        """
+        code = self._code(key)
+        return None if code == -1 else self.regions[code]["name"]
+
+    def region_index(self, region) -> AdjointIndex:
+        """
+        Args:
+            region: region name or position in the region table.
+
+        Returns: AdjointIndex of one region, opened on first use.
+        """
+        code = region if isinstance(region, (int, np.integer)) else \
+            [entry["name"] for entry in self.regions].index(region)
+        if code not in self._indexes:
+            self._indexes[code] = AdjointIndex(self.path, self.regions[code]["offset"])
+        return self._indexes[code]
+
+    def _code(self, key) -> int:
+        key = int(key)
+        pos = int(np.searchsorted(self.ids, key))
+        if pos == len(self.ids) or self.ids[pos] != key:
+            return -1
+        return int(self.region_codes[pos])
+
+
+def merge_regions(region_files: list, out_path: str, max_reported_collisions: int = 1000) -> dict:
+    """
+    Merges regional results into one GlobalAdjointIndex file without loading them all into memory. Regions are
+    handled one at a time: json files are converted to indexes with the streaming reader, and each regional index is
+    copied into the global file as it is, so only the id tables of all regions are ever held in memory together. Ids
+    found in more than one region are reported, and looked up in the first region listed.
+    Args:
+        region_files: paths to the regional *-upstream-dict.json or .adj files. The region name is the part of the
+                      file name before the first "-".
+        out_path: path to the output file.
+        max_reported_collisions: number of colliding ids to list in the file header, all are returned.
+
+    Returns: dictionary with the region table and a list of (id, [region names]) for every colliding id.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_path))) as tmp_dir:
+        regions, index_paths, ids, codes = [], [], [], []
+        for code, region_file in enumerate(region_files):
+            name = os.path.basename(region_file).split("-")[0]
+            index_path = region_file
+            if not region_file.endswith(INDEX_EXTENSION):
+                index_path = json_to_index(region_file, os.path.join(tmp_dir, f"{code}{INDEX_EXTENSION}"),
+                                           meta={"region": name})
+            keys = np.array(AdjointIndex(index_path).keys())
+            regions.append({"name": name, "count": len(keys), "size": os.path.getsize(index_path)})
+            index_paths.append(index_path)
+            ids.append(keys)
+            codes.append(np.full(len(keys), code, dtype=np.int16))
+
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int16)
+        sorter = np.argsort(ids, kind="stable")
+        ids, codes = ids[sorter], codes[sorter]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        repeated = np.flatnonzero(~first)
+        collisions = {}
+        for pos in repeated:
+            collisions.setdefault(int(ids[pos]), [regions[codes[pos - 1]]["name"]]).append(regions[codes[pos]]["name"])
+        collisions = list(collisions.items())
+
+        arrays = {"ids": ids[first].astype("<i8"), "region": codes[first].astype("<i2")}
+        header = {"version": 1, "regions": regions, "collision_count": len(collisions),
+                  "collisions": collisions[:max_reported_collisions]}
+        encoded, size = _plan_layout(GLOBAL_MAGIC, header, arrays, [region["size"] for region in regions])
+        tmp_path = f"{out_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            _write_layout(f, GLOBAL_MAGIC, encoded, header, arrays, size)
+            for region, index_path in zip(regions, index_paths):
+                f.seek(region["offset"])
+                with open(index_path, "rb") as src:
+                    shutil.copyfileobj(src, f)
+        os.replace(tmp_path, out_path)
+    if collisions:
+        print(f"WARNING: {len(collisions)} ids found in more than one region")
+    return {"regions": regions, "collisions": collisions}
+
+
+def open_index(path: str):
+    """
+    Returns: GlobalAdjointIndex for a file written by merge_regions, AdjointIndex for a regional index.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(GLOBAL_MAGIC))
+    return GlobalAdjointIndex(path) if magic == GLOBAL_MAGIC else AdjointIndex(path)
+
+
+def read_header(path: str, offset: int = 0, magic: bytes = MAGIC) -> dict:
+    """
+    Reads only the JSON header of an index.
+    Args:
+        path: path to the file containing the index.
+        offset: byte offset of the index inside the file.
+        magic: the bytes the file starts with, MAGIC for regional indexes or GLOBAL_MAGIC for merged ones.
+
+    Returns: header dictionary with the layout, count, meta and the dtype, shape and offset of every array.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not an adjoint catchment index")
+        header_len = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        return json.loads(f.read(header_len).decode("utf-8"))
+
+
+def write_index(path: str, ids: np.ndarray, start: np.ndarray, end: np.ndarray, order: np.ndarray,
+                next_down: np.ndarray = None, layout: str = "lists", meta: dict = None) -> str:
+    """
+    Writes an index file. The file is written next to its destination and moved into place once complete, so readers
+    never see a partially written index.
+    Args:
+        path: path to the output file, conventionally ending in .adj
+        ids: sorted array of unique ids.
+        start: offsets into order where each id's list starts, -1 for ids without an entry.
+        end: offsets into order where each id's list ends.
+        order: positions into ids making up the lists.
+        next_down: optional next down id for each id.
+        layout: "closure" if the lists are nested slices of one permutation, otherwise "lists".
+        meta: optional dictionary of extra information to store in the header, e.g. the region name.
+
+    Returns: the path written to.
+    """
+    arrays = {"ids": np.asarray(ids, dtype="<i8"), "start": np.asarray(start, dtype="<i8"),
+              "end": np.asarray(end, dtype="<i8"), "order": np.asarray(order, dtype="<i4")}
+    if next_down is not None:
+        arrays["next_down"] = np.asarray(next_down, dtype="<i8")
+    header = {"version": 1, "layout": layout, "count": int((arrays["start"] != -1).sum()), "meta": meta or {}}
+    encoded, size = _plan_layout(MAGIC, header, arrays)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        _write_layout(f, MAGIC, encoded, header, arrays, size)
+    os.replace(tmp_path, path)
+    return path
+
+
+def closure_to_index(closure, path: str, meta: dict = None) -> str:
+    """
+    Writes the upstream sets of an UpstreamClosure to an index, storing each set as a slice of the closure's
+    permutation rather than a separate list.
+    Args:
+        closure: RiverNetwork.UpstreamClosure to store.
+        path: path to the output file.
+        meta: optional dictionary of extra information to store in the header.
+
+    Returns: the path written to.
+    """
+    network = closure.network
+    ids = network.ids.astype(np.int64)
+    sorter = np.argsort(ids, kind="stable")
+    rank = np.empty(len(ids), dtype=np.int32)
+    rank[sorter] = np.arange(len(ids), dtype=np.int32)
+    return write_index(path, ids[sorter], closure.start[sorter], closure.end[sorter], rank[closure.order],
+                       next_down=network.next_down_ids.astype(np.int64)[sorter], layout="closure", meta=meta)
+
+
+def dict_to_index(lists_dict: dict, path: str, meta: dict = None, compact: bool = True) -> str:
+    """
+    Writes a dictionary in the *-upstream-dict.json format to an index.
+    Args:
+        lists_dict: dictionary of ids (as strings or ints) paired with lists of ids.
+        path: path to the output file.
+        meta: optional dictionary of extra information to store in the header.
+        compact: if true and the lists are exactly the upstream sets of some river network, that network is rebuilt
+                 from them and stored in the "closure" layout, which takes O(n) rather than O(n * depth) space. The
+                 lists come back in depth first order in that case. Lists that are truncated or otherwise not a
+                 network's upstream sets are stored as they are.
+
+    Returns: the path written to.
+    """
+    keys, lengths, values = _flatten_lists(lists_dict.items())
+    return _lists_to_index(keys, lengths, values, path, meta, compact)
+
+
+def _lists_to_index(keys: np.ndarray, lengths: np.ndarray, values: np.ndarray, path: str, meta: dict = None,
+                    compact: bool = True) -> str:
+    if compact:
+        closure = _closure_from_lists(keys, lengths, values)
+        if closure is not None:
+            return closure_to_index(closure, path, meta)
+    ids = np.unique(np.concatenate((keys, values)))
+    key_pos = np.searchsorted(ids, keys)
+    start = np.full(len(ids), -1, dtype=np.int64)
+    end = np.full(len(ids), -1, dtype=np.int64)
+    start[key_pos] = np.cumsum(lengths) - lengths
+    end[key_pos] = np.cumsum(lengths)
+    return write_index(path, ids, start, end, np.searchsorted(ids, values), layout="lists", meta=meta)
+
+
+def json_to_index(json_path: str, index_path: str = None, meta: dict = None, compact: bool = True) -> str:
+    """
+    Converts an existing *-upstream-dict.json file to an index. The json is read incrementally with
+    iter_json_items and the lists are packed straight into integer arrays, so the whole dictionary is never held in
+    memory as Python objects.
+    Args:
+        json_path: path to the json file.
+        index_path: path to the output file, defaults to the json path with the .adj extension.
+        meta: optional dictionary of extra information to store in the header.
+        compact: store the lists in the "closure" layout when possible, see dict_to_index.
+
+    Returns: the path written to.
+    """
+    if index_path is None:
+        index_path = os.path.splitext(json_path)[0] + INDEX_EXTENSION
+    keys, lengths, values = json_to_arrays(json_path)
+    return _lists_to_index(keys, lengths, values, index_path, meta, compact)
+
+
+def index_to_json(index_path: str, json_path: str = None) -> str:
+    """
+    Converts an index back to the *-upstream-dict.json format, for consumers that read the json files.
+    Args:
+        index_path: path to the index file.
+        json_path: path to the output file, defaults to the index path with the .json extension.
+
+    Returns: the path written to.
+    """
+    if json_path is None:
+        json_path = os.path.splitext(index_path)[0] + ".json"
+    with open(json_path, "w") as f:
+        f.write("{")
+        for i, (key, values) in enumerate(AdjointIndex(index_path).items()):
+            f.write(f'{", " if i else ""}"{key}": [{", ".join(map(str, values.tolist()))}]')
+        f.write("}")
+    return json_path
+
+
+def json_to_arrays(json_path: str):
+    """
+    Reads a *-upstream-dict.json file incrementally into integer arrays.
+
+    Returns: tuple of arrays of the keys, the length of each list, and all the lists one after another.
+    """
+    return _flatten_lists(iter_json_items(json_path))
+
+
+def network_from_lists(keys: np.ndarray, lengths: np.ndarray, values: np.ndarray) -> RiverNetwork:
+    """
+    Rebuilds the network behind a set of flattened upstream lists (see json_to_arrays), taking the next down segment
+    of each id to be the smallest other list that contains it. Ids that only appear as values are left out. The lists
+    are not checked, so truncated lists give an approximation of the network.
+    Args:
+        keys: array of the ids that have a list.
+        lengths: array of the length of each list.
+        values: all the lists one after another.
+
+    Returns: RiverNetwork of the keys.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    owners = np.repeat(keys, lengths)
+    owner_lengths = np.repeat(lengths, lengths)
+    others = (owners != values) & np.isin(values, keys)
+    pairs = np.lexsort((owner_lengths[others], values[others]))
+    member, owner = values[others][pairs], owners[others][pairs]
+    first = np.ones(len(member), dtype=bool)
+    first[1:] = member[1:] != member[:-1]
+    sorted_keys = np.unique(keys)
+    next_down = np.full(len(sorted_keys), -1, dtype=np.int64)
+    next_down[np.searchsorted(sorted_keys, member[first])] = owner[first]
+    return RiverNetwork(sorted_keys, next_down)
+
+
+def iter_json_items(path: str, chunk_size: int = 1 << 20):
+    """
+    Reads the items of a json file holding one object, such as an *-upstream-dict.json file, a chunk at a time, so the
+    file is never loaded into memory whole.
+    Args:
+        path: path to the json file.
+        chunk_size: number of characters read from the file at a time.
+
+    Returns: generator of (key, value) pairs in file order.
+    """
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip_to_token():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return buffer[pos] if pos < len(buffer) else ""
+                fill()
+
+        def decode():
+            nonlocal pos
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # a number at the very end of the buffer may continue in the next chunk
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        if skip_to_token() != "{":
+            raise ValueError(f"{path} does not contain a json object")
+        pos += 1
+        if skip_to_token() == "}":
+            return
+        while True:
+            skip_to_token()
+            key = decode()
+            if skip_to_token() != ":":
+                raise ValueError(f"Expected ':' after key {key!r} in {path}")
+            pos += 1
+            skip_to_token()
+            yield key, decode()
+            token = skip_to_token()
+            pos += 1
+            if token == "}":
+                return
+            if token != ",":
+                raise ValueError(f"Expected ',' or '}}' after the value of {key!r} in {path}")
+
+
+def _flatten_lists(items, chunk_len: int = 1 << 20):
+    """
+    Packs (key, list) pairs into arrays of keys, list lengths and the concatenated lists, a chunk of values at a time.
+    """
+    keys, lengths, chunks, chunk = [], [], [], []
+    for key, values in items:
+        keys.append(int(key))
+        lengths.append(len(values))
+        chunk.extend(values)
+        if len(chunk) >= chunk_len:
+            chunks.append(np.array(chunk, dtype=np.int64))
+            chunk = []
+    chunks.append(np.array(chunk, dtype=np.int64))
+    return np.array(keys, dtype=np.int64), np.array(lengths, dtype=np.int64), np.concatenate(chunks)
+
+
+def _closure_from_lists(keys: np.ndarray, lengths: np.ndarray, values: np.ndarray):
+    """
+    Rebuilds the network behind a set of upstream lists, taking the next down segment of each id to be the smallest
+    other list that contains it, and checks that the network's upstream sets match the lists exactly.
+
+    Returns: UpstreamClosure of the rebuilt network, or None if the lists are not the upstream sets of a network.
+    """
+    if len(np.unique(keys)) != len(keys) or not np.isin(values, keys).all():
+        return None
+    try:
+        closure = network_from_lists(keys, lengths, values).upstream_closure()
+    except ValueError:
+        return None
+    owners = np.repeat(keys, lengths)
+    owner_lengths = np.repeat(lengths, lengths)
+    network = closure.network
+    owner_index = network.index_of(owners)
+    member_pos = closure.start[network.index_of(values)]
+    if not np.array_equal(closure.end[owner_index] - closure.start[owner_index], owner_lengths):
+        return None
+    inside = (member_pos >= closure.start[owner_index]) & (member_pos < closure.end[owner_index])
+    if not inside.all():
+        return None
+    return closure
+
+
+def _plan_layout(magic: bytes, header: dict, arrays: dict, blob_sizes: list = ()):
+    """
+    Places the arrays, and any blobs (whole regional indexes) after them, at aligned offsets behind the header. The
+    offsets depend on the length of the header that records them, so the header size is grown until they fit.
+    Offsets are written into header["arrays"] and header["regions"].
+
+    Returns: tuple of the encoded header and the total file size.
+    """
+    header["arrays"] = {}
+    header_size = ALIGNMENT
+    while True:
+        pos = header_size
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": pos}
+            pos = _align(pos + array.nbytes)
+        for region, blob_size in zip(header.get("regions", []), blob_sizes):
+            region["offset"] = pos
+            pos = _align(pos + blob_size)
+        encoded = json.dumps(header).encode("utf-8")
+        if len(magic) + 8 + len(encoded) <= header_size:
+            return encoded, pos
+        header_size = _align(len(magic) + 8 + len(encoded))
+
+
+def _write_layout(f, magic: bytes, encoded: bytes, header: dict, arrays: dict, size: int):
+    f.write(magic)
+    f.write(np.array([len(encoded)], dtype="<u8").tobytes())
+    f.write(encoded)
+    for name, array in arrays.items():
+        f.seek(header["arrays"][name]["offset"])
+        f.write(array.tobytes())
+    f.truncate(size)
+
+
+def _map_array(path: str, base_offset: int, spec: dict) -> np.ndarray:
+    shape = tuple(spec["shape"])
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=spec["dtype"])
+    return np.memmap(path, dtype=spec["dtype"], mode="r", offset=base_offset + spec["offset"], shape=shape)
+
+
+def _align(pos: int) -> int:
+    return -(-pos // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+import AdjoinUpdown as adj
+from AdjoinStatsUpstream import AGG_FUNCS, aggregate_lists, join_stats_upstream
+from AdjointIndex import closure_to_index, json_to_arrays, network_from_lists
+from NetworkQueries import DownstreamQueries
+from RiverNetwork import RiverNetwork
+
+IMPLEMENTATIONS = ("legacy", "dict", "view", "closure")
+# largest network each implementation is run on by default, the per-id tracing ones grow with n * depth
+DEFAULT_MAX_SEGMENTS = {"legacy": 5000, "dict": 100000, "view": 100000, "closure": None}
+# modules the command line tools should not pay for unless they read geospatial files, and how long importing
+# AdjoinUpdown may take in a fresh interpreter, NumPy included
+HEAVY_MODULES = ("geopandas", "pandas", "shapely", "pyogrio", "matplotlib", "contextily")
+IMPORT_BUDGET_S = 0.25
+
+
+def synthetic_network(n: int, branching: int = 2, mainstem: int = 1, seed: int = 0) -> pd.DataFrame:
+    """
+    Makes a random river network of a controlled shape: a mainstem of the given length with a tributary tree hanging
+    off each of its segments, where every tributary segment has up to `branching` parents, so the deepest path is
+    about mainstem + log(n) / log(branching) segments long. Ids are shuffled so that row order carries no topology.
+    Args:
+        n: number of segments.
+        branching: number of parents of each tributary segment that is not a headwater.
+        mainstem: number of segments in the mainstem, from 1 (a bushy basin) up to n (a single chain).
+        seed: random seed.
+
+    Returns: dataframe with HydroID, NextDownID and order_ columns, in the GEOGloWS catchment format.
+    """
+    rng = np.random.default_rng(seed)
+    mainstem = int(min(max(mainstem, 1), n))
+    down = np.full(n, -1, dtype=np.int64)
+    down[1:mainstem] = np.arange(mainstem - 1)
+    tail = np.arange(n - mainstem)
+    tail_down = np.where(tail < mainstem, tail, mainstem + (tail - mainstem) // max(branching, 1))
+    down[mainstem:] = tail_down
+    ids = rng.permutation(n).astype(np.int64) + 1
+    next_down = np.where(down == -1, -1, ids[np.maximum(down, 0)])
+    rows = rng.permutation(n)
+    network = RiverNetwork(ids[rows], next_down[rows])
+    return pd.DataFrame({"HydroID": ids[rows], "NextDownID": next_down[rows], "order_": network.strahler_order()})
+
+
+def regional_network(json_path: str) -> pd.DataFrame:
+    """
+    Rebuilds a network from a bundled *-upstream-dict.json file, see AdjointIndex.network_from_lists. The bundled
+    lists were cut off by the old iteration limit, so the rebuilt network is only approximately the original one.
+
+    Returns: dataframe with HydroID, NextDownID and order_ columns.
+    """
+    network = network_from_lists(*json_to_arrays(json_path))
+    return pd.DataFrame({"HydroID": network.ids, "NextDownID": network.next_down_ids,
+                         "order_": network.strahler_order()})
+
+
+def benchmark_network(name: str, df: pd.DataFrame, out_dir: str, implementations=IMPLEMENTATIONS,
+                      max_segments: dict = None, json_max_segments: int = 100000, memory: bool = True,
+                      reference: dict = None) -> list:
+    """
+    Times every stage of every implementation on one network: ingest (reading the table back from disk), tree build,
+    tracing every id, and writing the results. Implementations:
+        - legacy: make_tree, trace_tree on the dict for every id, json.dump
+        - dict: make_tree_up converted to a plain dict, trace_tree on the dict for every id, json.dump
+        - view: make_tree_up view, trace_tree on the view for every id, json.dump
+        - closure: RiverNetwork, UpstreamClosure, json.dump of closure.to_dict() and closure_to_index
+    The upstream lists of each implementation are compared as sets with those of the closure, and with the reference
+    lists if any are given.
+    Args:
+        name: name of the network for the results.
+        df: network in the GEOGloWS catchment format, e.g. from synthetic_network.
+        out_dir: directory for the files written while benchmarking.
+        implementations: names of the implementations to run.
+        max_segments: dictionary of the largest network to run each implementation on, None for no limit.
+        json_max_segments: largest network to build and write json dictionaries for.
+        memory: if true, the peak memory of each stage is measured with tracemalloc, which slows every stage down.
+        reference: optional dictionary of reference upstream lists, e.g. a bundled json.
+
+    Returns: list of result records, one per implementation and stage.
+    """
+    max_segments = {**DEFAULT_MAX_SEGMENTS, **(max_segments or {})}
+    os.makedirs(out_dir, exist_ok=True)
+    table_path = os.path.join(out_dir, f"{name}.parquet")
+    try:
+        df.to_parquet(table_path)
+        read_table = pd.read_parquet
+    except ImportError:
+        table_path = os.path.join(out_dir, f"{name}.csv")
+        df.to_csv(table_path, index=False)
+        read_table = pd.read_csv
+
+    n = len(df)
+    base = {"network": name, "segments": n}
+    records = []
+    closure_lists = None
+    for implementation in sorted(implementations, key=lambda impl: impl != "closure"):
+        limit = max_segments.get(implementation)
+        if limit is not None and n > limit:
+            records.append({**base, "implementation": implementation, "stage": "skipped",
+                            "reason": f"more than {limit} segments"})
+            continue
+        record = dict(base, implementation=implementation)
+        table, stage = _measure(lambda: read_table(table_path), memory)
+        records.append({**record, "stage": "ingest", **stage})
+
+        make_json = n <= json_max_segments
+        if implementation == "closure":
+            network, stage = _measure(lambda: RiverNetwork.from_dataframe(table, "HydroID", "NextDownID"), memory)
+            records.append({**record, "stage": "tree_build", **stage})
+            records.append({**record, "stage": "check_distance", **check_distances(network)})
+            closure, stage = _measure(network.upstream_closure, memory)
+            records.append({**record, "stage": "trace", **stage})
+            index_path = os.path.join(out_dir, f"{name}-{implementation}.adj")
+            _, stage = _measure(lambda: closure_to_index(closure, index_path), memory)
+            records.append({**record, "stage": "index_write", "bytes": os.path.getsize(index_path), **stage})
+            if not make_json:
+                continue
+            lists, stage = _measure(closure.to_dict, memory)
+            records.append({**record, "stage": "to_dict", **stage})
+            closure_lists = lists
+            records.append({**record, "stage": "check_stats", **check_stats(lists)})
+        else:
+            if implementation == "legacy":
+                build = lambda: adj.make_tree(table)
+            elif implementation == "dict":
+                build = lambda: dict(adj.make_tree_up(table, 0, "HydroID", "NextDownID"))
+            else:
+                build = lambda: adj.make_tree_up(table, 0, "HydroID", "NextDownID")
+            tree, stage = _measure(build, memory)
+            records.append({**record, "stage": "tree_build", **stage})
+            lists, stage = _measure(lambda: {str(i): adj.trace_tree(tree, i) for i in table["HydroID"]}, memory)
+            records.append({**record, "stage": "trace", **stage})
+
+        if make_json:
+            json_path = os.path.join(out_dir, f"{name}-{implementation}.json")
+            _, stage = _measure(lambda: _dump_json(lists, json_path), memory)
+            records.append({**record, "stage": "json_write", "bytes": os.path.getsize(json_path), **stage})
+            if closure_lists is not None and implementation != "closure":
+                records.append({**record, "stage": "check", **_compare(lists, closure_lists)})
+            if reference is not None:
+                records.append({**record, "stage": "check_reference", **_compare(lists, reference)})
+    return records
+
+
+def import_time(module: str = "AdjoinUpdown", repeat: int = 5, budget: float = IMPORT_BUDGET_S) -> dict:
+    """
+    Measures the start-up cost every short command line job pays: the time to import a module in a fresh
+    interpreter, taken from python -X importtime as the best of repeat runs, and which HEAVY_MODULES it pulls in.
+
+    Returns: benchmark record with the seconds, the heavy modules imported, the budget and whether the import stayed
+             within it without importing any heavy module.
+    """
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    best, heavy = None, []
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        for line in run.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                seconds = int(fields[1]) / 1e6
+                best = seconds if best is None else min(best, seconds)
+        heavy = [name for name in run.stdout.strip().split(",") if name]
+    return {"network": "startup", "implementation": module, "stage": "import", "seconds": best,
+            "heavy_modules": heavy, "budget_s": budget, "within_budget": best <= budget and not heavy}
+
+
+def check_stats(lists: dict, max_lists: int = 1000, seed: int = 0) -> dict:
+    """
+    Checks the NumPy-only aggregate_lists against join_stats_upstream for every function in AGG_FUNCS, on up to
+    max_lists of the upstream lists and an added empty list, with random attributes of which some are NaN or missing.
+    The empty list must give 0 for count and NaN for every other function.
+
+    Returns: whether every function agrees, and the functions that do not.
+    """
+    rng = np.random.default_rng(seed)
+    lists = {**dict(list(lists.items())[:max_lists]), "empty": []}
+    ids = np.unique(np.concatenate([np.asarray(values, dtype=np.int64) for values in lists.values()]))
+    ids = ids[rng.random(len(ids)) < 0.9]
+    values = rng.random((len(ids), 2))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    stats_df = pd.DataFrame({"HydroID": ids, "a": values[:, 0], "b": values[:, 1]})
+    mismatched = []
+    for agg_func in AGG_FUNCS:
+        result = aggregate_lists(lists, list(lists), ids, values, agg_func)
+        expected = join_stats_upstream(lists, stats_df, ["a", "b"], agg_func, "HydroID").to_numpy(dtype=float)
+        empty_ok = (result[-1] == 0).all() if agg_func == "count" else np.isnan(result[-1]).all()
+        if not empty_ok or not np.allclose(result, expected, equal_nan=True):
+            mismatched.append(agg_func)
+    return {"equivalent": not mismatched, "mismatched": len(mismatched), "mismatched_examples": mismatched}
+
+
+def check_distances(network: RiverNetwork, pairs: int = 1000, seed: int = 0) -> dict:
+    """
+    Checks DownstreamQueries.distance against walking the paths to the outlet one segment at a time, with random
+    lengths, on random pairs and on pairs of tributaries that join the same segment, whose distance is 0.
+
+    Returns: whether every distance agrees, and some of the pairs that do not.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.random(len(network)) * 10
+    has_down = np.flatnonzero(network.down >= 0)
+    by_down = has_down[np.argsort(network.down[has_down], kind="stable")]
+    siblings = np.flatnonzero(network.down[by_down][1:] == network.down[by_down][:-1])
+    a = np.concatenate([rng.integers(0, len(network), pairs), by_down[siblings[:pairs]]])
+    b = np.concatenate([rng.integers(0, len(network), pairs), by_down[siblings[:pairs] + 1]])
+    result = DownstreamQueries(network, lengths).distance(network.ids[a], network.ids[b])
+    mismatched = []
+    for i, j, distance in zip(a.tolist(), b.tolist(), result.tolist()):
+        # distance from the downstream end of i to the downstream end of every segment below it
+        below, current, total = {i: 0.0}, i, 0.0
+        while network.down[current] >= 0:
+            current = int(network.down[current])
+            total += lengths[current]
+            below[current] = total
+        current, total = j, 0.0
+        while current not in below and network.down[current] >= 0:
+            current = int(network.down[current])
+            total += lengths[current]
+        if current not in below:
+            expected = np.nan
+        elif current in (i, j):
+            expected = below[current] + total
+        else:
+            expected = below[current] + total - 2 * lengths[current]
+        if not np.isclose(distance, expected, equal_nan=True):
+            mismatched.append((int(network.ids[i]), int(network.ids[j])))
+    return {"equivalent": not mismatched, "mismatched": len(mismatched), "mismatched_examples": mismatched[:5]}
+
+
+def _measure(func, memory: bool):
+    """
+    Returns: tuple of the result of func() and a dictionary of its wall time, CPU time and peak traced memory.
+    """
+    if memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func()
+    stage = {"seconds": time.perf_counter() - wall, "cpu_seconds": time.process_time() - cpu}
+    if memory:
+        stage["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result, stage
+
+
+def _dump_json(lists: dict, json_path: str):
+    with open(json_path, "w") as f:
+        json.dump(lists, f, cls=adj.NpEncoder)
+
+
+def _compare(lists: dict, expected: dict) -> dict:
+    """
+    Returns: counts of the keys whose lists hold the same ids as the expected lists, whose lists differ, and that are
+             missing from either side.
+    """
+    common = lists.keys() & expected.keys()
+    mismatched = [key for key in common if set(map(int, lists[key])) != set(map(int, expected[key]))]
+    return {"equivalent": not mismatched and len(common) == len(lists) == len(expected),
+            "matching": len(common) - len(mismatched), "mismatched": len(mismatched),
+            "missing": len(expected.keys() - lists.keys()), "extra": len(lists.keys() - expected.keys()),
+            "mismatched_examples": mismatched[:5]}
+
+
+def _environment() -> dict:
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "system": platform.system(),
+            "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks building trees, tracing and writing results for every '
+                                                 'implementation on synthetic networks of growing size and on the '
+                                                 'bundled regional jsons, and writes the timings, peak memory and '
+                                                 'equivalence checks to a json file.')
+    parser.add_argument('--sizes', type=str, default="1e3,1e4,1e5,1e6,1e7",
+                        help='Comma separated numbers of segments of the synthetic networks. '
+                             'Default: "1e3,1e4,1e5,1e6,1e7"')
+    parser.add_argument('--branching', type=int, default=2,
+                        help='Parents per tributary segment of the synthetic networks. Default: 2')
+    parser.add_argument('--mainstem', type=str, default="1,1000",
+                        help='Comma separated mainstem lengths to benchmark each size with. Default: "1,1000"')
+    parser.add_argument('--regionsdir', type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                             "RegionalAdjointCatchmentJSONs"),
+                        help='Directory of *-upstream-dict.json files to benchmark on, "" to skip them.')
+    parser.add_argument('--implementations', type=str, default=",".join(IMPLEMENTATIONS),
+                        help=f'Comma separated implementations to run. Default: "{",".join(IMPLEMENTATIONS)}"')
+    parser.add_argument('--jsonmax', type=float, default=1e5,
+                        help='Largest network to write json dictionaries for. Default: 1e5')
+    parser.add_argument('--nomemory', action='store_true', help='Skip the tracemalloc memory measurements.')
+    parser.add_argument('--workdir', type=str, default="benchmark_files",
+                        help='Directory for the files written while benchmarking. Default: "benchmark_files"')
+    parser.add_argument('--outfile', type=str, default="benchmark_results.json",
+                        help='Path to write the results to. Default: "benchmark_results.json"')
+    parser.add_argument('--importbudget', type=float, default=IMPORT_BUDGET_S,
+                        help=f'Seconds importing AdjoinUpdown may take. Default: {IMPORT_BUDGET_S}')
+    parser.add_argument('--importonly', action='store_true',
+                        help='Only check the import time budget, exiting with 1 if it is exceeded.')
+    args = parser.parse_args()
+
+    startup = import_time(budget=args.importbudget)
+    print(f"importing {startup['implementation']} took {startup['seconds']:.3f}s of {startup['budget_s']}s"
+          + (f", importing {startup['heavy_modules']}" if startup['heavy_modules'] else ""))
+    if args.importonly:
+        sys.exit(0 if startup["within_budget"] else 1)
+
+    implementations = [impl for impl in args.implementations.split(",") if impl]
+    unknown = set(implementations) - set(IMPLEMENTATIONS)
+    if unknown:
+        raise ValueError(f"Unknown implementations {sorted(unknown)}, use any of {IMPLEMENTATIONS}")
+    results = [startup]
+    for size in [int(float(size)) for size in args.sizes.split(",") if size]:
+        for mainstem in [int(float(m)) for m in args.mainstem.split(",") if m]:
+            name = f"synthetic-n{size}-b{args.branching}-m{mainstem}"
+            print(name)
+            df = synthetic_network(size, args.branching, mainstem)
+            results.extend(benchmark_network(name, df, args.workdir, implementations,
+                                             json_max_segments=int(args.jsonmax), memory=not args.nomemory))
+    if args.regionsdir:
+        for json_path in sorted(glob(os.path.join(args.regionsdir, "*-upstream-dict.json"))):
+            name = os.path.basename(json_path).replace("-upstream-dict.json", "")
+            print(name)
+            with open(json_path) as f:
+                try:
+                    reference = json.load(f)
+                except json.JSONDecodeError:
+                    reference = None
+            results.extend(benchmark_network(name, regional_network(json_path), args.workdir, implementations,
+                                             json_max_segments=int(args.jsonmax), memory=not args.nomemory,
+                                             reference=reference))
+
+    with open(args.outfile, "w") as f:
+        json.dump({"environment": _environment(), "results": results}, f, indent=1)
+    for record in results:
+        if "seconds" in record:
+            print(f"{record['network']:<32} {record['implementation']:<8} {record['stage']:<12} "
+                  f"{record['seconds']:10.4f}s" + (f" {record['peak_mb']:10.1f}MB" if "peak_mb" in record else ""))
+        elif record["stage"] in ("check", "check_reference"):
+            print(f"{record['network']:<32} {record['implementation']:<8} {record['stage']:<16} "
+                  f"equivalent: {record['equivalent']}, {record['mismatched']} mismatched lists")
+        elif record["stage"] == "check_distance":
+            print(f"{record['network']:<32} {record['implementation']:<8} {record['stage']:<16} "
+                  f"equivalent: {record['equivalent']}, {record['mismatched']} mismatched pairs")
+        elif record["stage"] == "check_stats":
+            print(f"{record['network']:<32} {record['implementation']:<8} {record['stage']:<16} "
+                  f"equivalent: {record['equivalent']}, mismatched functions: {record['mismatched_examples']}")
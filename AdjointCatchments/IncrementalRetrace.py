@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+
+from AdjointIndex import read_header, write_index
+
+
+def diff_networks(old_df: pd.DataFrame, new_df: pd.DataFrame, stream_id_col: str = "COMID",
+                  next_down_id_col: str = "NextDownID", outlet_id: int = -1) -> dict:
+    """
+    Compares two versions of a stream network table, e.g. before and after an edit of the catchments.
+    Args:
+        old_df: dataframe of the network the stored index was built from.
+        new_df: dataframe of the edited network.
+        stream_id_col: the name of the column that contains the unique ids for the streams
+        next_down_id_col: the name of the column that contains the unique id of the next down stream for each row
+        outlet_id: the next down id used to mark outlets, also given to outlets whose next down id is missing (NaN),
+                   so they compare equal across versions.
+
+    Returns: dictionary with "added" ({id: next down id}), "removed" (list of ids) and "rewired" ({id: new next down
+             id}), the arguments of update_index.
+    """
+    old = pd.Series(old_df[next_down_id_col].fillna(outlet_id).to_numpy(), index=old_df[stream_id_col].to_numpy())
+    new = pd.Series(new_df[next_down_id_col].fillna(outlet_id).to_numpy(), index=new_df[stream_id_col].to_numpy())
+    added = new[~new.index.isin(old.index)]
+    kept = new[new.index.isin(old.index)]
+    rewired = kept[kept.to_numpy() != old.loc[kept.index].to_numpy()]
+    return {"added": {int(k): int(v) for k, v in added.items()},
+            "removed": [int(k) for k in old.index[~old.index.isin(new.index)]],
+            "rewired": {int(k): int(v) for k, v in rewired.items()}}
+
+
+def update_index(index_path: str, added: dict = None, removed: list = None, rewired: dict = None,
+                 outlet_id: int = -1) -> dict:
+    """
+    Applies a small edit of the network to an existing index instead of tracing the whole region again. In the
+    "closure" layout every upstream set is a slice of one depth first permutation, so moving a segment moves its whole
+    upstream subtree as one contiguous block of the permutation: only the upstream sets of the segments downstream of
+    the old and the new position of the edited segment change, and every other set keeps its contents and has its
+    offsets shifted. Removed segments leave their parents as outlets unless the parents are rewired as well.
+    If no segments are added or removed the arrays keep their size and are overwritten in place, otherwise the index
+    is rewritten next to the old one and moved into place.
+    Args:
+        index_path: path to an upstream .adj index in the "closure" layout, as written by create_adjoint_dict.
+        added: dictionary of new stream ids paired with their next down ids.
+        removed: list of stream ids to delete.
+        rewired: dictionary of existing stream ids paired with their new next down ids.
+        outlet_id: the next down id used to mark outlets.
+
+    Returns: dictionary with "changed", the ids whose upstream lists changed (including added ids), and "segments",
+             the number of segments in the updated index.
+    """
+    header = read_header(index_path)
+    if header["layout"] != "closure" or "next_down" not in header["arrays"]:
+        raise ValueError(f"{index_path} does not store a river network, only upstream indexes in the closure layout "
+                         f"can be updated, create the index again with create_adjoint_dict")
+    if not header.get("meta", {}).get("trace_up", True):
+        raise ValueError(f"{index_path} holds downstream lists, only upstream indexes can be updated")
+    added = {int(k): int(v) for k, v in (added or {}).items()}
+    removed = [int(k) for k in (removed or [])]
+    rewired = {int(k): int(v) for k, v in (rewired or {}).items()}
+
+    state = _ClosureState(index_path, header)
+    changed = set()
+    if removed:
+        missing = [key for key in removed if state.position(key) == -1]
+        if missing:
+            raise ValueError(f"Cannot remove ids that are not in the index, e.g. {missing[:5]}")
+        for key in removed:
+            changed.update(state.move(state.position(key), -1))
+        removed_pos = state.position(np.array(removed))
+        orphans = np.flatnonzero(np.isin(state.next_down, removed))
+        state.next_down[orphans] = outlet_id
+        state.delete(removed_pos)
+    if added:
+        existing = [key for key in added if state.position(key) != -1]
+        if existing:
+            raise ValueError(f"Cannot add ids that are already in the index, e.g. {existing[:5]}")
+        state.insert(np.array(list(added), dtype=np.int64))
+        changed.update(added)
+    for key, down in {**added, **rewired}.items():
+        pos = state.position(key)
+        if pos == -1:
+            raise ValueError(f"Cannot rewire {key}, it is not in the index")
+        down_pos = -1 if down == outlet_id else state.position(down)
+        if down != outlet_id and down_pos == -1:
+            raise ValueError(f"Cannot rewire {key} to {down}, it is not in the index")
+        changed.update(state.move(pos, down_pos))
+        state.next_down[pos] = down
+
+    changed = np.array(sorted(changed), dtype=np.int64)
+    changed = changed[state.position(changed) != -1]
+    state.save(index_path, header)
+    return {"changed": changed, "segments": len(state.ids)}
+
+
+class _ClosureState:
+    """
+    In-memory copy of the arrays of a "closure" index with the operations update_index is built from.
+    """
+
+    def __init__(self, path: str, header: dict):
+        self.resized = False
+        arrays = {}
+        for name in ("ids", "start", "end", "order", "next_down"):
+            spec = header["arrays"][name]
+            arrays[name] = np.fromfile(path, dtype=spec["dtype"], count=int(np.prod(spec["shape"])),
+                                       offset=spec["offset"])
+        self.ids = arrays["ids"]
+        self.start = arrays["start"]
+        self.end = arrays["end"]
+        self.order = arrays["order"]
+        self.next_down = arrays["next_down"]
+
+    def position(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(keys.shape, -1) if keys.ndim else -1
+        pos = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        return np.where(self.ids[pos] == keys, pos, -1) if keys.ndim else int(pos if self.ids[pos] == keys else -1)
+
+    def downstream_ids(self, pos: int) -> list:
+        """
+        Returns: ids of the segments downstream of the segment at position pos, whose upstream lists contain it.
+        """
+        found = []
+        down = self.next_down[pos]
+        while True:
+            down_pos = self.position(down)
+            if down_pos == -1 or down_pos == pos:
+                return found
+            found.append(int(down))
+            down = self.next_down[down_pos]
+
+    def move(self, pos: int, down_pos: int) -> list:
+        """
+        Moves the block of the permutation holding the upstream subtree of the segment at position pos to just after
+        the segment at down_pos, or to the end of the permutation as a new basin if down_pos is -1.
+
+        Returns: ids of the segments whose upstream lists changed.
+        """
+        s, e = int(self.start[pos]), int(self.end[pos])
+        if down_pos != -1 and s <= self.start[down_pos] < e:
+            raise ValueError(f"Cannot rewire {self.ids[pos]} to {self.ids[down_pos]}, it is upstream of it and the "
+                             f"network would contain a cycle")
+        changed = self.downstream_ids(pos)
+        size = e - s
+        block = self.order[s:e].copy()
+        in_block = (self.start >= s) & (self.start < e)
+        rel_start, rel_end = self.start[in_block] - s, self.end[in_block] - s
+        self.order = np.concatenate((self.order[:s], self.order[e:]))
+        self.start[self.start >= e] -= size
+        self.end[self.end >= e] -= size
+
+        if down_pos == -1:
+            q = len(self.order)
+        else:
+            q = int(self.start[down_pos]) + 1
+            self.start[self.start >= q] += size
+            self.end[self.end >= q] += size
+        self.order = np.concatenate((self.order[:q], block, self.order[q:]))
+        self.start[in_block] = rel_start + q
+        self.end[in_block] = rel_end + q
+        if down_pos != -1:
+            changed += [int(self.ids[down_pos])] + self.downstream_ids(down_pos)
+        return changed
+
+    def delete(self, positions: np.ndarray):
+        """
+        Deletes segments that are outlets without parents.
+        """
+        entries = np.sort(self.start[positions])
+        keep = np.ones(len(self.order), dtype=bool)
+        keep[entries] = False
+        self.order = self.order[keep]
+        self.start = self.start - np.searchsorted(entries, self.start, side="right")
+        self.end = self.end - np.searchsorted(entries, self.end - 1, side="right")
+
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[positions] = False
+        new_pos = np.cumsum(keep) - 1
+        self.order = new_pos[self.order].astype(np.int32)
+        self.ids, self.start, self.end = self.ids[keep], self.start[keep], self.end[keep]
+        self.next_down = self.next_down[keep]
+        self.resized = True
+
+    def insert(self, keys: np.ndarray):
+        """
+        Inserts segments as outlets at the end of the permutation.
+        """
+        ids = np.concatenate((self.ids, keys))
+        sorter = np.argsort(ids, kind="stable")
+        new_pos = np.empty(len(ids), dtype=np.int32)
+        new_pos[sorter] = np.arange(len(ids), dtype=np.int32)
+        entries = np.arange(len(self.order), len(self.order) + len(keys), dtype=np.int64)
+        self.order = new_pos[np.concatenate((self.order, np.arange(len(self.ids), len(ids))))]
+        self.ids = ids[sorter]
+        self.start = np.concatenate((self.start, entries))[sorter]
+        self.end = np.concatenate((self.end, entries + 1))[sorter]
+        self.next_down = np.concatenate((self.next_down, np.full(len(keys), -1, dtype=np.int64)))[sorter]
+        self.resized = True
+
+    def save(self, path: str, header: dict):
+        arrays = {"ids": self.ids, "start": self.start, "end": self.end, "order": self.order,
+                  "next_down": self.next_down}
+        if self.resized:
+            write_index(path, self.ids, self.start, self.end, self.order, next_down=self.next_down,
+                        layout="closure", meta=header.get("meta"))
+            return
+        for name in ("start", "end", "order", "next_down"):
+            spec = header["arrays"][name]
+            target = np.memmap(path, dtype=spec["dtype"], mode="r+", offset=spec["offset"], shape=tuple(spec["shape"]))
+            target[:] = arrays[name]
+            target.flush()
+            del target
@@ -0,0 +1,229 @@
+import cProfile
+import json
+import os
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Span:
+    """
+    One timed stage of the pipeline. Set rows inside the with block to record how many rows or segments it handled.
+    """
+
+    def __init__(self, name: str, path: str, rows: int = None):
+        self.name = name
+        self.path = path
+        self.rows = rows
+        self.child_peak = 0
+
+    def record(self, wall: float, cpu: float, peak_mb: float = None) -> dict:
+        record = {"name": self.name, "path": self.path, "wall_s": wall, "cpu_s": cpu, "rows": self.rows,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if peak_mb is not None:
+            record["peak_traced_mb"] = peak_mb
+        return record
+
+
+class Instrumentation:
+    """
+    Collects named, nested spans around the stages of a run (reading, validating, building the network, tracing,
+    writing) with their wall and CPU time, row counts and peak memory, and hands each finished span to its sinks.
+    Sinks are callables taking a span record, e.g. log_sink, or objects with a close() method, e.g. JsonSink, which
+    are closed by close(). Optionally the whole run is captured with cProfile, and tracemalloc measures the peak
+    memory allocated within each span rather than only the process's resident high-water mark.
+    The pipeline reports to the current instrumentation (see span and use_instrumentation), which by default records
+    nothing, so the spans cost next to nothing unless switched on.
+    """
+
+    def __init__(self, sinks: list = None, profile_path: str = None, trace_memory: bool = False,
+                 enabled: bool = True):
+        """
+        Args:
+            sinks: list of sinks to send span records to.
+            profile_path: if given, the run is profiled with cProfile and the stats are written to this path on close.
+            trace_memory: if true, tracemalloc records the peak memory allocated in each span.
+            enabled: if false, spans are not timed or recorded at all.
+        """
+        self.sinks = sinks or []
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.enabled = enabled
+        self.records = []
+        self._stack = []
+        self._profiler = None
+        if enabled and profile_path is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name: str, rows: int = None):
+        """
+        Times the code in a with block as a stage called name, nested under any span that is already open.
+        Args:
+            name: name of the stage.
+            rows: number of rows or segments handled, can also be set on the yielded Span.
+
+        Yields: the Span.
+        """
+        path = "/".join([s.name for s in self._stack] + [name])
+        current = Span(name, path, rows)
+        if not self.enabled:
+            yield current
+            return
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            if self._stack:
+                self._stack[-1].child_peak = max(self._stack[-1].child_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(current)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield current
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stack.pop()
+            peak_mb = None
+            if tracing:
+                peak = max(tracemalloc.get_traced_memory()[1], current.child_peak)
+                peak_mb = peak / 2 ** 20
+                if self._stack:
+                    self._stack[-1].child_peak = max(self._stack[-1].child_peak, peak)
+            self.emit(current.record(wall, cpu, peak_mb))
+
+    def emit(self, record: dict):
+        """
+        Stores a span record and sends it to every sink, also used to pass on records made in worker processes.
+        """
+        self.records.append(record)
+        for sink in self.sinks:
+            (sink.write if hasattr(sink, "write") else sink)(record)
+
+    def close(self):
+        """
+        Stops profiling, writes the cProfile stats and closes the sinks.
+        """
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        for sink in self.sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+
+
+class JsonSink:
+    """
+    Collects span records and writes them to a json file on close, along with their aggregate (see aggregate).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = []
+
+    def write(self, record: dict):
+        self.records.append(record)
+
+    def close(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"stages": aggregate(self.records), "spans": self.records}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def log_sink(record: dict):
+    """
+    Prints one line per finished span.
+    """
+    line = f"[{record['path']}] {record['wall_s']:.3f}s wall, {record['cpu_s']:.3f}s cpu"
+    if record.get("rows") is not None:
+        line += f", {record['rows']} rows"
+    if "peak_traced_mb" in record:
+        line += f", peak {record['peak_traced_mb']:.1f} MB traced"
+    line += f", peak RSS {record['peak_rss_mb']:.0f} MB"
+    if record.get("region"):
+        line = f"{record['region']}: {line}"
+    print(line)
+
+
+def aggregate(records: list) -> dict:
+    """
+    Sums span records by stage, e.g. over every region of a multi-region run.
+
+    Returns: dictionary of span paths paired with their count, total and largest wall and CPU times, total rows and
+             largest peak memory.
+    """
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(record["path"], {"count": 0, "wall_s": 0.0, "max_wall_s": 0.0, "cpu_s": 0.0,
+                                                   "rows": 0, "peak_rss_mb": 0.0})
+        stage["count"] += 1
+        stage["wall_s"] += record["wall_s"]
+        stage["max_wall_s"] = max(stage["max_wall_s"], record["wall_s"])
+        stage["cpu_s"] += record["cpu_s"]
+        stage["rows"] += record.get("rows") or 0
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"], record["peak_rss_mb"])
+        if "peak_traced_mb" in record:
+            stage["peak_traced_mb"] = max(stage.get("peak_traced_mb", 0.0), record["peak_traced_mb"])
+    return stages
+
+
+_current = Instrumentation(enabled=False)
+
+
+def get_instrumentation() -> Instrumentation:
+    return _current
+
+
+def span(name: str, rows: int = None):
+    """
+    Opens a span on the current instrumentation, see Instrumentation.span.
+    """
+    return _current.span(name, rows)
+
+
+@contextmanager
+def use_instrumentation(instrumentation: Instrumentation):
+    """
+    Makes an instrumentation the current one inside a with block, and closes it at the end.
+    """
+    global _current
+    previous, _current = _current, instrumentation
+    try:
+        yield instrumentation
+    finally:
+        _current = previous
+        instrumentation.close()
+
+
+def add_arguments(parser):
+    """
+    Adds the instrumentation switches to an argparse parser, read back with from_args.
+    """
+    parser.add_argument('--spanlog', action='store_true', help='Print the time taken by each stage.')
+    parser.add_argument('--spanjson', type=str, default=None,
+                        help='Path to a json file to write the timings of every stage to.')
+    parser.add_argument('--cprofile', type=str, default=None,
+                        help='Path to write cProfile stats of the run to, readable with pstats or snakeviz.')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Measure the peak memory allocated in each stage with tracemalloc (slower).')
+
+
+def from_args(args) -> Instrumentation:
+    """
+    Returns: Instrumentation configured from the switches added by add_arguments, disabled if none are set.
+    """
+    sinks = []
+    if args.spanlog:
+        sinks.append(log_sink)
+    if args.spanjson:
+        sinks.append(JsonSink(args.spanjson))
+    enabled = bool(sinks or args.cprofile or args.tracemalloc)
+    if enabled and not sinks:
+        sinks.append(log_sink)
+    return Instrumentation(sinks, args.cprofile, args.tracemalloc, enabled)
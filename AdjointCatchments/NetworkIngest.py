@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+from glob import glob
+
+import pandas as pd
+
+CACHE_DIR_NAME = ".adjoint_cache"
+SIDECAR_EXTENSIONS = (".dbf", ".shx", ".cpg", ".prj")
+
+
+def read_network_table(path: str, columns: list = None, geometry: bool = False, cache_dir: str = None,
+                       use_cache: bool = True) -> pd.DataFrame:
+    """
+    Reads only the needed columns of a catchment or drainage line file, skipping the geometry unless it is asked for,
+    and keeps a Parquet copy of the result so later runs load it in a fraction of a second instead of parsing the DBF
+    again. The cache is keyed on the source file's path, modification time and size, and on the columns read, so an
+    edited source file is always read again.
+    Args:
+        path: path to a .shp or .gpkg file, a directory containing a single .shp file, or a "zip://" path.
+        columns: names of the attribute columns to read, all columns if None. Names that are not in the file are
+                 skipped, so callers can check for missing columns themselves.
+        geometry: if true, the geometry is read as well and a GeoDataFrame is returned.
+        cache_dir: directory for the cached copies, defaults to a .adjoint_cache directory next to the source file.
+        use_cache: if false, always reads the source file and writes no cache.
+
+    Returns: DataFrame, or GeoDataFrame if geometry is true, with the available requested columns.
+    """
+    path = _resolve_source(path)
+    if columns is not None:
+        available = _available_columns(path)
+        columns = [col for col in columns if col in available]
+
+    cache_path = None
+    if use_cache and _parquet_available():
+        cache_path = _cache_path(path, columns, geometry, cache_dir)
+        if os.path.exists(cache_path):
+            if geometry:
+                import geopandas as gpd
+                return gpd.read_parquet(cache_path)
+            return pd.read_parquet(cache_path)
+
+    import geopandas as gpd
+    df = gpd.read_file(path, columns=columns, ignore_geometry=not geometry)
+    if not geometry:
+        df = pd.DataFrame(df)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)
+    return df
+
+
+def _resolve_source(path: str) -> str:
+    if os.path.isdir(path):
+        shapefiles = glob(os.path.join(path, "*.shp"))
+        if len(shapefiles) != 1:
+            raise ValueError(f"Expected one .shp file in {path}, found {len(shapefiles)}")
+        return shapefiles[0]
+    return path
+
+
+def _source_file(path: str) -> str:
+    """
+    Returns: the file on disk behind a path, e.g. the .zip file of a "zip://archive.zip!layer.shp" path.
+    """
+    if path.startswith("zip://"):
+        return path[len("zip://"):].split("!")[0]
+    return path
+
+
+def _available_columns(path: str) -> list:
+    try:
+        import pyogrio
+        return list(pyogrio.read_info(path)["fields"])
+    except ImportError:
+        import geopandas as gpd
+        return list(gpd.read_file(path, rows=1).columns)
+
+
+def _cache_path(path: str, columns: list, geometry: bool, cache_dir: str = None) -> str:
+    source = os.path.abspath(_source_file(path))
+    key = json.dumps({"path": os.path.abspath(path) if not path.startswith("zip://") else path,
+                      "files": _source_stats(source), "columns": columns, "geometry": geometry})
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(source), CACHE_DIR_NAME)
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(cache_dir, f"{stem}-{digest}.parquet")
+
+
+def _source_stats(source: str) -> list:
+    """
+    Returns: the name, mtime and size of the source file and, for a shapefile, of each of its sidecar files that
+             exists, so an edit of only the attributes in the .dbf also invalidates the cache. A zip archive is one file.
+    """
+    files = [source]
+    root, ext = os.path.splitext(source)
+    if ext.lower() == ".shp":
+        files += [root + sidecar for sidecar in SIDECAR_EXTENSIONS + tuple(e.upper() for e in SIDECAR_EXTENSIONS)
+                  if os.path.exists(root + sidecar)]
+    stats = []
+    for file in files:
+        stat = os.stat(file)
+        stats.append([os.path.basename(file), stat.st_mtime_ns, stat.st_size])
+    return stats
+
+
+def _parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
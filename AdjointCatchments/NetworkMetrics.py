@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+from RiverNetwork import RiverNetwork
+
+
+class NetworkMetrics:
+    """
+    Per-segment flow length and accumulation metrics of a network, computed for every segment at once from the
+    upstream closure instead of walking trace_tree lists. Everything upstream of a segment is one slice of the
+    closure's depth first permutation, and everything downstream of it is the set of segments whose slice holds it, so:
+        - sums over the upstream set (upstream length, Shreve magnitude, plain accumulations) are differences of one
+          prefix sum over the permutation
+        - sums over the downstream path (distance to outlet) are one prefix sum of a difference array, adding a
+          segment's value at the start of its slice and removing it at the end
+        - recurrences that are not sums (longest upstream path, decayed accumulation) go one depth level at a time
+          from the sources to the outlets, each level a single vectorized step
+    All results are arrays in network order, so for a network built from a dataframe they line up with its rows.
+    """
+
+    def __init__(self, network: RiverNetwork, lengths=None):
+        """
+        Args:
+            network: RiverNetwork to measure.
+            lengths: optional array with the length of each segment (e.g. LENGTHKM), in network order, needed for the
+                     distance metrics and decayed accumulations.
+        """
+        self.network = network
+        self.lengths = None if lengths is None else np.asarray(lengths, dtype=float)
+        if self.lengths is not None and np.isnan(self.lengths).any():
+            raise ValueError(f"{int(np.isnan(self.lengths).sum())} segments have no length, fill them in first")
+        self.closure = network.upstream_closure()
+        self.depth = self.closure.depth
+        by_depth = np.argsort(-self.depth, kind="stable")
+        level_starts = np.flatnonzero(np.r_[True, self.depth[by_depth][1:] != self.depth[by_depth][:-1]])
+        self._levels = np.split(by_depth, level_starts[1:])
+
+    def upstream_sum(self, values) -> np.ndarray:
+        """
+        Returns: array with the sum of values over each segment and everything upstream of it.
+        """
+        values = np.asarray(values)
+        sums = np.zeros(len(values) + 1, dtype=np.result_type(values, np.int64))
+        np.cumsum(values[self.closure.order], out=sums[1:])
+        return sums[self.closure.end] - sums[self.closure.start]
+
+    def distance_to_outlet(self) -> np.ndarray:
+        """
+        Returns: array with the length of the path from the downstream end of each segment to its outlet, the same
+                 as DownstreamQueries.distance_to_outlet.
+        """
+        return self._downstream_sum(self._require_lengths())
+
+    def upstream_length(self) -> np.ndarray:
+        """
+        Returns: array with the total length of each segment and every segment upstream of it.
+        """
+        return self.upstream_sum(self._require_lengths())
+
+    def longest_upstream_path(self) -> np.ndarray:
+        """
+        Returns: array with the length of the longest flow path from a source down to the downstream end of each
+                 segment, its own length included.
+        """
+        lengths = self._require_lengths()
+        longest = np.zeros(len(self.network))
+        from_parents = np.zeros(len(self.network))
+        down = self.network.down
+        for level in self._levels:
+            longest[level] = lengths[level] + from_parents[level]
+            level = level[down[level] >= 0]
+            np.maximum.at(from_parents, down[level], longest[level])
+        return longest
+
+    def shreve_magnitude(self) -> np.ndarray:
+        """
+        Returns: array with the number of sources (segments without parents) upstream of each segment.
+        """
+        sources = self.network.up_offsets[1:] == self.network.up_offsets[:-1]
+        return self.upstream_sum(sources.astype(np.int64))
+
+    def strahler_order(self) -> np.ndarray:
+        """
+        Returns: array with the Strahler order of each segment recomputed from the topology, see
+                 RiverNetwork.strahler_order.
+        """
+        return self.network.strahler_order()
+
+    def decayed_accumulation(self, values, decay_rate: float) -> np.ndarray:
+        """
+        Accumulates values downstream, discounting what flows through each segment by its length:
+            D(v) = x(v) + exp(-decay_rate * length(v)) * sum of D(p) over the parents p of v
+        so a value x(u) upstream arrives at v scaled by exp(-decay_rate) to the power of the length of the path from
+        u's downstream end to v's downstream end, as for first order decay of a pollutant in transit.
+        Args:
+            values: array with the value x of each segment, in network order.
+            decay_rate: decay per unit of length, in the inverse units of the lengths. 0 gives the plain upstream sum.
+
+        Returns: array with D of each segment.
+        """
+        values = np.asarray(values, dtype=float)
+        retained = np.exp(-decay_rate * self._require_lengths())
+        accumulated = np.zeros(len(self.network))
+        from_parents = np.zeros(len(self.network))
+        down = self.network.down
+        for level in self._levels:
+            accumulated[level] = values[level] + retained[level] * from_parents[level]
+            level = level[down[level] >= 0]
+            np.add.at(from_parents, down[level], accumulated[level])
+        return accumulated
+
+    def to_dataframe(self, stream_id_col: str = "COMID", values: dict = None, decay_rate: float = None) -> \
+            pd.DataFrame:
+        """
+        Collects the metrics into a table that joins onto the drainage lines by stream id.
+        Args:
+            stream_id_col: name to give the stream id column.
+            values: optional dictionary of names paired with arrays of values, in network order, to accumulate.
+            decay_rate: if given, the values are also accumulated with decayed_accumulation.
+
+        Returns: dataframe with one row per segment in network order, holding the stream id, depth (number of
+                 segments downstream), Strahler order, Shreve magnitude, the distance metrics if there are lengths,
+                 and upstream_<name> (and decayed_<name>) for each of the values.
+        """
+        table = {stream_id_col: self.network.ids, "depth": self.depth, "strahler_order": self.strahler_order(),
+                 "shreve_magnitude": self.shreve_magnitude()}
+        if self.lengths is not None:
+            table["distance_to_outlet"] = self.distance_to_outlet()
+            table["upstream_length"] = self.upstream_length()
+            table["longest_upstream_path"] = self.longest_upstream_path()
+        for name, column in (values or {}).items():
+            table[f"upstream_{name}"] = self.upstream_sum(column)
+            if decay_rate is not None:
+                table[f"decayed_{name}"] = self.decayed_accumulation(column, decay_rate)
+        return pd.DataFrame(table)
+
+    def _downstream_sum(self, values: np.ndarray) -> np.ndarray:
+        # every segment's value reaches the positions strictly inside its slice, i.e. everything upstream of it
+        n = len(self.network)
+        diff = np.bincount(self.closure.start + 1, values, minlength=n + 1) - \
+            np.bincount(self.closure.end, values, minlength=n + 1)
+        return np.cumsum(diff[:n])[self.closure.start]
+
+    def _require_lengths(self) -> np.ndarray:
+        if self.lengths is None:
+            raise ValueError("Metrics were made without segment lengths, pass lengths (e.g. LENGTHKM) to measure "
+                             "distances")
+        return self.lengths
+
+
+def network_metrics(df: pd.DataFrame, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID",
+                    length_col: str = "LENGTHKM", value_cols: list = None, decay_rate: float = None) -> pd.DataFrame:
+    """
+    Computes the NetworkMetrics of a drainage line table.
+    Args:
+        df: dataframe or GeoDataFrame of drainage lines.
+        stream_id_col: name of the stream id column.
+        next_down_id_col: name of the next down id column.
+        length_col: name of the segment length column, or None to skip the distance metrics.
+        value_cols: optional names of columns to accumulate upstream.
+        decay_rate: if given, value_cols are also accumulated with NetworkMetrics.decayed_accumulation.
+
+    Returns: dataframe of the metrics with the same index as df, without the stream id column, so it can be added
+             with df.join(metrics).
+    """
+    network = RiverNetwork.from_dataframe(df, stream_id_col, next_down_id_col)
+    lengths = df[length_col].to_numpy() if length_col is not None else None
+    values = {col: df[col].to_numpy() for col in value_cols or []}
+    metrics = NetworkMetrics(network, lengths).to_dataframe(stream_id_col, values, decay_rate)
+    return metrics.drop(columns=stream_id_col).set_axis(df.index)
@@ -0,0 +1,271 @@
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from AdjointIndex import INDEX_EXTENSION, AdjointIndex, closure_to_index
+from ResultWriter import write_lists
+from RiverNetwork import RiverNetwork
+
+STITCH_NAME = "stitch.parquet"
+PARTITIONS_NAME = "partitions.json"
+
+
+def basin_groups(network: RiverNetwork, chunk_size: int) -> list:
+    """
+    Splits the network into groups of whole basins holding about chunk_size segments each. A basin larger than
+    chunk_size gets a group of its own.
+
+    Returns: list of arrays of row indices.
+    """
+    outlets = network.outlet_of()
+    rows = np.argsort(outlets, kind="stable")
+    basin_starts = np.flatnonzero(np.r_[True, outlets[rows][1:] != outlets[rows][:-1]])
+    groups, group_start = [], 0
+    for basin_start in basin_starts[1:]:
+        if basin_start - group_start >= chunk_size:
+            groups.append(rows[group_start:basin_start])
+            group_start = basin_start
+    if group_start < len(rows):
+        groups.append(rows[group_start:])
+    return groups
+
+
+def subtree_groups(network: RiverNetwork, max_size: int) -> list:
+    """
+    Splits the network into groups of at most max_size segments, keeping subtrees together where they fit. Every
+    segment whose upstream subtree fits in max_size, but whose next down segment's does not, makes a unit with its
+    subtree; the segments with larger subtrees are units of their own. Units are consecutive in the depth first order
+    of the network, and are packed into groups in that order, so small basins and neighboring tributaries share a
+    group and only the links between groups need stitching.
+
+    Returns: list of arrays of row indices.
+    """
+    closure = network.upstream_closure()
+    size = closure.end - closure.start
+    fits = size <= max_size
+    down_fits = np.zeros(len(network), dtype=bool)
+    has_down = network.down >= 0
+    down_fits[has_down] = fits[network.down[has_down]]
+    unit_root = ~fits | ~down_fits
+    unit_starts = np.sort(closure.start[unit_root])
+    unit_sizes = np.diff(np.append(unit_starts, len(network)))
+
+    groups, group_start, group_size = [], 0, 0
+    for unit_start, unit_size in zip(unit_starts.tolist(), unit_sizes.tolist()):
+        if group_size + unit_size > max_size and group_size:
+            groups.append(closure.order[group_start:unit_start])
+            group_start, group_size = unit_start, 0
+        group_size += unit_size
+    if group_size:
+        groups.append(closure.order[group_start:])
+    return groups
+
+
+def partition_network(network: RiverNetwork, max_size: int, by: str = "subtree"):
+    """
+    Splits a network into partitions that can be traced separately, and the table of links that cross between them.
+    Args:
+        network: RiverNetwork to split.
+        max_size: largest number of segments in a partition. With by="basin" basins are never split, they are
+                  grouped into partitions of about max_size segments and a larger basin gets one of its own.
+        by: "basin" to keep whole basins together, so nothing needs stitching, or "subtree" for partitions of bounded
+            size that may split a basin.
+
+    Returns: tuple of (list of RiverNetworks, one per partition, with links to other partitions cut, and a stitch
+             dataframe with the columns id, next_down_id, partition and next_down_partition, one row per cut link).
+    """
+    if by == "basin":
+        groups = basin_groups(network, max_size)
+    elif by == "subtree":
+        groups = subtree_groups(network, max_size)
+    else:
+        raise ValueError(f'by must be "basin" or "subtree", not {by}')
+    partition_of = np.empty(len(network), dtype=np.int32)
+    for number, rows in enumerate(groups):
+        partition_of[rows] = number
+    has_down = network.down >= 0
+    crossing = np.zeros(len(network), dtype=bool)
+    crossing[has_down] = partition_of[has_down] != partition_of[network.down[has_down]]
+    stitch = pd.DataFrame({"id": network.ids[crossing], "next_down_id": network.next_down_ids[crossing],
+                           "partition": partition_of[crossing],
+                           "next_down_partition": partition_of[network.down[crossing]]})
+    next_down_ids = np.where(crossing, -1, network.next_down_ids)
+    parts = []
+    for rows in groups:
+        rows = np.sort(rows)
+        parts.append(RiverNetwork(network.ids[rows], next_down_ids[rows],
+                                  None if network.orders is None else network.orders[rows]))
+    return parts, stitch
+
+
+def trace_partition(ids: np.ndarray, next_down_ids: np.ndarray, path: str, meta: dict = None) -> str:
+    """
+    Traces one partition and writes its upstream sets to an index. Takes plain arrays so it can run in a worker.
+
+    Returns: the path written to.
+    """
+    closure = RiverNetwork(ids, next_down_ids).upstream_closure()
+    return closure_to_index(closure, path, meta)
+
+
+class PartitionedIndex:
+    """
+    Upstream sets of a network traced one partition at a time, merged on lookup into the same sets a run over the
+    whole network gives. Each partition's index holds the upstream sets within the partition; the upstream set of an
+    id is its own partition's set plus the merged sets of every stitched segment that flows into a member of it. The
+    stitch rows of a partition are sorted by the position of their next down segment in the partition's depth first
+    order, so the rows flowing into a set are one searchsorted range. Partition indexes are memory-mapped and at most
+    max_open of them are kept open, so only the partitions an id drains through are read.
+    """
+
+    def __init__(self, index_paths: list, stitch: pd.DataFrame, max_open: int = 64):
+        """
+        Args:
+            index_paths: paths to the index of each partition, in partition order.
+            stitch: stitch dataframe from partition_network.
+            max_open: number of partition indexes to keep open at once.
+        """
+        self.index_paths = list(index_paths)
+        self.max_open = max_open
+        self._open = OrderedDict()
+        # per partition, the stitched ids flowing in sorted by where their next down segment sits in its permutation
+        self._inflow = []
+        partition_ids = []
+        for number, path in enumerate(self.index_paths):
+            index = AdjointIndex(path)
+            partition_ids.append(np.array(index.ids))
+            rows = stitch[stitch["next_down_partition"] == number]
+            positions = index.start[np.searchsorted(index.ids, rows["next_down_id"].to_numpy())]
+            order = np.argsort(positions, kind="stable")
+            self._inflow.append((positions[order], rows["id"].to_numpy()[order]))
+        ids = np.concatenate(partition_ids) if partition_ids else np.zeros(0, dtype=np.int64)
+        codes = np.repeat(np.arange(len(partition_ids), dtype=np.int32), [len(p) for p in partition_ids])
+        sorter = np.argsort(ids, kind="stable")
+        self.ids, self.partition_of = ids[sorter], codes[sorter]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return self._partition(key) != -1
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.upstream(key)
+
+    def upstream(self, key) -> np.ndarray:
+        """
+        Returns: array of the id and every id upstream of it, across partitions.
+        """
+        if self._partition(key) == -1:
+            raise KeyError(key)
+        found = []
+        pending = [int(key)]
+        while pending:
+            current = pending.pop()
+            number = self._partition(current)
+            index = self._index(number)
+            pos = int(np.searchsorted(index.ids, current))
+            start, end = int(index.start[pos]), int(index.end[pos])
+            found.append(index.ids[index.order[start:end]])
+            positions, inflow_ids = self._inflow[number]
+            pending.extend(inflow_ids[np.searchsorted(positions, start):np.searchsorted(positions, end)].tolist())
+        return np.concatenate(found)
+
+    def items(self):
+        """
+        Yields: (id, upstream ids) pairs for every id, partition by partition.
+        """
+        for number in range(len(self.index_paths)):
+            for key in self._index(number).ids.tolist():
+                yield key, self.upstream(key)
+
+    def to_dict(self) -> dict:
+        """
+        Returns: dictionary in the create_adjoint_dict format.
+        """
+        return {str(key): values.tolist() for key, values in self.items()}
+
+    def _index(self, number: int) -> AdjointIndex:
+        if number in self._open:
+            self._open.move_to_end(number)
+        else:
+            self._open[number] = AdjointIndex(self.index_paths[number])
+            if len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+        return self._open[number]
+
+    def _partition(self, key) -> int:
+        key = int(key)
+        pos = int(np.searchsorted(self.ids, key))
+        if pos == len(self.ids) or self.ids[pos] != key:
+            return -1
+        return int(self.partition_of[pos])
+
+
+def trace_partitioned(network: RiverNetwork, work_dir: str, max_size: int, by: str = "subtree", workers: int = 1,
+                      out_file: str = None) -> PartitionedIndex:
+    """
+    Traces a network one partition at a time, in worker processes, keeping only one partition's closure in memory
+    per worker, and optionally writes the merged upstream sets out in any format of ResultWriter.write_lists.
+    Args:
+        network: RiverNetwork to trace.
+        work_dir: directory for the partition indexes, the stitch table and the list of partitions, which can be
+                  reopened with open_partitioned. Partition indexes left there by an earlier run are deleted.
+        max_size: largest number of segments in a partition, see partition_network.
+        by: "basin" or "subtree", see partition_network.
+        workers: number of worker processes.
+        out_file: optional path to write the merged upstream lists to, e.g. a .json or .jsonl file.
+
+    Returns: PartitionedIndex of the partitions.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    for old_path in glob(os.path.join(work_dir, f"partition-*{INDEX_EXTENSION}")):
+        os.remove(old_path)
+    parts, stitch = partition_network(network, max_size, by)
+    names = [f"partition-{number}{INDEX_EXTENSION}" for number in range(len(parts))]
+    paths = [os.path.join(work_dir, name) for name in names]
+    tasks = [(part.ids, part.next_down_ids, path, {"partition": number})
+             for number, (part, path) in enumerate(zip(parts, paths))]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(trace_partition, *zip(*tasks)))
+    else:
+        for task in tasks:
+            trace_partition(*task)
+    _write_stitch(stitch, work_dir)
+    with open(os.path.join(work_dir, PARTITIONS_NAME), "w") as f:
+        json.dump({"partitions": names, "by": by, "max_size": max_size}, f)
+    index = PartitionedIndex(paths, stitch)
+    if out_file is not None:
+        write_lists(index.items(), out_file)
+    return index
+
+
+def open_partitioned(work_dir: str) -> PartitionedIndex:
+    """
+    Returns: PartitionedIndex of the partitions written to work_dir by trace_partitioned, as listed next to the
+             stitch table.
+    """
+    stitch = _read_stitch(work_dir)
+    with open(os.path.join(work_dir, PARTITIONS_NAME)) as f:
+        names = json.load(f)["partitions"]
+    return PartitionedIndex([os.path.join(work_dir, name) for name in names], stitch)
+
+
+def _write_stitch(stitch: pd.DataFrame, work_dir: str):
+    try:
+        stitch.to_parquet(os.path.join(work_dir, STITCH_NAME))
+    except ImportError:
+        stitch.to_csv(os.path.join(work_dir, STITCH_NAME.replace(".parquet", ".csv")), index=False)
+
+
+def _read_stitch(work_dir: str) -> pd.DataFrame:
+    path = os.path.join(work_dir, STITCH_NAME)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    return pd.read_csv(path.replace(".parquet", ".csv"))
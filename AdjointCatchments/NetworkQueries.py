@@ -0,0 +1,152 @@
+import numpy as np
+
+from RiverNetwork import RiverNetwork
+
+
+class DownstreamQueries:
+    """
+    Answers batches of downstream queries on a RiverNetwork with binary lifting: jump[k][i] is the segment 2**k steps
+    downstream of segment i, so any number of steps down can be taken in O(log depth) vectorized jumps. Depths and
+    distances to the outlet are accumulated the same way, so nothing walks the network one pointer at a time except
+    when a whole path has to be returned.
+    """
+
+    def __init__(self, network: RiverNetwork, lengths=None):
+        """
+        Args:
+            network: RiverNetwork to query.
+            lengths: optional array with the length of each segment (e.g. LENGTHKM), in network order, needed for
+                     distance queries.
+        """
+        self.network = network
+        n = len(network)
+        # index n is a sentinel below every outlet, so jumps past an outlet stay put
+        down = np.append(np.where(network.down == -1, n, network.down), n).astype(np.int32)
+        steps = np.append(np.where(network.down == -1, 0, 1), 0).astype(np.int64)
+        below = None
+        self.lengths = None
+        if lengths is not None:
+            lengths = self.lengths = np.asarray(lengths, dtype=float)
+            below = np.append(np.where(network.down == -1, 0.0, lengths[network.down]), 0.0)
+
+        self.jump = [down]
+        reach = down
+        for _ in range(int(np.ceil(np.log2(n + 1))) + 1):
+            steps = steps + steps[reach]
+            if below is not None:
+                below = below + below[reach]
+            reach = reach[reach]
+            if (reach == self.jump[-1]).all():
+                break
+            self.jump.append(reach)
+        else:
+            raise ValueError("The network contains cycles, clean it with NetworkValidation.validate_network first")
+        self.depth = steps[:n]
+        self.outlet = network.outlet_of()
+        self.distance_to_outlet = below[:n] if below is not None else None
+
+    def ancestor(self, indices: np.ndarray, steps: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            indices: segment indices.
+            steps: number of steps to go down from each segment, at most its depth.
+
+        Returns: indices of the segments the given number of steps downstream.
+        """
+        indices = np.asarray(indices, dtype=np.int32).copy()
+        steps = np.asarray(steps, dtype=np.int64)
+        for k, jump in enumerate(self.jump):
+            take = (steps >> k) & 1 == 1
+            indices[take] = jump[indices[take]]
+        return indices
+
+    def lca_indices(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """
+        Returns: index of the first segment downstream of (or equal to) both a and b, -1 if they drain to different
+                 outlets.
+        """
+        a = np.asarray(a, dtype=np.int32)
+        b = np.asarray(b, dtype=np.int32)
+        result = np.full(len(a), -1, dtype=np.int32)
+        same = self.outlet[a] == self.outlet[b]
+        a, b = a[same], b[same]
+        depth_a, depth_b = self.depth[a], self.depth[b]
+        a = self.ancestor(a, np.maximum(depth_a - depth_b, 0))
+        b = self.ancestor(b, np.maximum(depth_b - depth_a, 0))
+        for jump in reversed(self.jump):
+            ja, jb = jump[a], jump[b]
+            move = ja != jb
+            a[move], b[move] = ja[move], jb[move]
+        result[same] = np.where(a == b, a, self.jump[0][a])
+        return result
+
+    def lca(self, a_ids, b_ids) -> np.ndarray:
+        """
+        Finds where pairs of rivers meet.
+        Args:
+            a_ids: array of stream ids.
+            b_ids: array of stream ids of the same length.
+
+        Returns: array of the ids of the confluence (lowest common downstream segment) of each pair, -1 where the pair
+                 drains to different outlets or an id is not in the network.
+        """
+        a, b, known = self._indices(a_ids, b_ids)
+        result = np.full(len(a), -1, dtype=np.int64)
+        meet = self.lca_indices(a[known], b[known])
+        result[np.flatnonzero(known)[meet != -1]] = self.network.ids[meet[meet != -1]]
+        return result
+
+    def distance(self, a_ids, b_ids) -> np.ndarray:
+        """
+        Distance along the network between the downstream ends of pairs of segments, through their confluence. If one
+        segment is downstream of the other the distance runs to its downstream end, otherwise both run only to the
+        junction at the upstream end of the segment where they meet.
+        Args:
+            a_ids: array of stream ids.
+            b_ids: array of stream ids of the same length.
+
+        Returns: float array of distances in the units of lengths, NaN where the pair is not connected.
+        """
+        if self.distance_to_outlet is None:
+            raise ValueError("DownstreamQueries was built without segment lengths")
+        a, b, known = self._indices(a_ids, b_ids)
+        result = np.full(len(a), np.nan)
+        a, b = a[known], b[known]
+        meet = self.lca_indices(a, b)
+        joined = meet != -1
+        a, b, meet = a[joined], b[joined], meet[joined]
+        dist = self.distance_to_outlet
+        # tributaries meet at the upstream end of meet, so neither path includes meet's own length
+        junction = dist[meet] + np.where((a != meet) & (b != meet), self.lengths[meet], 0.0)
+        result[np.flatnonzero(known)[joined]] = dist[a] + dist[b] - 2 * junction
+        return result
+
+    def paths_to_outlet(self, ids):
+        """
+        Finds the path to the outlet (the ocean) of many segments at once.
+        Args:
+            ids: array of stream ids.
+
+        Returns: tuple of (offsets, path_ids), so the path of ids[i], starting with itself, is
+                 path_ids[offsets[i]:offsets[i + 1]]. Ids not in the network get an empty path.
+        """
+        indices = self.network.index_of(np.atleast_1d(ids))
+        counts = np.where(indices == -1, 0, self.depth[indices] + 1)
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        path = np.empty(offsets[-1], dtype=np.int32)
+        active = np.flatnonzero(indices != -1)
+        current = indices[active]
+        pos = offsets[active]
+        while len(active):
+            path[pos] = current
+            current = self.network.down[current]
+            pos = pos + 1
+            keep = current != -1
+            current, pos, active = current[keep], pos[keep], active[keep]
+        return offsets, self.network.ids[path]
+
+    def _indices(self, a_ids, b_ids):
+        a = self.network.index_of(np.atleast_1d(a_ids))
+        b = self.network.index_of(np.atleast_1d(b_ids))
+        return a, b, (a != -1) & (b != -1)
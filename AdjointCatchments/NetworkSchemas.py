@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from RiverNetwork import RiverNetwork
+
+CANONICAL_COLUMNS = ("stream_id", "next_down_id", "order", "length")
+
+
+@dataclass(frozen=True)
+class NetworkSchema:
+    """
+    Column names and conventions of one source of stream networks, mapping its tables onto the canonical network
+    model: a RiverNetwork, or a dataframe with the CANONICAL_COLUMNS stream_id, next_down_id, order and length.
+    """
+    name: str
+    stream_id_col: str
+    next_down_id_col: str
+    order_col: str = None
+    length_col: str = None
+    outlet_id: int = -1
+    description: str = ""
+
+    @property
+    def columns(self) -> list:
+        """
+        Returns: names of the columns of this source that are read, the required ones first.
+        """
+        return [col for col in (self.stream_id_col, self.next_down_id_col, self.order_col, self.length_col)
+                if col is not None]
+
+    def matches(self, columns) -> bool:
+        """
+        Returns: true if the id and next down id columns of this schema are among the given columns.
+        """
+        return self.stream_id_col in columns and self.next_down_id_col in columns
+
+    def to_canonical(self, df: "pd.DataFrame") -> "pd.DataFrame":
+        """
+        Renames the columns of a table of this source to the canonical names, with -1 marking outlets. Order and
+        length columns that the schema or table lacks are left out.
+        """
+        import pandas as pd
+
+        canonical = pd.DataFrame({"stream_id": df[self.stream_id_col].to_numpy(),
+                                  "next_down_id": df[self.next_down_id_col].to_numpy()})
+        if self.outlet_id != -1:
+            canonical.loc[canonical["next_down_id"] == self.outlet_id, "next_down_id"] = -1
+        for canonical_col, col in (("order", self.order_col), ("length", self.length_col)):
+            if col is not None and col in df.columns:
+                canonical[canonical_col] = df[col].to_numpy()
+        return canonical
+
+    def network(self, df: "pd.DataFrame") -> RiverNetwork:
+        """
+        Returns: RiverNetwork of a table of this source, with stream orders if the table has them.
+        """
+        orders = df[self.order_col].to_numpy() if self.order_col is not None and self.order_col in df.columns \
+            else None
+        next_down = df[self.next_down_id_col].to_numpy()
+        if self.outlet_id != -1:
+            next_down = np.where(next_down == self.outlet_id, -1, next_down)
+        return RiverNetwork(df[self.stream_id_col].to_numpy(), next_down, orders)
+
+
+SCHEMAS = {
+    "geoglows": NetworkSchema("geoglows", "COMID", "NextDownID", "order_", "LENGTHKM",
+                              description="GEOGloWS drainage lines"),
+    "geoglows_catchments": NetworkSchema("geoglows_catchments", "HydroID", "NextDownID", "order_",
+                                         description="GEOGloWS delineation catchments"),
+    "nga": NetworkSchema("nga", "LINKNO", "DSLINKNO", "strmOrder", "Length",
+                         description="NGA delineation stream networks made with TauDEM (*streamnet*.shp)"),
+    "nga_catchments": NetworkSchema("nga_catchments", "streamID", "DSLINKNO", "strmOrder", "Length",
+                                    description="NGA basins (*basins*.gpkg) joined to their TauDEM stream network"),
+}
+SCHEMAS["taudem"] = SCHEMAS["nga"]
+
+
+def get_schema(schema) -> NetworkSchema:
+    """
+    Args:
+        schema: a NetworkSchema, or the name of one in SCHEMAS.
+
+    Returns: the NetworkSchema.
+    """
+    if isinstance(schema, NetworkSchema):
+        return schema
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown network schema {schema}, use one of {sorted(SCHEMAS)}")
+    return SCHEMAS[schema]
+
+
+def detect_schema(columns) -> NetworkSchema:
+    """
+    Returns: the first schema in SCHEMAS whose id columns are among the given columns.
+    """
+    for schema in SCHEMAS.values():
+        if schema.matches(columns):
+            return schema
+    raise ValueError(f"No known network schema matches the columns {list(columns)}, use one of {sorted(SCHEMAS)} "
+                     f"or make a NetworkSchema")
+
+
+def read_network(path: str, schema=None, canonical: bool = False):
+    """
+    Reads the columns of a stream network file needed by its schema, through NetworkIngest so they are cached.
+    Args:
+        path: path to the network file, see read_network_table.
+        schema: NetworkSchema or name of one, detected from the file's columns if None.
+        canonical: if true, the table is returned with the canonical column names.
+
+    Returns: tuple of (NetworkSchema, dataframe).
+    """
+    from NetworkIngest import read_network_table
+
+    if schema is None:
+        candidates = list(dict.fromkeys(col for known in SCHEMAS.values() for col in known.columns))
+        df = read_network_table(path, candidates)
+        schema = detect_schema(df.columns)
+        df = df[[col for col in schema.columns if col in df.columns]]
+    else:
+        schema = get_schema(schema)
+        df = read_network_table(path, schema.columns)
+        missing = [col for col in (schema.stream_id_col, schema.next_down_id_col) if col not in df.columns]
+        if missing:
+            raise ValueError(f"{path} is missing the {schema.name} columns {missing}")
+    return schema, schema.to_canonical(df) if canonical else df
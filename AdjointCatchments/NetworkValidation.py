@@ -0,0 +1,137 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from RiverNetwork import RiverNetwork
+
+
+@dataclass
+class NetworkReport:
+    """
+    Defects found by validate_network. Every list holds stream ids.
+    """
+    n_segments: int = 0
+    n_outlets: int = 0
+    missing_ids: int = 0
+    duplicate_ids: list = field(default_factory=list)
+    self_loops: list = field(default_factory=list)
+    dangling_next_down: list = field(default_factory=list)
+    cycles: list = field(default_factory=list)
+    multiple_outlets: dict = field(default_factory=dict)
+    nan_orders: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not (self.missing_ids or self.duplicate_ids or self.self_loops or self.dangling_next_down or
+                    self.cycles or self.multiple_outlets or self.nan_orders)
+
+    def summary(self) -> str:
+        """
+        Returns: one line per kind of defect with how many were found and a few example ids.
+        """
+        lines = [f"{self.n_segments} segments, {self.n_outlets} outlets"]
+        if self.missing_ids:
+            lines.append(f"rows without an id: {self.missing_ids}")
+        for name in ("duplicate_ids", "self_loops", "dangling_next_down", "cycles", "nan_orders"):
+            found = getattr(self, name)
+            if found:
+                lines.append(f"{name.replace('_', ' ')}: {len(found)}, e.g. {found[:5]}")
+        if self.multiple_outlets:
+            examples = dict(list(self.multiple_outlets.items())[:5])
+            lines.append(f"basins with multiple outlets: {len(self.multiple_outlets)}, e.g. {examples}")
+        return "\n".join(lines)
+
+
+def validate_network(df: pd.DataFrame, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID",
+                     order_col: str = None, basin_col: str = None, outlet_id: int = -1):
+    """
+    Checks a stream network for the defects that used to need the iteration cutoff in trace_tree, and makes a cleaned
+    copy that can be traced without one. Every check is vectorized, apart from walking around the cycles found.
+    Cleaning:
+        - rows without an id are dropped, and for duplicated ids only the first row is kept
+        - self loops, next down ids that are missing or not in the network become outlets
+        - each cycle is broken by making one of its segments an outlet, the one with the highest order if orders are
+          given, otherwise the one with the lowest id
+        - missing orders are filled in with the Strahler order computed from the cleaned network
+    Basins with more than one outlet can only be found if basin_col is given, and are reported but left as they are.
+    Args:
+        df: dataframe containing the stream network.
+        stream_id_col: the name of the column that contains the unique ids for the streams
+        next_down_id_col: the name of the column that contains the unique id of the next down stream for each row
+        order_col: name of the column that contains the stream order, if it should be checked.
+        basin_col: name of a column with a basin id for each segment, if outlets per basin should be checked.
+        outlet_id: the next down id used to mark outlets.
+
+    Returns: tuple of (NetworkReport, cleaned dataframe).
+    """
+    report = NetworkReport()
+    has_id = df[stream_id_col].notna()
+    report.missing_ids = int((~has_id).sum())
+    duplicated = df[stream_id_col].duplicated(keep="first") & has_id
+    report.duplicate_ids = df.loc[duplicated, stream_id_col].unique().tolist()
+    cleaned = df[has_id & ~duplicated].copy()
+
+    ids = cleaned[stream_id_col].to_numpy()
+    next_down = cleaned[next_down_id_col].to_numpy()
+    self_loop = next_down == ids
+    report.self_loops = ids[self_loop].tolist()
+    outlet = next_down == outlet_id
+    dangling = ~outlet & ~self_loop & (pd.isna(next_down) | ~np.isin(next_down, ids))
+    report.dangling_next_down = ids[dangling].tolist()
+    next_down = np.where(self_loop | dangling | outlet, outlet_id, next_down)
+
+    orders = cleaned[order_col].to_numpy(dtype=float, copy=True) if order_col is not None else None
+    network = RiverNetwork(ids, next_down)
+    for cycle in _find_cycles(network.down):
+        report.cycles.append(ids[cycle].tolist())
+        if orders is not None and not np.isnan(orders[cycle]).all():
+            cut = cycle[np.nanargmax(orders[cycle])]
+        else:
+            cut = cycle[np.argmin(ids[cycle])]
+        next_down[cut] = outlet_id
+    cleaned[next_down_id_col] = next_down
+    if report.cycles:
+        network = RiverNetwork(ids, next_down)
+
+    report.n_segments = len(network)
+    report.n_outlets = int((network.down == -1).sum())
+    if basin_col is not None:
+        outlets = cleaned.loc[network.down == -1, [basin_col, stream_id_col]]
+        counts = outlets.groupby(basin_col)[stream_id_col]
+        report.multiple_outlets = {basin: group.tolist() for basin, group in counts if len(group) > 1}
+    if order_col is not None:
+        missing_order = np.isnan(orders)
+        report.nan_orders = ids[missing_order].tolist()
+        if missing_order.any():
+            orders[missing_order] = network.strahler_order()[missing_order]
+            cleaned[order_col] = orders
+    return report, cleaned
+
+
+def _find_cycles(down: np.ndarray) -> list:
+    """
+    Finds the cycles of a down index array. Jumping 2**k >= n steps down from any segment that never reaches an
+    outlet always lands on a cycle, so only the cycles themselves are walked one segment at a time.
+
+    Returns: list of int arrays with the indices of the segments on each cycle.
+    """
+    n = len(down)
+    nodes = np.arange(n)
+    reach = np.where(down == -1, nodes, down)
+    for _ in range(int(np.ceil(np.log2(max(n, 2)))) + 1):
+        reach = reach[reach]
+    stuck = down[reach] != -1
+    cycles = []
+    on_cycle = np.zeros(n, dtype=bool)
+    for start in np.unique(reach[stuck]):
+        if on_cycle[start]:
+            continue
+        cycle = [start]
+        nxt = down[start]
+        while nxt != start:
+            cycle.append(nxt)
+            nxt = down[nxt]
+        on_cycle[cycle] = True
+        cycles.append(np.array(cycle))
+    return cycles
@@ -0,0 +1,124 @@
+import numpy as np
+
+from RiverNetwork import RiverNetwork
+
+
+class OrderChains:
+    """
+    Same-order chains of every stream order of a network, found in one pass instead of filtering and tracing the
+    network once per order. Cutting every link between segments of different orders leaves a forest in which each
+    tree holds segments of one order only, and the depth first order of that forest (its UpstreamClosure) gives, for
+    all orders at once:
+        - the same-order upstream list of each segment as one slice of the permutation, exactly the lists
+          create_adjoint_dict gives with order_filter set to the segment's order
+        - chains: following each segment's first same-order parent gives runs of segments that are consecutive in the
+          permutation. Every segment is labelled with its chain and its position along it, 0 at the chain's downstream
+          end, and a same-order downstream list is the reversed slice of each chain down to the chain's head, which is
+          a single slice unless a segment has more than one parent of its own order.
+    Chains are also grouped by order, so chains_of_order(k) is a slice of one array.
+    """
+
+    def __init__(self, network: RiverNetwork):
+        """
+        Args:
+            network: RiverNetwork built with stream orders.
+        """
+        if network.orders is None:
+            raise ValueError("Network was built without stream orders, cannot find same-order chains")
+        self.network = network
+        has_down = network.down >= 0
+        same_order = np.zeros(len(network), dtype=bool)
+        same_order[has_down] = network.orders[has_down] == network.orders[network.down[has_down]]
+        self.forest = RiverNetwork(network.ids, np.where(same_order, network.next_down_ids, -1), network.orders)
+        self.closure = self.forest.upstream_closure()
+
+        down = self.forest.down
+        first_parent = np.full(len(network), -1, dtype=np.int32)
+        linked = down >= 0
+        first_parent[linked] = self.forest.up_children[self.forest.up_offsets[down[linked]]]
+        is_head = first_parent != np.arange(len(network))
+        heads_in_order = is_head[self.closure.order]
+        chain_in_order = np.cumsum(heads_in_order) - 1
+        self.chain_start = np.flatnonzero(heads_in_order).astype(np.int64)
+        self.chain_end = np.append(self.chain_start[1:], len(network)).astype(np.int64)
+        self.chain_head = self.closure.order[self.chain_start]
+        self.chain_order = network.orders[self.chain_head]
+
+        self.chain = np.empty(len(network), dtype=np.int32)
+        self.chain[self.closure.order] = chain_in_order
+        self.position = (self.closure.start - self.chain_start[self.chain]).astype(np.int32)
+
+        self.chains_by_order = np.argsort(self.chain_order, kind="stable").astype(np.int32)
+        self.orders, counts = np.unique(self.chain_order, return_counts=True)
+        self.order_offsets = np.zeros(len(self.orders) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.order_offsets[1:])
+
+    def __len__(self):
+        return len(self.chain_start)
+
+    def chains_of_order(self, order: int) -> np.ndarray:
+        """
+        Returns: int32 array of the numbers of the chains of the given order.
+        """
+        k = np.searchsorted(self.orders, order)
+        if k == len(self.orders) or self.orders[k] != order:
+            return np.zeros(0, dtype=np.int32)
+        return self.chains_by_order[self.order_offsets[k]:self.order_offsets[k + 1]]
+
+    def chain_ids(self, chain: int) -> np.ndarray:
+        """
+        Returns: array of the ids along a chain, from its downstream end up.
+        """
+        return self.network.ids[self.closure.order[self.chain_start[chain]:self.chain_end[chain]]]
+
+    def upstream(self, stream_id) -> np.ndarray:
+        """
+        Returns: array of the id and every id upstream of it that can be reached through segments of its order.
+        """
+        return self.network.ids[self.closure.upstream_indices(self._index(stream_id))]
+
+    def downstream(self, stream_id) -> np.ndarray:
+        """
+        Returns: array of the id and every id downstream of it before the stream order changes.
+        """
+        index = self._index(stream_id)
+        slices = []
+        while index != -1:
+            chain = self.chain[index]
+            slices.append(self.closure.order[self.chain_start[chain]:self.closure.start[index] + 1][::-1])
+            index = self.forest.down[self.chain_head[chain]]
+        return self.network.ids[np.concatenate(slices)]
+
+    def upstream_dict(self, order: int) -> dict:
+        """
+        Returns: dictionary of every id of the given order paired with its upstream list, in the create_adjoint_dict
+                 format, the same as calling it with order_filter set to order.
+        """
+        closure = self.closure
+        members = np.flatnonzero(self.network.orders == order)
+        return {str(self.network.ids[i]): self.network.ids[closure.order[closure.start[i]:closure.end[i]]].tolist()
+                for i in members}
+
+    def downstream_dict(self, order: int) -> dict:
+        """
+        Returns: dictionary of every id of the given order paired with its downstream list, in the create_adjoint_dict
+                 format with trace_up false and order_filter set to order.
+        """
+        members = self.network.ids[self.network.orders == order]
+        return {str(stream_id): self.downstream(stream_id).tolist() for stream_id in members}
+
+    def order_dicts(self, trace_up: bool = True) -> dict:
+        """
+        Args:
+            trace_up: if true, gives upstream lists, otherwise downstream lists.
+
+        Returns: dictionary of every stream order paired with its upstream_dict or downstream_dict.
+        """
+        make = self.upstream_dict if trace_up else self.downstream_dict
+        return {int(order): make(order) for order in self.orders}
+
+    def _index(self, stream_id) -> int:
+        index = self.network.index_of(stream_id)
+        if index == -1:
+            raise KeyError(stream_id)
+        return int(index)
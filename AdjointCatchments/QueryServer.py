@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from AdjoinStatsUpstream import AGG_FUNCS, aggregate_lists
+from AdjointIndex import open_index
+
+
+class ResultCache:
+    """
+    Least recently used cache of query results, bounded by the bytes of the cached arrays rather than by their count,
+    since one upstream list near a large river's mouth can be bigger than thousands of headwater lists.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value: np.ndarray):
+        if value.nbytes > self.max_bytes:
+            return
+        if key in self._items:
+            self.bytes -= self._items.pop(key).nbytes
+        self._items[key] = value
+        self.bytes += value.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+
+
+class QueryServer:
+    """
+    Answers upstream, downstream and upstream statistics queries over HTTP (and optionally a Unix socket) from an
+    index opened once, instead of every application loading the whole *-upstream-dict.json for a single lookup.
+    Endpoints, all returning JSON, with ids given as ids=1,2,3 in the query string or as {"ids": [...]} in a POST body:
+        - /upstream: {id: [upstream ids]}
+        - /downstream: {id: [downstream ids]}, for indexes written from a RiverNetwork
+        - /stats: {id: {col: value}}, the cols (comma separated) of the stats table aggregated upstream with agg
+        - /metrics: request counts and latencies per endpoint, and cache hits, misses and size
+    Unknown ids are left out of the results and listed under "missing". The stats table is read once into a sorted id
+    array and a matrix of its numeric columns, so a /stats request costs the length of its upstream lists rather than
+    the size of the table, and the aggregation runs in a worker thread so other clients are served meanwhile.
+    """
+
+    def __init__(self, index_path: str, stats_path: str = None, stats_id_col: str = "COMID",
+                 cache_bytes: int = 256 * 2 ** 20, latency_window: int = 10000):
+        """
+        Args:
+            index_path: path to a regional .adj index or a merged all-regions index.
+            stats_path: optional .parquet or .csv table of per segment attributes for /stats.
+            stats_id_col: name of the id column of the stats table.
+            cache_bytes: most bytes of results to keep in the cache.
+            latency_window: number of recent requests per endpoint the latency percentiles are computed over.
+        """
+        self.index = open_index(index_path)
+        self.stat_ids, self.stat_values, self.stat_cols = None, None, {}
+        if stats_path is not None:
+            stats = pd.read_parquet(stats_path) if stats_path.endswith(".parquet") else pd.read_csv(stats_path)
+            stats = stats.drop_duplicates(stats_id_col).sort_values(stats_id_col)
+            numeric = [col for col in stats.columns
+                       if col != stats_id_col and pd.api.types.is_numeric_dtype(stats[col])]
+            self.stat_ids = stats[stats_id_col].to_numpy(dtype=np.int64)
+            self.stat_values = stats[numeric].to_numpy(dtype=float)
+            self.stat_cols = {col: position for position, col in enumerate(numeric)}
+        self.stats_id_col = stats_id_col
+        self.cache = ResultCache(cache_bytes)
+        self.started = time.time()
+        self._latencies = {}
+        self._counts = {}
+        self._errors = 0
+        self._latency_window = latency_window
+        self._routes = {"/upstream": self.upstream, "/downstream": self.downstream, "/stats": self.stats_query,
+                        "/metrics": self.metrics}
+
+    def lookup(self, kind: str, key: int):
+        """
+        Returns: array of upstream or downstream ids of key, from the cache when possible, None if key is unknown.
+        """
+        cached = self.cache.get((kind, key))
+        if cached is not None:
+            return cached
+        try:
+            value = self.index[key] if kind == "upstream" else self.index.downstream(key)
+        except KeyError:
+            return None
+        value = np.array(value)
+        self.cache.put((kind, key), value)
+        return value
+
+    def upstream(self, params: dict) -> dict:
+        return self._lists("upstream", params)
+
+    def downstream(self, params: dict) -> dict:
+        return self._lists("downstream", params)
+
+    async def stats_query(self, params: dict) -> dict:
+        if self.stat_ids is None:
+            raise ValueError("The server was started without a stats table")
+        cols = _as_list(params.get("cols"))
+        agg_func = params.get("agg", "sum")
+        if agg_func not in AGG_FUNCS:
+            raise ValueError(f"agg must be one of {AGG_FUNCS}")
+        missing_cols = [col for col in cols if col not in self.stat_cols]
+        if not cols or missing_cols:
+            raise ValueError(f"cols must name numeric columns of the stats table, unknown: {missing_cols}")
+        found, missing = {}, []
+        for key in _ids(params):
+            value = self.lookup("upstream", key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, aggregate_lists, found, list(found), self.stat_ids, self.stat_values, agg_func,
+            [self.stat_cols[col] for col in cols], True)
+        values = {str(key): {col: _json_value(value) for col, value in zip(cols, row)}
+                  for key, row in zip(found, result)}
+        return {"results": values, "missing": missing}
+
+    def metrics(self, params: dict = None) -> dict:
+        endpoints = {}
+        for path, latencies in self._latencies.items():
+            ms = np.array(latencies) * 1000
+            endpoints[path] = {"requests": self._counts[path], "mean_ms": float(ms.mean()),
+                               "p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+                               "p99_ms": float(np.percentile(ms, 99))}
+        lookups = self.cache.hits + self.cache.misses
+        return {"uptime_s": time.time() - self.started, "errors": self._errors, "endpoints": endpoints,
+                "cache": {"hits": self.cache.hits, "misses": self.cache.misses,
+                          "hit_rate": self.cache.hits / lookups if lookups else 0.0, "entries": len(self.cache),
+                          "bytes": self.cache.bytes, "max_bytes": self.cache.max_bytes,
+                          "evictions": self.cache.evictions}}
+
+    async def handle(self, path: str, params: dict):
+        """
+        Runs one request, awaiting the routes that hand their work to a worker thread.
+
+        Returns: tuple of the HTTP status and the JSON serializable response.
+        """
+        route = self._routes.get(path)
+        if route is None:
+            return 404, {"error": f"Unknown endpoint {path}, use one of {list(self._routes)}"}
+        tic = time.perf_counter()
+        try:
+            body = route(params)
+            if asyncio.iscoroutine(body):
+                body = await body
+            status = 200
+        except (ValueError, TypeError) as e:
+            self._errors += 1
+            status, body = 400, {"error": str(e)}
+        if path != "/metrics":
+            self._counts[path] = self._counts.get(path, 0) + 1
+            self._latencies.setdefault(path, deque(maxlen=self._latency_window)).append(time.perf_counter() - tic)
+        return status, body
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, unix_socket: str = None):
+        """
+        Serves requests until cancelled, on host and port, and on a Unix socket if a path is given.
+        """
+        servers = [await asyncio.start_server(self._client, host, port)]
+        if unix_socket is not None:
+            servers.append(await asyncio.start_unix_server(self._client, unix_socket))
+        print(f"Serving {self.index.path} on http://{host}:{port}" + (f" and {unix_socket}" if unix_socket else ""))
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                if int(headers.get("content-length", 0)):
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                url = urlsplit(target)
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                if method == "POST" and body:
+                    try:
+                        params.update(json.loads(body))
+                    except json.JSONDecodeError as e:
+                        status, response = 400, {"error": f"Body is not valid JSON: {e}"}
+                    else:
+                        status, response = await self.handle(url.path, params)
+                elif method in ("GET", "POST"):
+                    status, response = await self.handle(url.path, params)
+                else:
+                    status, response = 405, {"error": f"Method {method} not allowed"}
+
+                payload = json.dumps(response).encode("utf-8")
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(f"{version} {status} {_REASONS.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1"))
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _lists(self, kind: str, params: dict) -> dict:
+        found, missing = {}, []
+        for key in _ids(params):
+            value = self.lookup(kind, key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[str(key)] = value.tolist()
+        return {"results": found, "missing": missing}
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [item for item in value.split(",") if item]
+    return list(value)
+
+
+def _ids(params: dict) -> list:
+    return [int(key) for key in _as_list(params.get("ids"))]
+
+
+def _json_value(value):
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serves upstream and downstream lookups from an adjoint catchment '
+                                                 'index (.adj) over HTTP on localhost.')
+    parser.add_argument('index', type=str, help='Required. Path to a regional or all-regions .adj index.')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Host to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on. Default: 8765')
+    parser.add_argument('--unixsocket', type=str, default=None, help='Path of a Unix socket to listen on as well.')
+    parser.add_argument('--stats', type=str, default=None,
+                        help='Path to a .parquet or .csv table of segment attributes for the /stats endpoint.')
+    parser.add_argument('--statsidcol', type=str, default="COMID",
+                        help='Name of the id column of the stats table. Default: "COMID"')
+    parser.add_argument('--cachemb', type=float, default=256,
+                        help='Size of the result cache in megabytes. Default: 256')
+    args = parser.parse_args()
+    server = QueryServer(args.index, args.stats, args.statsidcol, int(args.cachemb * 2 ** 20))
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unixsocket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+
+FORMATS = {".json": "json", ".jsonl": "jsonl", ".parquet": "parquet"}
+
+
+def format_for_path(path: str) -> str:
+    """
+    Returns: the output format for a path from its extension: "json" for .json, "jsonl" for .jsonl and "parquet" for
+             .parquet, None for any other extension.
+    """
+    return FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def write_lists(items, path: str, fmt: str = None, chunk_size: int = 10000, list_name: str = "ids",
+                chunk_values: int = 1 << 24) -> str:
+    """
+    Writes (id, list of ids) pairs as they are produced, chunk_size pairs (or chunk_values ids, whichever comes first)
+    at a time, so memory stays bounded by the chunk rather than the region, however long the lists near the mouth of a
+    large basin get. Integer arrays are formatted directly from their values instead of going through json.dump and
+    NpEncoder one element at a time. The file is written next to its destination and moved into place once complete.
+    Formats:
+        - json: the *-upstream-dict.json format, {"id": [ids], ...}, byte for byte what json.dump writes
+        - jsonl: one {"id": [ids]} object per line
+        - parquet: an id column and a large_list column (64 bit offsets) named list_name, one row group per chunk.
+          Needs pyarrow.
+    Args:
+        items: iterable of (id, list or integer array) pairs, e.g. from UpstreamClosure.items().
+        path: path to the output file.
+        fmt: one of "json", "jsonl" or "parquet", taken from the extension of path if None.
+        chunk_size: number of pairs to collect before writing them out.
+        list_name: name of the list column in parquet files.
+        chunk_values: number of ids in the lists to collect before writing them out.
+
+    Returns: the path written to.
+    """
+    fmt = fmt or format_for_path(path)
+    if fmt not in FORMATS.values():
+        raise ValueError(f"Unknown output format {fmt} for {path}, use one of {sorted(FORMATS.values())}")
+    tmp_path = f"{path}.tmp"
+    if fmt == "parquet":
+        _write_parquet(items, tmp_path, chunk_size, list_name, chunk_values)
+    else:
+        with open(tmp_path, "w") as f:
+            _write_json(items, f, chunk_size, lines=fmt == "jsonl", chunk_values=chunk_values)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _write_json(items, f, chunk_size: int, lines: bool, chunk_values: int):
+    separator = "\n" if lines else ", "
+    buffer = []
+    buffered_values = 0
+    first = True
+    if not lines:
+        f.write("{")
+    for key, values in items:
+        values = np.asarray(values)
+        entry = f'"{key}": [{", ".join(map(str, values.tolist()))}]'
+        buffer.append("{" + entry + "}" if lines else entry)
+        buffered_values += len(values)
+        if len(buffer) >= chunk_size or buffered_values >= chunk_values:
+            f.write(("" if first else separator) + separator.join(buffer))
+            first = False
+            buffer = []
+            buffered_values = 0
+    if buffer:
+        f.write(("" if first else separator) + separator.join(buffer))
+        first = False
+    if not lines:
+        f.write("}")
+    elif not first:
+        f.write("\n")
+
+
+def _write_parquet(items, path: str, chunk_size: int, list_name: str, chunk_values: int):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Writing parquet files needs pyarrow, install it or write .json or .jsonl instead")
+    schema = pa.schema([("id", pa.int64()), (list_name, pa.large_list(pa.int64()))])
+    with pq.ParquetWriter(path, schema) as writer:
+        keys, lists = [], []
+        buffered_values = 0
+        for key, values in items:
+            keys.append(int(key))
+            lists.append(np.asarray(values, dtype=np.int64))
+            buffered_values += len(lists[-1])
+            if len(keys) >= chunk_size or buffered_values >= chunk_values:
+                writer.write_table(_parquet_chunk(pa, schema, keys, lists))
+                keys, lists = [], []
+                buffered_values = 0
+        if keys:
+            writer.write_table(_parquet_chunk(pa, schema, keys, lists))
+
+
+def _parquet_chunk(pa, schema, keys: list, lists: list):
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(values) for values in lists], out=offsets[1:])
+    values = np.concatenate(lists) if lists else np.zeros(0, dtype=np.int64)
+    list_array = pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(values))
+    return pa.Table.from_arrays([pa.array(np.array(keys, dtype=np.int64)), list_array], schema=schema)
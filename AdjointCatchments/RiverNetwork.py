@@ -0,0 +1,568 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class RiverNetwork:
+    """
+    Array-backed river network graph. Every stream id is mapped to a dense int32 index (its row position in the source
+    table), and the topology is stored as flat NumPy arrays instead of Python dicts:
+        - down: index of the next down segment for each segment, -1 for outlets or ids not in the network
+        - up_offsets/up_children: CSR upstream adjacency, the parents of segment i are
+          up_children[up_offsets[i]:up_offsets[i + 1]], in the same order as the rows of the source table
+    The whole structure is built in a single vectorized pass, so it scales to networks with millions of segments.
+    """
+
+    def __init__(self, ids, next_down_ids, orders=None):
+        """
+        Args:
+            ids: array of unique segment ids.
+            next_down_ids: array of the same length with the id of the segment each segment flows into. Values that
+                           are not present in ids (e.g. -1) mark outlets.
+            orders: optional array of the same length with stream orders, needed to filter the network by order.
+        """
+        ids = np.asarray(ids)
+        next_down_ids = np.asarray(next_down_ids)
+        if ids.shape != next_down_ids.shape or ids.ndim != 1:
+            raise ValueError("ids and next_down_ids must be one dimensional arrays of the same length")
+        self.ids = ids
+        self.next_down_ids = next_down_ids
+        self.orders = None if orders is None else np.asarray(orders)
+
+        self._sorter = np.argsort(ids, kind="stable").astype(np.int32)
+        self._sorted_ids = ids[self._sorter]
+        repeated = self._sorted_ids[1:] == self._sorted_ids[:-1]
+        if repeated.any():
+            dupes = np.unique(self._sorted_ids[1:][repeated])
+            raise ValueError(f"Stream ids must be unique, found {len(dupes)} duplicated ids, "
+                             f"e.g. {dupes[:5].tolist()}")
+
+        n = len(ids)
+        self.down = self.index_of(next_down_ids)
+        has_down = self.down >= 0
+        child_nodes = np.flatnonzero(has_down).astype(np.int32)
+        self.up_children = child_nodes[np.argsort(self.down[child_nodes], kind="stable")]
+        self.up_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.down[has_down], minlength=n), out=self.up_offsets[1:])
+        self._closure = None
+
+    @classmethod
+    def from_dataframe(cls, df, stream_id_col: str = "COMID", next_down_id_col: str = "NextDownID",
+                       order_col: str = None) -> "RiverNetwork":
+        """
+        Builds a network from the id columns of a (Geo)DataFrame.
+        Args:
+            df: dataframe containing the stream network.
+            stream_id_col: the name of the column that contains the unique ids for the streams
+            next_down_id_col: the name of the column that contains the unique id of the next down stream for each row
+            order_col: name of the column that contains the stream order, if filtering by order will be needed.
+
+        Returns: RiverNetwork whose dense indices follow the row order of df.
+        """
+        orders = df[order_col].to_numpy() if order_col is not None else None
+        return cls(df[stream_id_col].to_numpy(), df[next_down_id_col].to_numpy(), orders)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_of(self, ids):
+        """
+        Looks up the dense index of one or more stream ids.
+        Args:
+            ids: a single id or an array of ids.
+
+        Returns: int32 index, or array of indices, with -1 for ids that are not in the network.
+        """
+        scalar = np.ndim(ids) == 0
+        ids = np.atleast_1d(np.asarray(ids))
+        if len(self._sorted_ids) == 0:
+            found = np.full(len(ids), -1, dtype=np.int32)
+            return found[0] if scalar else found
+        pos = np.searchsorted(self._sorted_ids, ids)
+        pos_clipped = np.minimum(pos, len(self._sorted_ids) - 1)
+        found = np.where(self._sorted_ids[pos_clipped] == ids, self._sorter[pos_clipped], -1).astype(np.int32)
+        return found[0] if scalar else found
+
+    def parents(self, index: int) -> np.ndarray:
+        """
+        Returns: indices of the segments that flow directly into the segment at the given index.
+        """
+        return self.up_children[self.up_offsets[index]:self.up_offsets[index + 1]]
+
+    def upstream_indices(self, index: int) -> np.ndarray:
+        """
+        Breadth first search up the network from a segment, one whole level of the search at a time. The result is
+        in the same order trace_tree gives for a make_tree_up tree. Segments are only visited once, so malformed
+        networks containing cycles terminate without needing an iteration cutoff.
+        Args:
+            index: dense index of the segment to search from.
+
+        Returns: int32 array of the indices of the segment and everything upstream of it.
+        """
+        visited = np.zeros(len(self), dtype=bool)
+        frontier = np.array([index], dtype=np.int32)
+        visited[frontier] = True
+        levels = [frontier]
+        while len(frontier):
+            frontier = _gather_children(self.up_offsets, self.up_children, frontier)
+            frontier = frontier[~visited[frontier]]
+            visited[frontier] = True
+            levels.append(frontier)
+        return np.concatenate(levels)
+
+    def downstream_indices(self, index: int) -> np.ndarray:
+        """
+        Follows the down index array from a segment to its outlet.
+        Args:
+            index: dense index of the segment to search from.
+
+        Returns: int32 array of the indices of the segment and every segment downstream of it.
+        """
+        path = [index]
+        seen = {index}
+        nxt = self.down[index]
+        while nxt != -1 and nxt not in seen:
+            path.append(nxt)
+            seen.add(nxt)
+            nxt = self.down[nxt]
+        return np.array(path, dtype=np.int32)
+
+    def upstream_closure(self) -> "UpstreamClosure":
+        """
+        Returns: UpstreamClosure holding the upstream set of every segment in the network, computed on first use.
+        """
+        if self._closure is None:
+            self._closure = UpstreamClosure(self)
+        return self._closure
+
+    def outlet_of(self) -> np.ndarray:
+        """
+        Returns: int32 array with the index of the outlet each segment drains to, which labels the independent basins
+                 of the network.
+        """
+        closure = self.upstream_closure()
+        roots = np.flatnonzero(self.down == -1)
+        roots = roots[np.argsort(closure.start[roots])]
+        return roots[np.searchsorted(closure.start[roots], closure.start, side="right") - 1].astype(np.int32)
+
+    def strahler_order(self) -> np.ndarray:
+        """
+        Computes Strahler stream orders without visiting segments one at a time, using the fact that a segment has an
+        order above k exactly when some segment upstream of it (or itself) has at least two parents of order k or
+        more. Each order is one pass of counts and prefix sums over the upstream closure, and there are at most
+        log2(n) + 1 orders.
+
+        Returns: int array of the Strahler order of each segment.
+        """
+        closure = self.upstream_closure()
+        has_down = self.down >= 0
+        orders = np.ones(len(self), dtype=np.int64)
+        at_least = np.ones(len(self), dtype=bool)
+        while at_least.any():
+            counts = np.bincount(self.down[at_least & has_down], minlength=len(self))
+            joins = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(counts[closure.order] >= 2, out=joins[1:])
+            at_least = joins[closure.end] - joins[closure.start] > 0
+            orders += at_least
+        return orders
+
+    def subset(self, mask) -> "RiverNetwork":
+        """
+        Makes a network of only the segments selected by a boolean mask. Segments whose next down segment is not
+        selected become outlets, with a next down id of -1.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        keep_down = np.zeros(len(self), dtype=bool)
+        keep_down[self.down >= 0] = mask[self.down[self.down >= 0]]
+        next_down_ids = np.where(keep_down, self.next_down_ids, -1)
+        orders = None if self.orders is None else self.orders[mask]
+        return RiverNetwork(self.ids[mask], next_down_ids[mask], orders)
+
+    def filter_order(self, order: int) -> "RiverNetwork":
+        """
+        Returns: network containing only the segments of the given stream order, linked only to neighbors that share
+                 that order.
+        """
+        if self.orders is None:
+            raise ValueError("Network was built without stream orders, cannot filter by order")
+        return self.subset(self.orders == order)
+
+    def upstream_set(self, stream_id) -> "SegmentSet":
+        """
+        Returns: lazy SegmentSet of the segment and everything upstream of it, see UpstreamClosure.upstream_set.
+        """
+        return self.upstream_closure().upstream_set(stream_id)
+
+    def downstream_set(self, stream_id) -> "DownstreamSet":
+        """
+        Returns: lazy DownstreamSet of the segment and everything downstream of it, see
+                 UpstreamClosure.downstream_set.
+        """
+        return self.upstream_closure().downstream_set(stream_id)
+
+    def upstream_tree(self) -> "UpstreamTreeView":
+        """
+        Returns: read-only dict-like view in the make_tree_up format, {id: (parent ids)}.
+        """
+        return UpstreamTreeView(self)
+
+    def downstream_tree(self) -> "DownstreamTreeView":
+        """
+        Returns: read-only dict-like view in the make_tree_down format, {id: next down id}.
+        """
+        return DownstreamTreeView(self)
+
+
+class UpstreamClosure:
+    """
+    Upstream sets of every segment of a network, computed together without tracing any segment on its own. The
+    segments are laid out in depth first (Euler tour) order starting from the outlets, so everything upstream of a
+    segment occupies one contiguous slice [start, end) of a single permutation array, with the segment itself first:
+        upstream of segment i == order[start[i]:end[i]]
+    The Euler tour is ranked with vectorized pointer jumping, which takes O(log n) passes over the network no matter
+    how long its mainstems are, and holds O(n) memory in total. Nothing is truncated, however large the basin.
+    """
+
+    def __init__(self, network: RiverNetwork):
+        self.network = network
+        n = len(network)
+        nodes = np.arange(n, dtype=np.int64)
+        down = network.down.astype(np.int64)
+        offsets = network.up_offsets
+        children = network.up_children.astype(np.int64)
+        roots = np.flatnonzero(down == -1)
+
+        # tour events: entering segment v is event v, leaving it is event n + v, and 2n marks the end of the tour
+        tour_end = 2 * n
+        next_sibling = np.full(n, -1, dtype=np.int64)
+        not_last = np.ones(len(children), dtype=bool)
+        not_last[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = False
+        next_sibling[children[:-1][not_last[:-1]]] = children[1:][not_last[:-1]]
+        next_sibling[roots[:-1]] = roots[1:]
+
+        has_children = offsets[1:] > offsets[:-1]
+        first_child = np.full(n, -1, dtype=np.int64)
+        first_child[has_children] = children[offsets[:-1][has_children]]
+
+        successor = np.empty(2 * n + 1, dtype=np.int64)
+        successor[:n] = np.where(has_children, first_child, n + nodes)
+        successor[n:2 * n] = np.where(next_sibling != -1, next_sibling, np.where(down != -1, n + down, tour_end))
+        successor[tour_end] = tour_end
+
+        # list ranking: steps_left[e] becomes the number of events after e in the tour
+        steps_left = np.ones(2 * n + 1, dtype=np.int64)
+        steps_left[tour_end] = 0
+        for _ in range(int(np.ceil(np.log2(2 * n + 1))) + 1):
+            steps_left += steps_left[successor]
+            successor = successor[successor]
+        if (successor != tour_end).any():
+            stuck = int((successor[:n] != tour_end).sum())
+            raise ValueError(f"{stuck} segments never reach an outlet, the network contains cycles")
+
+        position = 2 * n - steps_left[:2 * n]
+        enters_before = np.zeros(2 * n + 1, dtype=np.int64)
+        is_enter = np.zeros(2 * n, dtype=np.int64)
+        is_enter[position[:n]] = 1
+        np.cumsum(is_enter, out=enters_before[1:])
+        self.start = enters_before[position[:n]]
+        self.end = enters_before[position[n:]]
+        self.order = np.empty(n, dtype=np.int32)
+        self.order[self.start] = nodes
+        self._members = None
+        self._depth = None
+
+    def __len__(self):
+        return len(self.network)
+
+    @property
+    def depth(self) -> np.ndarray:
+        """
+        Number of segments downstream of each segment, computed on first use. A segment is downstream of every
+        position strictly inside its slice, so adding one at the start of each slice and removing it at the end gives
+        the depths as one prefix sum over the permutation.
+        """
+        if self._depth is None:
+            n = len(self)
+            diff = np.bincount(self.start + 1, minlength=n + 1) - np.bincount(self.end, minlength=n + 1)
+            self._depth = np.cumsum(diff[:n])[self.start]
+        return self._depth
+
+    def is_upstream(self, stream_id, of_id) -> bool:
+        """
+        Returns: true if the segment stream_id is of_id or upstream of it, an O(1) interval containment test.
+        """
+        index, of_index = self._index(stream_id), self._index(of_id)
+        return bool(self.start[of_index] <= self.start[index] < self.end[of_index])
+
+    def upstream_set(self, stream_id) -> "SegmentSet":
+        """
+        Returns: lazy SegmentSet of the segment and everything upstream of it, a single interval of the permutation.
+        """
+        index = self._index(stream_id)
+        return SegmentSet(self, [self.start[index]], [self.end[index]])
+
+    def downstream_set(self, stream_id) -> "DownstreamSet":
+        """
+        Returns: lazy DownstreamSet of the segment and every segment downstream of it.
+        """
+        return DownstreamSet(self, self._index(stream_id))
+
+    def upstream_indices(self, index: int) -> np.ndarray:
+        """
+        Returns: int32 array (a view, not a copy) of the indices of the segment and everything upstream of it.
+        """
+        return self.order[self.start[index]:self.end[index]]
+
+    def upstream(self, stream_id) -> np.ndarray:
+        """
+        Returns: array of the ids of the segment and everything upstream of it.
+        """
+        index = self.network.index_of(stream_id)
+        if index == -1:
+            raise KeyError(stream_id)
+        return self.network.ids[self.upstream_indices(index)]
+
+    def members(self) -> np.ndarray:
+        """
+        Returns: the permutation array translated into stream ids, so upstream of segment i == members[start:end].
+                 Made on first use and shared, so treat it as read-only.
+        """
+        if self._members is None:
+            self._members = self.network.ids[self.order]
+        return self._members
+
+    def items(self):
+        """
+        Yields: (stream id, array of the ids upstream of it) pairs in network order, each array a view of one shared
+                array, so no list is copied until it is used.
+        """
+        members = self.members()
+        for stream_id, s, e in zip(self.network.ids.tolist(), self.start.tolist(), self.end.tolist()):
+            yield stream_id, members[s:e]
+
+    def to_dict(self) -> dict:
+        """
+        Returns: dictionary in the create_adjoint_dict format, each stream id as a string paired with the list of ids
+                 upstream of it (itself first).
+        """
+        members = self.members().tolist()
+        return {str(stream_id): members[s:e] for stream_id, s, e in
+                zip(self.network.ids.tolist(), self.start.tolist(), self.end.tolist())}
+
+    def _index(self, stream_id) -> int:
+        index = self.network.index_of(stream_id)
+        if index == -1:
+            raise KeyError(stream_id)
+        return int(index)
+
+
+class SegmentSet:
+    """
+    Lazy set of segments of a network, held as sorted, disjoint [lo, hi) intervals of positions in the depth first
+    permutation of an UpstreamClosure rather than as a list of ids. An upstream set is a single interval, so its
+    length and membership tests are O(1), and intersections, differences and unions are merges of interval lists
+    whose cost depends on the number of intervals, not on the size of the basins. For example the incremental
+    catchment between two gauges is network.upstream_set(lower) - network.upstream_set(upper), two intervals however
+    many segments it holds. Iterating yields the ids of each interval as a view of closure.members(); ids are only
+    copied out by ids(), indices() or tolist().
+    """
+
+    def __init__(self, closure: UpstreamClosure, lo, hi):
+        """
+        Args:
+            closure: UpstreamClosure whose permutation the intervals refer to.
+            lo: sorted array of the first position of each interval.
+            hi: array of the position after the end of each interval, disjoint from and before the next interval.
+        """
+        self.closure = closure
+        self._lo = np.asarray(lo, dtype=np.int64)
+        self._hi = np.asarray(hi, dtype=np.int64)
+
+    @property
+    def intervals(self):
+        """
+        Returns: tuple of the lo and hi arrays of the intervals.
+        """
+        return self._lo, self._hi
+
+    def __len__(self):
+        lo, hi = self.intervals
+        return int((hi - lo).sum())
+
+    def __contains__(self, stream_id):
+        index = self.closure.network.index_of(stream_id)
+        if index == -1:
+            return False
+        lo, hi = self.intervals
+        i = int(np.searchsorted(lo, self.closure.start[index], side="right")) - 1
+        return i >= 0 and self.closure.start[index] < hi[i]
+
+    def __iter__(self):
+        members = self.closure.members()
+        for lo, hi in zip(*self.intervals):
+            yield members[lo:hi]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} segments in {len(self.intervals[0])} intervals)"
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def intersection(self, other: "SegmentSet") -> "SegmentSet":
+        return self._combine(other, np.logical_and)
+
+    def union(self, other: "SegmentSet") -> "SegmentSet":
+        return self._combine(other, np.logical_or)
+
+    def difference(self, other: "SegmentSet") -> "SegmentSet":
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def indices(self) -> np.ndarray:
+        """
+        Returns: int32 array of the indices of the segments, in depth first order.
+        """
+        lo, hi = self.intervals
+        return self.closure.order[_ranges(lo, hi)]
+
+    def ids(self) -> np.ndarray:
+        """
+        Returns: array of the ids of the segments, in depth first order.
+        """
+        lo, hi = self.intervals
+        return self.closure.members()[_ranges(lo, hi)]
+
+    def tolist(self) -> list:
+        """
+        Returns: list of the ids of the segments, in depth first order.
+        """
+        return self.ids().tolist()
+
+    def _combine(self, other: "SegmentSet", keep) -> "SegmentSet":
+        if other.closure is not self.closure:
+            raise ValueError("Cannot combine sets of segments from different networks or closures")
+        (a_lo, a_hi), (b_lo, b_hi) = self.intervals, other.intervals
+        # cut at every interval boundary, then keep the pieces covered as asked and merge the touching ones
+        points = np.unique(np.concatenate((a_lo, a_hi, b_lo, b_hi)))
+        lo, hi = points[:-1], points[1:]
+        kept = keep(_covered(a_lo, a_hi, lo), _covered(b_lo, b_hi, lo))
+        lo, hi = lo[kept], hi[kept]
+        joined = np.zeros(len(lo), dtype=bool)
+        joined[1:] = lo[1:] == hi[:-1]
+        return SegmentSet(self.closure, lo[~joined], hi[np.append(~joined[1:], True)] if len(lo) else hi)
+
+
+class DownstreamSet(SegmentSet):
+    """
+    Lazy SegmentSet of a segment and every segment downstream of it. Its length (from UpstreamClosure.depth) and
+    membership tests, u is downstream of v exactly when v lies in u's slice, are O(1) without following the path;
+    the intervals, one per run of the path that is consecutive in the permutation, are only found when the set is
+    iterated, combined or materialized.
+    """
+
+    def __init__(self, closure: UpstreamClosure, index: int):
+        super().__init__(closure, [], [])
+        self.index = index
+        self._found = False
+
+    @property
+    def intervals(self):
+        if not self._found:
+            positions = np.sort(self.closure.start[self.closure.network.downstream_indices(self.index)])
+            runs = np.flatnonzero(np.diff(positions) != 1) + 1
+            self._lo = positions[np.r_[0, runs]]
+            self._hi = positions[np.r_[runs - 1, len(positions) - 1]] + 1
+            self._found = True
+        return self._lo, self._hi
+
+    def __len__(self):
+        return int(self.closure.depth[self.index]) + 1
+
+    def __contains__(self, stream_id):
+        index = self.closure.network.index_of(stream_id)
+        if index == -1:
+            return False
+        position = self.closure.start[self.index]
+        return bool(self.closure.start[index] <= position < self.closure.end[index])
+
+
+class UpstreamTreeView(Mapping):
+    """
+    Thin dict-like view of a RiverNetwork where each id maps to a tuple of its parent ids, as made by make_tree_up.
+    """
+
+    def __init__(self, network: RiverNetwork):
+        self.network = network
+
+    def __getitem__(self, key):
+        index = self.network.index_of(key)
+        if index == -1:
+            raise KeyError(key)
+        return tuple(self.network.ids[self.network.parents(index)].tolist())
+
+    def __contains__(self, key):
+        return self.network.index_of(key) != -1
+
+    def __iter__(self):
+        return iter(self.network.ids.tolist())
+
+    def __len__(self):
+        return len(self.network)
+
+
+class DownstreamTreeView(Mapping):
+    """
+    Thin dict-like view of a RiverNetwork where each id maps to its next down id, as made by make_tree_down.
+    """
+
+    def __init__(self, network: RiverNetwork):
+        self.network = network
+
+    def __getitem__(self, key):
+        index = self.network.index_of(key)
+        if index == -1:
+            raise KeyError(key)
+        return self.network.next_down_ids[index].item()
+
+    def __contains__(self, key):
+        return self.network.index_of(key) != -1
+
+    def __iter__(self):
+        return iter(self.network.ids.tolist())
+
+    def __len__(self):
+        return len(self.network)
+
+
+def _covered(lo: np.ndarray, hi: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Returns: boolean array, true for the positions inside one of the sorted, disjoint [lo, hi) intervals.
+    """
+    i = np.searchsorted(lo, positions, side="right") - 1
+    return (i >= 0) & (positions < hi[np.maximum(i, 0)]) if len(lo) else np.zeros(len(positions), dtype=bool)
+
+
+def _ranges(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    Returns: the positions of the [lo, hi) intervals one after another, as one array.
+    """
+    lengths = hi - lo
+    return np.repeat(lo - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+
+def _gather_children(offsets: np.ndarray, children: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    """
+    Concatenates the CSR rows of several nodes in one vectorized step, keeping the order of nodes.
+    """
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    total = counts.sum()
+    if total == 0:
+        return children[:0]
+    row_starts = np.cumsum(counts) - counts
+    return children[np.repeat(starts - row_starts, counts) + np.arange(total)]
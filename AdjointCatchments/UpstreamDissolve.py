@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from NetworkPartition import basin_groups
+from RiverNetwork import RiverNetwork
+
+
+def dissolve_upstream(catchments: gpd.GeoDataFrame, out_gpkg: str = None, stream_id_col: str = "HydroID",
+                      next_down_id_col: str = "NextDownID", layer: str = "upstream",
+                      simplify_tolerance: float = None, workers: int = 1, chunk_size: int = 50000):
+    """
+    Makes the upstream watershed polygon of every catchment in a region in one run. Instead of filtering and
+    dissolving the catchments once per outlet, the polygons are built bottom-up: each segment's watershed is the union
+    of its own catchment and the already dissolved watersheds of its parents, reusing the work done upstream rather
+    than unioning every headwater again for each outlet below it. Basins are independent, so groups of whole basins
+    are processed in parallel, and each group's results are written to the GeoPackage as soon as it finishes, which
+    bounds memory by the group size rather than the region size.
+    Args:
+        catchments: GeoDataFrame of catchment polygons with stream id and next down id columns.
+        out_gpkg: path to a GeoPackage to write the watersheds to. If None, they are returned as a GeoDataFrame.
+        stream_id_col: the name of the column that contains the unique ids for the catchments
+        next_down_id_col: the name of the column that contains the unique id of the next down catchment for each row
+        layer: name of the layer to write in the GeoPackage.
+        simplify_tolerance: if given, output polygons are simplified with this tolerance (in the units of the
+                            catchments' CRS). The unions themselves are always done on the full polygons.
+        workers: number of worker processes to spread basins over.
+        chunk_size: approximate number of catchments per task given to a worker.
+
+    Returns: the path to the GeoPackage, or a GeoDataFrame of stream ids and watershed polygons if out_gpkg is None.
+    """
+    network = RiverNetwork.from_dataframe(catchments, stream_id_col, next_down_id_col)
+    wkbs = shapely.to_wkb(catchments.geometry.values)
+    tasks = [(network.ids[rows], network.next_down_ids[rows], wkbs[rows], simplify_tolerance)
+             for rows in basin_groups(network, chunk_size)]
+
+    if out_gpkg is not None and os.path.exists(out_gpkg):
+        os.remove(out_gpkg)
+    results = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            _collect(pool.map(_dissolve_task, tasks), catchments.crs, stream_id_col, out_gpkg, layer, results)
+    else:
+        _collect(map(_dissolve_task, tasks), catchments.crs, stream_id_col, out_gpkg, layer, results)
+    if out_gpkg is not None:
+        return out_gpkg
+    if not results:
+        return gpd.GeoDataFrame({stream_id_col: []}, geometry=[], crs=catchments.crs)
+    return gpd.GeoDataFrame({stream_id_col: np.concatenate([r[0] for r in results])},
+                            geometry=np.concatenate([r[1] for r in results]), crs=catchments.crs)
+
+
+def _dissolve_task(task):
+    ids, next_down_ids, wkbs, simplify_tolerance = task
+    network = RiverNetwork(ids, next_down_ids)
+    out = shapely.from_wkb(wkbs)
+    # reversed depth first order puts every segment after all of its parents, so their watersheds are ready
+    for index in network.upstream_closure().order[::-1]:
+        parents = network.parents(index)
+        if len(parents):
+            out[index] = shapely.union_all(np.append(out[parents], out[index]))
+    if simplify_tolerance:
+        out = shapely.simplify(out, simplify_tolerance, preserve_topology=True)
+    return ids, shapely.to_wkb(out)
+
+
+def _collect(task_results, crs, stream_id_col: str, out_gpkg: str, layer: str, results: list):
+    for ids, wkbs in task_results:
+        geoms = shapely.from_wkb(wkbs)
+        if out_gpkg is None:
+            results.append((ids, geoms))
+            continue
+        gdf = gpd.GeoDataFrame({stream_id_col: ids}, geometry=geoms, crs=crs)
+        gdf.to_file(out_gpkg, layer=layer, driver="GPKG", mode="a" if os.path.exists(out_gpkg) else "w")
@@ -0,0 +1,191 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from AdjointIndex import INDEX_EXTENSION, GlobalAdjointIndex, json_to_arrays, open_index
+from NetworkQueries import DownstreamQueries
+from NetworkSchemas import get_schema
+from RiverNetwork import RiverNetwork
+
+
+@dataclass
+class VerifyReport:
+    """
+    Differences found by verify_results between stored upstream (or downstream) lists and the lists traced from the
+    network. Every list holds stream ids.
+        - missing_keys: network ids without a stored list
+        - extra_keys: stored ids that are not in the network
+        - truncated: lists holding only part of the traced list and nothing else, as the cuttoff_n limit of trace_tree
+          leaves them
+        - mismatched: lists holding ids that are not in the traced list
+        - duplicated: lists holding an id more than once
+    """
+    n_segments: int = 0
+    n_stored: int = 0
+    n_checked: int = 0
+    n_ok: int = 0
+    missing_keys: list = field(default_factory=list)
+    extra_keys: list = field(default_factory=list)
+    truncated: list = field(default_factory=list)
+    mismatched: list = field(default_factory=list)
+    duplicated: list = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not (self.missing_keys or self.extra_keys or self.truncated or self.mismatched or self.duplicated)
+
+    def summary(self) -> str:
+        """
+        Returns: one line per kind of difference with how many were found and a few example ids.
+        """
+        lines = [f"{self.n_segments} segments, {self.n_stored} stored lists, {self.n_ok} of {self.n_checked} "
+                 f"checked lists match"]
+        for name in ("missing_keys", "extra_keys", "truncated", "mismatched", "duplicated"):
+            found = getattr(self, name)
+            if found:
+                lines.append(f"{name.replace('_', ' ')}: {len(found)}, e.g. {found[:5]}")
+        return "\n".join(lines)
+
+
+def verify_results(network: RiverNetwork, results_path: str, trace_up: bool = True, sample: int = None,
+                   workers: int = 1, seed: int = 0, chunk_values: int = 1 << 22) -> VerifyReport:
+    """
+    Checks stored upstream (or downstream) lists against the lists traced from the network with the closure (or
+    binary lifting downstream). The traced and stored lists are mapped to dense network indices once, saved to a
+    temporary directory and memory-mapped by the workers, which compare whole chunks of lists at once as sorted
+    (list, segment) pairs rather than one list at a time. Lists are compared as sets, so their order does not matter.
+    Args:
+        network: RiverNetwork the results were made from.
+        results_path: path to a *-upstream-dict.json file or a regional .adj index.
+        trace_up: if true the results are upstream lists, otherwise downstream lists.
+        sample: if given, only this many ids, chosen at random, have their lists compared. Missing and extra keys are
+                always checked for every id.
+        workers: number of worker processes.
+        seed: seed of the random sample.
+        chunk_values: about how many list values each worker compares at once.
+
+    Returns: VerifyReport.
+    """
+    if results_path.endswith(INDEX_EXTENSION):
+        stored = open_index(results_path)
+        if isinstance(stored, GlobalAdjointIndex):
+            raise ValueError(f"{results_path} is a merged index of several regions, verify its regions one by one")
+        keys = stored.keys()
+        positions = np.flatnonzero(stored.start != -1)
+        starts, ends = stored.start[positions], stored.end[positions]
+        values = network.index_of(stored.ids)[stored.order]
+    else:
+        keys, lengths, values = json_to_arrays(results_path)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        values = network.index_of(values)
+
+    if trace_up:
+        closure = network.upstream_closure()
+        expected = {"start": closure.start, "end": closure.end, "values": closure.order}
+    else:
+        offsets, path_ids = DownstreamQueries(network).paths_to_outlet(network.ids)
+        expected = {"start": offsets[:-1], "end": offsets[1:], "values": network.index_of(path_ids)}
+
+    key_indices = network.index_of(keys)
+    known = key_indices != -1
+    stored_start = np.full(len(network), -1, dtype=np.int64)
+    stored_end = np.full(len(network), -1, dtype=np.int64)
+    stored_start[key_indices[known]] = starts[known]
+    stored_end[key_indices[known]] = ends[known]
+    report = VerifyReport(n_segments=len(network), n_stored=len(keys))
+    report.missing_keys = np.sort(network.ids[stored_start == -1]).tolist()
+    report.extra_keys = np.sort(keys[~known]).tolist()
+
+    checked = np.flatnonzero(stored_start != -1)
+    if sample is not None and sample < len(checked):
+        checked = np.sort(np.random.default_rng(seed).choice(checked, sample, replace=False))
+    report.n_checked = len(checked)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        arrays = {"expected_start": expected["start"], "expected_end": expected["end"],
+                  "expected": expected["values"], "stored_start": stored_start, "stored_end": stored_end,
+                  "stored": values}
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        tasks = [(tmp_dir, chunk) for chunk in _chunks(expected["end"] - expected["start"], checked, chunk_values)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_verify_chunk, *zip(*tasks)))
+        else:
+            results = [_verify_chunk(*task) for task in tasks]
+    for truncated, mismatched, duplicated in results:
+        report.truncated.extend(network.ids[truncated].tolist())
+        report.mismatched.extend(network.ids[mismatched].tolist())
+        report.duplicated.extend(network.ids[duplicated].tolist())
+    report.truncated.sort()
+    report.mismatched.sort()
+    report.duplicated.sort()
+    report.n_ok = report.n_checked - len(set(report.truncated) | set(report.mismatched) | set(report.duplicated))
+    return report
+
+
+def verify_file(network_path: str, results_path: str, stream_id_col: str = "COMID",
+                next_down_id_col: str = "NextDownID", schema: str = None, trace_up: bool = True, sample: int = None,
+                workers: int = 1) -> VerifyReport:
+    """
+    Reads a stream network file and runs verify_results on the results made from it.
+    Args:
+        network_path: path to the stream network file, read through NetworkIngest.
+        results_path: path to a *-upstream-dict.json file or a regional .adj index.
+        stream_id_col: name of the stream id column, if no schema is given.
+        next_down_id_col: name of the next down id column, if no schema is given.
+        schema: optional NetworkSchema, or the name of one, giving the column names instead.
+        trace_up: if true the results are upstream lists, otherwise downstream lists.
+        sample: if given, only this many randomly chosen lists are compared, see verify_results.
+        workers: number of worker processes.
+
+    Returns: VerifyReport.
+    """
+    from NetworkIngest import read_network_table
+
+    if schema is not None:
+        schema = get_schema(schema)
+        network = schema.network(read_network_table(network_path, [schema.stream_id_col, schema.next_down_id_col]))
+    else:
+        network_df = read_network_table(network_path, [stream_id_col, next_down_id_col])
+        network = RiverNetwork.from_dataframe(network_df, stream_id_col, next_down_id_col)
+    return verify_results(network, results_path, trace_up, sample, workers)
+
+
+def _chunks(lengths: np.ndarray, indices: np.ndarray, chunk_values: int) -> list:
+    total = np.cumsum(lengths[indices])
+    bounds = np.searchsorted(total, np.arange(chunk_values, total[-1] if len(total) else 0, chunk_values),
+                             side="right")
+    return [chunk for chunk in np.split(indices, np.unique(bounds)) if len(chunk)]
+
+
+def _pairs(start: np.ndarray, end: np.ndarray, values: np.ndarray, width: int) -> np.ndarray:
+    # every (list, segment) pair of a chunk as one integer, sorted, with segments outside the network as width - 1
+    lengths = end - start
+    flat = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(start, lengths)
+    segments = np.asarray(values[flat], dtype=np.int64)
+    segments[segments == -1] = width - 1
+    pairs = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths) * width + segments
+    pairs.sort()
+    return pairs
+
+
+def _verify_chunk(tmp_dir: str, indices: np.ndarray):
+    arrays = {name: np.load(os.path.join(tmp_dir, f"{name}.npy"), mmap_mode="r")
+              for name in ("expected_start", "expected_end", "expected", "stored_start", "stored_end", "stored")}
+    width = len(arrays["expected_start"]) + 1
+    expected = _pairs(arrays["expected_start"][indices], arrays["expected_end"][indices], arrays["expected"], width)
+    stored = _pairs(arrays["stored_start"][indices], arrays["stored_end"][indices], arrays["stored"], width)
+
+    repeated = np.r_[False, stored[1:] == stored[:-1]]
+    found = np.searchsorted(expected, stored)
+    found = expected[np.minimum(found, len(expected) - 1)] == stored if len(expected) else np.zeros(len(stored), bool)
+    count = len(indices)
+    extra = np.bincount(stored[~found] // width, minlength=count)
+    matched = np.bincount(stored[found & ~repeated] // width, minlength=count)
+    short = arrays["expected_end"][indices] - arrays["expected_start"][indices] - matched
+    repeats = np.bincount(stored[repeated] // width, minlength=count)
+    return indices[(extra == 0) & (short > 0)], indices[extra > 0], indices[repeats > 0]
@@ -1,9 +1,13 @@
 import json
-import pandas as pd
+import os
+import sys
 import argparse
-import geopandas as gpd
-import contextily as cx
-import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "AdjointCatchments"))
+from AdjointIndex import INDEX_EXTENSION, open_index
+from NetworkIngest import read_network_table
+from NetworkSchemas import SCHEMAS
+from VerifyResults import verify_file
 
 if __name__ == "__main__":
     network_shp = None
@@ -13,20 +17,33 @@ if __name__ == "__main__":
     description = 'This script will run some tests on JSONs produced from AdjoinUpdown.py. Given a path to a stream' \
                   'network and a path to an upstreamJSON produced using that same stream network, it will display a' \
                   'map showing the full stream network with the upstream chain from a chosen ID highlighted, and it' \
-                  'will also test the list going back downstream from the top to the bottom to ensure it is right.'
+                  'will also test the list going back downstream from the top to the bottom to ensure it is right.' \
+                  ' With --verify it instead checks every stored list (or a sample of them) against the network ' \
+                  'without plotting, reporting missing keys and truncated or mismatched lists.'
 
     parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument('networkshp', type=str,
                         help='Required. Path to .shp file containing network to test.')
     parser.add_argument('upstreamjsonpath', type=str,
-                        help='Required. Path to .shp file containing json created from the network using '
+                        help='Required. Path to the json (or .adj index) created from the network using '
                              'AdjoinUpdown.py')
     parser.add_argument('--streamidcol', metavar='-SIDCol', type=str, default="COMID",
                         help='Name of Stream ID Column. Default: "COMID"')
     parser.add_argument('--ordercol', metavar='-OrdCol', type=str, default="order_",
                         help='Name of Column containing stream orders. Need not be provided if orderfilter is 0,'
                              'otherwise required if the tool is to be able to filter by order. Default: "order_"')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check the stored lists against the lists traced from the network instead of plotting.')
+    parser.add_argument('--nextdownidcol', metavar='-NDIDCol', type=str, default="NextDownID",
+                        help='Name of Next Down ID Column, used by --verify. Default: "NextDownID"')
+    parser.add_argument('--schema', choices=sorted(SCHEMAS), default=None,
+                        help='Network schema, overriding the id and next down id column names, used by --verify.')
+    parser.add_argument('--sample', type=int, default=None,
+                        help='Number of randomly chosen lists to check with --verify. Default: all of them')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used by --verify. Default: 1')
+    parser.add_argument('--tracedown', action='store_true',
+                        help='The stored lists trace downstream rather than upstream, used by --verify.')
     args = parser.parse_args()
     print(vars(args))
     network_shp = args.networkshp
@@ -36,19 +53,36 @@ if __name__ == "__main__":
     if 'ordercol' in args:
         order_col = args.ordercol
 
-    f = open(upstream_json_path)
+    if args.verify:
+        report = verify_file(network_shp, upstream_json_path, stream_id_col, args.nextdownidcol, args.schema,
+                             not args.tracedown, args.sample, args.workers)
+        print(report.summary())
+        sys.exit(0 if report.ok else 1)
+
+    import contextily as cx
+    import matplotlib.pyplot as plt
 
-    upstream_dict = json.load(f)
+    if upstream_json_path.endswith(INDEX_EXTENSION):
+        upstream_dict = open_index(upstream_json_path)
+    else:
+        with open(upstream_json_path) as f:
+            upstream_dict = json.load(f)
 
     # japan_comb_adjoin = gpd.read_file('NGADelineation/Japan_comb/Japan_comb.shp')
     # print(japan_comb_adjoin['streamID'])
-    drainage = gpd.read_file(network_shp)
+    drainage = read_network_table(network_shp, [stream_id_col], geometry=True)
     searchid = input('input search id: ')
     while searchid != "stop":
+        try:
+            id_list = upstream_dict[searchid]
+        except (KeyError, ValueError):
+            # an .adj index looks ids up as integers, so text that is not a number raises ValueError
+            print(f"{searchid} is not an id in {upstream_json_path}")
+            searchid = input('input search id: ')
+            continue
         fig, ax = plt.subplots(figsize=(100, 100))
-        print(upstream_dict[searchid])
+        print(id_list)
         # print(japan_comb_adjoin[japan_comb_adjoin["streamID"] == searchid])
-        id_list = upstream_dict[searchid]
         plot_group = drainage[drainage[stream_id_col].isin(id_list)]
         print(plot_group)
         plot_group.plot(ax=ax, color='red')